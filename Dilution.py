@@ -1,7 +1,7 @@
 
 from __future__ import division, print_function
-from collections import defaultdict
-from math import ceil, atan2, degrees
+from collections import defaultdict, OrderedDict
+from math import ceil
 from operator import itemgetter
 import sys
 import os
@@ -10,6 +10,14 @@ import arcpy
 import ArcHydroTools
 from arcpy import env
 from arcpy.sa import *
+from hydrotools import arcpy_io
+from hydrotools import d8
+from hydrotools import index
+from hydrotools import network
+from hydrotools import polyline
+from hydrotools import streams
+from hydrotools import tables
+from hydrotools import zonal
 
 arcpy.CheckOutExtension("Spatial")
 
@@ -18,6 +26,10 @@ node_dx = 100  # meters
 buffer_widths = [30, 50, 70, 90, 110]  #feet
 checkDirection = False
 
+# Use the numpy zonal statistics engine for the stream fac min/max table,
+# the SSBT / Type F link selection and the upstream reach selection
+use_numpy = False
+
 # This is the # of cells needed for stream initiation via Clarke et al 2008 - 
 # Modeling Streams and Hydrogeomorphic attributes in Oregon from digital and field data.
 # (0.360 square km) = 400 x 30 x 30m cells
@@ -43,6 +55,9 @@ out_strlink_raster = target_gdb + r"\s06_strlink"
 out_fac_stats = target_gdb + r"\s07_fac_min_max"
 
 out_strlink_fc = target_gdb + r"\s08_stream_fc"
+# DF, DS_MIX and TRIB by HydroID for use outside ArcGIS. Use a
+# .parquet extension for Parquet (needs pandas).
+out_dilution_table = os.path.join(os.path.dirname(target_gdb), "s08_dilution.csv")
 
 out_ssbt_focal = target_gdb + r"\s09_ssbt_focal_sum"
 out_ssbt_product = target_gdb + r"\s10_ssbt_product"
@@ -62,7 +77,6 @@ out_upstream_final_fc = target_gdb + r"\s21_upstream_final_fc"
 out_split_nodes_fc = target_gdb + r"\s22_upstream_split_nodes"
 out_attr_nodes_fc = target_gdb + r"\s23_upstream_attribute_nodes"
 
-out_upstream_split_fc = target_gdb + r"\s24_upstream_reaches"
 out_upstream_attr_fc = target_gdb + r"\s25_upstream_attr_reaches"
 
 arcpy.env.overwriteOutput = True
@@ -102,31 +116,44 @@ def from_meters_con(inFeature):
                  "units of feet or meters.")
     return con_from_m
 
-def stream_walk(dict, key, key_list, junctions, hid_walk, gid_ssbt_list):
-    """Walks downstream until the outlet is reached and returns the
-    total length in meters"""
-    
-    next_down = dict[key]["NextDownID"]
-    gid = dict[key]["GridID"]
-    if next_down in key_list:
-        length = dict[next_down]["length_m"]
-        outlet = False
-        junctions = junctions + 1
-        hid_walk.append(next_down)
-    else:
-        if gid not in gid_ssbt_list:
-            junctions = junctions + 1
-        next_down = -1
-        length = 0
-        outlet = True
-    return next_down, length, outlet, junctions, hid_walk
+def downstream_walk(usDict, hid_list, gid_ssbt_list):
+    """Returns dictionaries of the meters to the SSBT and the number of
+    junctions to the SSBT for every HydroID. The NextDownID graph is
+    walked once in reverse topological order so each feature adds its
+    downstream feature's totals instead of walking to the outlet.
+    A feature whose NextDownID is not in hid_list is an outlet with 0
+    meters and 0 junctions, or 1 if its GridID is not an SSBT GridID."""
+    
+    pos = dict((hid, i) for i, hid in enumerate(hid_list))
+    down = numpy.array([pos.get(usDict[hid]["NextDownID"], -1)
+                        for hid in hid_list], dtype=numpy.int64)
+    length = numpy.array([usDict[hid]["length_m"] for hid in hid_list],
+                         dtype=numpy.float64)
+    
+    gid_ssbt = set(gid_ssbt_list)
+    meters = numpy.zeros(len(hid_list))
+    junctions = numpy.array([0 if usDict[hid]["GridID"] in gid_ssbt else 1
+                             for hid in hid_list], dtype=numpy.int64)
+    
+    # downstream features first
+    order, offsets = d8.topological_order(down)
+    for w in range(offsets.size - 2, -1, -1):
+        seg = order[offsets[w]:offsets[w + 1]]
+        d = down[seg]
+        meters[seg] = meters[d] + length[d]
+        junctions[seg] = junctions[d] + 1
+    
+    return (dict(zip(hid_list, meters.tolist())),
+            dict(zip(hid_list, junctions.tolist())))
 
 def create_node_list(streamline_fc, streamline_fc_ds, checkDirection, z_raster, node_dx):
     """Reads an input stream centerline file and returns the NODE ID,
-    HYDRO ID, and X/Y coordinates as a list"""
+    HYDRO ID, and X/Y coordinates as a list, the attribute nodes and
+    the reaches between the nodes with their vertices"""
     nodeList = []
     attrList = []
-    incursorFields = ["SHAPE@","SHAPE@LENGTH", "HydroID", "GridID", "NextDownID", "DF", "DS_MIX", "TRIB"]
+    reachList = []
+    incursorFields = ["SHAPE@","SHAPE@LENGTH", "HydroID", "GridID", "NextDownID", "DF", "DS_MIX", "TRIB", "TYPE"]
     nodeID = 1
     # Determine input projection and spatial units
     proj = arcpy.Describe(streamline_fc).spatialReference
@@ -158,35 +185,35 @@ def create_node_list(streamline_fc, streamline_fc_ds, checkDirection, z_raster,
             gid_ssbt_list.append(row[0])
     
     # Check for duplicate hids
-    dups = list(set([i for i in hid_list if hid_list.count(i) > 1]))
+    dups = index.duplicates(hid_list)
     if dups:
         sys.exit("There are duplicate hydro IDs in your input stream"+
                  "feature class."+
                  "\nHere are the duplicates:  \n"+
                  "{0}".format(dups))        
     
+    # meters and junctions to the SSBT for every feature in one pass
+    ssbt_meters, ssbt_junctions = downstream_walk(usDict, hid_list,
+                                                  gid_ssbt_list)
+    
     # Now create the nodes. I'm pulling the fc data twice because on 
     # speed tests it is faster compared to saving all the incursorFields 
     # to a list and iterating over the list        
     print("Creating Nodes")
+    lines = []
+    node_rows = []
+    node_line = []
+    node_flip = []
+    node_pos = []
+    node_pos2 = []
+    node_mid = []
     with arcpy.da.SearchCursor(streamline_fc, incursorFields,"",proj) as Inrows:
         for row in Inrows:    
             lineLength = row[1] # These units are in the units of projection
             this_hid = row[2]
             this_gid = row[3]
-            next_down = this_hid
-            meters_to_ssbt = 0
-            hid_walk = [this_hid]
-            junctions = 0
-            while True:
-                next_down, length, outlet, junctions, hid_walk = stream_walk(
-                    usDict, next_down, hid_list, junctions, hid_walk, gid_ssbt_list)
-                meters_to_ssbt = meters_to_ssbt + length
-                if outlet is True:
-                    for h in range(0, len(hid_walk)):
-                        usDict[hid_walk[h]]["Junctions"] = junctions-h
-                    break             
-            this_junction = usDict[this_hid]["Junctions"]
+            meters_to_ssbt = ssbt_meters[this_hid]
+            this_junction = ssbt_junctions[this_hid]
             
             # This is the remainder distance between the last split node 
             # and the top of the downstream reach.
@@ -222,53 +249,74 @@ def create_node_list(streamline_fc, streamline_fc_ds, checkDirection, z_raster,
             
             mid_distance = node_dx * con_from_m / lineLength
             
+            lines.append(polyline.vertices(row[0]))
             for i in range(0, len(positions)):
-            #for position in positions:
-                node = row[0].positionAlongLine(abs(flip - positions[i]),
-                                                True).centroid
-                node2 = row[0].positionAlongLine(abs(flip - positions2[i]),
-                                                True).centroid                
-                
-                node_meters_to_ssbt = float(meters_to_ssbt +
-                                            (positions[i] * lineLength * con_to_m))
-                # Get the coordinates at the up/down midway point along
-                # the line between nodes and calculate the stream azimuth
-                if positions[i] == 0.0:
-                    mid_up = row[0].positionAlongLine(
-                        abs(flip - (positions[i] + mid_distance)),True).centroid
-                    mid_down = node
-                elif 0.0 < positions[i] + mid_distance < 1:
-                    mid_up = row[0].positionAlongLine(
-                        abs(flip - (positions[i] + mid_distance)),True).centroid
-                    mid_down = row[0].positionAlongLine(
-                        abs(flip - (positions[i] - mid_distance)),True).centroid
-                else:
-                    mid_up = node
-                    mid_down = row[0].positionAlongLine(
-                        abs(flip - (positions[i] - mid_distance)),True).centroid
-            
-                stream_azimuth = degrees(atan2((mid_down.X - mid_up.X),
-                                               (mid_down.Y - mid_up.Y)))
-                if stream_azimuth < 0:
-                    stream_azimuth = stream_azimuth + 360
-                    
-                # list of "NODE_ID",HydroID,"GridID","NextDownID", "DF", 
-                # "DS_MIX", "TRIB","M_FROM_SSBT", "JUNC_TO_SSBT",STREAM_AZMTH,
-                # "POINT_X","POINT_Y","SHAPE@X","SHAPE@Y"
-                nodeList.append((nodeID, row[2], row[3], row[4], row[5],
-                                 row[6], row[7], node_meters_to_ssbt, 
-                                 stream_azimuth,
-                                 this_junction,
-                                 node.X, node.Y,
-                                 node.X, node.Y))
-                
-                attrList.append((node_meters_to_ssbt, 
-                                 this_junction, stream_azimuth,
-                                 node2.X, node2.Y,
-                                 node2.X, node2.Y))                
-                
-                nodeID = nodeID + 1
-    return(nodeList, attrList)
+                node_rows.append((row[2], row[3], row[4], row[5], row[6],
+                                  row[7], this_junction,
+                                  float(meters_to_ssbt +
+                                        (positions[i] * lineLength * con_to_m)),
+                                  row[8]))
+                node_line.append(len(lines) - 1)
+                node_flip.append(flip)
+                node_pos.append(positions[i])
+                node_pos2.append(positions2[i])
+                node_mid.append(mid_distance)
+    
+    # Get all the node coordinates, the midway points along the line
+    # between nodes and the stream azimuths at once
+    if not node_rows:
+        return(nodeList, attrList, reachList)
+    lines = polyline.Polylines(lines)
+    node_line = numpy.array(node_line, dtype=numpy.int64)
+    flip = numpy.array(node_flip, dtype=numpy.float64)
+    pos = numpy.array(node_pos, dtype=numpy.float64)
+    pos2 = numpy.array(node_pos2, dtype=numpy.float64)
+    mid = numpy.array(node_mid, dtype=numpy.float64)
+    
+    # the first node's downstream point and the last node's upstream
+    # point are the node itself
+    first = pos == 0.0
+    last = ~first & ~((0.0 < pos + mid) & (pos + mid < 1))
+    mid_up = numpy.where(last, pos, pos + mid)
+    mid_down = numpy.where(first, pos, pos - mid)
+    
+    node_x, node_y = lines.points(node_line, numpy.abs(flip - pos), True)
+    node2_x, node2_y = lines.points(node_line, numpy.abs(flip - pos2), True)
+    stream_azimuth = lines.azimuth(node_line, numpy.abs(flip - mid_up),
+                                   numpy.abs(flip - mid_down), True)
+    
+    # each reach runs from the node before (or the start of the line)
+    # to the node and takes the attributes of the attribute node in it
+    before = numpy.r_[0.0, pos[:-1]]
+    before[numpy.r_[True, node_line[1:] != node_line[:-1]]] = 0.0
+    reaches = lines.segments(node_line, numpy.abs(flip - before),
+                             numpy.abs(flip - pos), True)
+    
+    for i, node_row in enumerate(node_rows):
+        # list of "NODE_ID",HydroID,"GridID","NextDownID", "DF", 
+        # "DS_MIX", "TRIB","M_FROM_SSBT", "JUNC_TO_SSBT",STREAM_AZMTH,
+        # "POINT_X","POINT_Y","SHAPE@X","SHAPE@Y"
+        node_meters_to_ssbt = node_row[7]
+        this_junction = node_row[6]
+        nodeList.append((nodeID,) + node_row[:6] + (node_meters_to_ssbt, 
+                         float(stream_azimuth[i]),
+                         this_junction,
+                         node_x[i], node_y[i],
+                         node_x[i], node_y[i]))
+        
+        attrList.append((node_meters_to_ssbt, 
+                         this_junction, float(stream_azimuth[i]),
+                         node2_x[i], node2_y[i],
+                         node2_x[i], node2_y[i]))
+        
+        # HydroID, "GridID", "NextDownID", "DF", "DS_MIX", "TRIB",
+        # "M_FROM_SSBT", "JUNC_TO_SSBT", "STREAM_AZMTH", "TYPE", SHAPE@
+        reachList.append(node_row[:6] + (node_meters_to_ssbt,
+                         this_junction, float(stream_azimuth[i]),
+                         node_row[8], reaches[i]))
+        
+        nodeID = nodeID + 1
+    return(nodeList, attrList, reachList)
 
 def create_nodes_fc(nodeList, nodes_fc, streamline_fc, cursorfields, proj):
     """Create the output point feature class using
@@ -311,6 +359,137 @@ def create_nodes_fc(nodeList, nodes_fc, streamline_fc, cursorfields, proj):
             row[3] = row[1] # LATITUDE
             cursor.updateRow(row)
 
+def create_reaches_fc(reachList, reach_fc, nodes_fc, streamline_fc, cursorfields, proj):
+    """Create the output reach polylines from the reach list. The
+    LONGITUDE and LATITUDE of the attribute node in each reach are
+    copied from nodes_fc, which has one point per reach in the same
+    order."""
+    print("Exporting Reaches")
+    
+    arcpy.CreateFeatureclass_management(os.path.dirname(reach_fc),
+                                        os.path.basename(reach_fc),
+                                        "POLYLINE","","DISABLED","DISABLED",proj)
+    
+    for f in cursorfields:
+        f_list = arcpy.ListFields(streamline_fc,f)
+        if f_list:
+            arcpy.AddField_management(reach_fc, f, f_list[0].type,
+                                      f_list[0].precision, f_list[0].scale,
+                                      f_list[0].length, "",
+                                      "NULLABLE", "NON_REQUIRED")
+        else:
+            arcpy.AddField_management(reach_fc, f, "DOUBLE", "", "", "",
+                                      "", "NULLABLE", "NON_REQUIRED")
+    
+    for f in ["LONGITUDE", "LATITUDE"]:
+        arcpy.AddField_management(reach_fc, f, "DOUBLE", "", "", "",
+                                  "", "NULLABLE", "NON_REQUIRED")
+    
+    with arcpy.da.SearchCursor(nodes_fc, ["LONGITUDE","LATITUDE"],
+                               sql_clause=(None, "ORDER BY OBJECTID")) as Inrows:
+        lon_lat = [tuple(row) for row in Inrows]
+    
+    with arcpy.da.InsertCursor(reach_fc, cursorfields +
+                               ["LONGITUDE","LATITUDE","SHAPE@"]) as cursor:
+        for row, ll in zip(reachList, lon_lat):
+            shape = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in row[-1]]),
+                                   proj)
+            cursor.insertRow(row[:-1] + ll + (shape,))
+
+def flat_buffer(shape, xy, width, proj):
+    """Returns the flat ended buffer of a line with vertices xy as an
+    arcpy Polygon, like Buffer FULL FLAT: the round ended
+    Polyline.buffer with the caps past each end taken away. Returns
+    None for a line with no length."""
+    caps = polyline.end_caps(xy, width)
+    if not len(caps):
+        return None
+    caps = arcpy.Polygon(arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in cap])
+                                      for cap in caps]), proj)
+    return shape.buffer(width).difference(caps)
+
+def create_buffer_fcs(reach_fc, buffer_fcs, widths, proj):
+    """Create a flat ended buffer feature class of the reaches for
+    each width (in the units of the reaches) in one pass. The reach
+    attributes are copied to the buffers. The buffers are built in
+    in_memory and only copied to buffer_fcs once they are all done, so
+    a failed run leaves no partial buffer feature class behind."""
+    print("Buffering Reaches")
+    
+    fields = [f.name for f in arcpy.ListFields(reach_fc)
+              if f.type not in ["OID", "Geometry"] and
+              f.name not in ["Shape_Length", "Shape_Area"]]
+    
+    mem_fcs = ["in_memory\\" + os.path.basename(buffer_fc)
+               for buffer_fc in buffer_fcs]
+    for mem_fc in mem_fcs:
+        if arcpy.Exists(mem_fc):
+            arcpy.Delete_management(mem_fc)
+        arcpy.CreateFeatureclass_management("in_memory",
+                                            os.path.basename(mem_fc),
+                                            "POLYGON",reach_fc,"DISABLED",
+                                            "DISABLED",proj)
+    
+    try:
+        cursors = [arcpy.da.InsertCursor(mem_fc, fields + ["SHAPE@"])
+                   for mem_fc in mem_fcs]
+        try:
+            with arcpy.da.SearchCursor(reach_fc, fields + ["SHAPE@"]) as Inrows:
+                for row in Inrows:
+                    xy = polyline.vertices(row[-1])
+                    for cursor, width in zip(cursors, widths):
+                        shape = flat_buffer(row[-1], xy, width, proj)
+                        if shape is not None:
+                            cursor.insertRow(list(row[:-1]) + [shape])
+        finally:
+            # releases the locks on the in_memory feature classes
+            del cursors
+        
+        for mem_fc, buffer_fc in zip(mem_fcs, buffer_fcs):
+            arcpy.CopyFeatures_management(mem_fc, buffer_fc)
+    finally:
+        for mem_fc in mem_fcs:
+            arcpy.Delete_management(mem_fc)
+
+def dissolve_links(streamline_fc, out_fc, types, fields, proj, erase=None):
+    """Copies the stream links with a HydroID in the types dictionary
+    to a new feature class with a TYPE field from the dictionary. Links
+    with a HydroID in the erase dictionary have its geometry taken away
+    first, like Erase, and are left out if nothing is left. Links
+    with the same fields and TYPE are dissolved into one feature."""
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_fc),
+                                        os.path.basename(out_fc),
+                                        "POLYLINE","","DISABLED",
+                                        "DISABLED",proj)
+    for f in fields:
+        fld = arcpy.ListFields(streamline_fc, f)[0]
+        arcpy.AddField_management(out_fc, f, fld.type, fld.precision,
+                                  fld.scale, fld.length, "",
+                                  "NULLABLE", "NON_REQUIRED")
+    arcpy.AddField_management(out_fc, "TYPE", "TEXT", "", "", 25, "",
+                              "NULLABLE", "NON_REQUIRED")
+    
+    erase = erase or {}
+    hid = fields.index("HydroID")
+    shapes = OrderedDict()
+    with arcpy.da.SearchCursor(streamline_fc, fields + ["SHAPE@"]) as Inrows:
+        for row in Inrows:
+            if row[hid] in types:
+                shape = row[-1]
+                if row[hid] in erase:
+                    shape = shape.difference(erase[row[hid]])
+                    if not shape.length:
+                        continue
+                key = tuple(row[:-1]) + (types[row[hid]],)
+                if key in shapes:
+                    shapes[key] = shapes[key].union(shape)
+                else:
+                    shapes[key] = shape
+    
+    with arcpy.da.InsertCursor(out_fc, fields + ["TYPE", "SHAPE@"]) as cursor:
+        for key, shape in shapes.items():
+            cursor.insertRow(key + (shape,))
+
 # to correct SSBT polyline vertices
 # snap tool
 # feature vertices to points Dangle
@@ -371,7 +550,12 @@ print("6. stream sid done")
 
 # Output a table of the strahler and min and max FAC value for each stream. 
 # This is used to determine the incoming flow for each tributary
-if arcpy.Exists(out_fac_stats) is False:
+if arcpy.Exists(out_fac_stats) is False and use_numpy:
+    fac_stats = zonal.zonal_statistics(arcpy_io.raster_to_array(out_strlink_raster),
+                                       arcpy_io.raster_to_array(out_fac))
+    arcpy.da.NumPyArrayToTable(fac_stats.table(stats=["count", "min", "max"]),
+                               out_fac_stats)
+elif arcpy.Exists(out_fac_stats) is False:
     ZonalStatisticsAsTable(out_strlink_raster,"VALUE", out_fac,
                            out_fac_stats,"DATA","MIN_MAX")
 print("7. fac sid zonal stats done")
@@ -387,19 +571,17 @@ print("8a. stream polyline done")
 
 # ---- Dilution factors -------------------------------------------------
 
-# read stream fc into a dictionary using hydro id (hid) as key
-hidDict = nested_dict()
-with arcpy.da.SearchCursor(out_strlink_fc, ["HydroID","GridID", "NextDownID"]) as Inrows:
-    for row in Inrows:
-        hidDict[row[0]]["GridID"] = row[1] 
-        hidDict[row[0]]["NextDownID"] = row[2]
-
-# read tables into a dictionary using the stream GridID (gid) as key
-gidDict = nested_dict() 
-with arcpy.da.SearchCursor(out_fac_stats, ["Value","MIN", "MAX"]) as Inrows:
-    for row in Inrows:
-        gidDict[row[0]]["MIN"] = row[1] 
-        gidDict[row[0]]["MAX"] = row[2]
+# read the stream fc and fac min/max table into aligned arrays
+links = arcpy.da.TableToNumPyArray(out_strlink_fc,
+                                   ["HydroID","GridID", "NextDownID"])
+fac_stats = arcpy.da.TableToNumPyArray(out_fac_stats, ["Value","MIN", "MAX"])
+
+df, down_mix, trib = tables.dilution_factors(links["HydroID"],
+                                             links["GridID"],
+                                             links["NextDownID"],
+                                             fac_stats["Value"],
+                                             fac_stats["MIN"],
+                                             fac_stats["MAX"])
         
 # Get a list of existing fields
 existingFields = []
@@ -419,52 +601,59 @@ if not u"TRIB" in existingFields:
     arcpy.AddField_management(out_strlink_fc, "TRIB", "LONG", "9", "0", "",
                               "", "NULLABLE", "NON_REQUIRED")
 
-fields = ["GridID","HydroID","NextDownID", "DF", "DS_MIX", "TRIB"]
-
-# iterate through the stream fc and calculate dilution
+# write all three fields back in one pass
+fields = ["HydroID", "DF", "DS_MIX", "TRIB"]
+values = dict(zip(links["HydroID"].tolist(),
+                  zip(df.tolist(), down_mix.astype(numpy.int64).tolist(),
+                      trib.astype(numpy.int64).tolist())))
 with arcpy.da.UpdateCursor(out_strlink_fc, fields) as Inrows:
     for row in Inrows:
-        
-        trib_gid = hidDict[row[1]]["GridID"]
-        down_hid = row[2]
-        
-        if down_hid == -1:
-            # we are at the watershed outlet
-            df = -1
-            down_mix = -1
-            trib = gidDict[trib_gid]["MAX"]
-        else:
-            down_gid = hidDict[down_hid]["GridID"]
-            trib = gidDict[trib_gid]["MAX"]
-            down_mix = gidDict[down_gid]["MIN"]           
-            df = down_mix / trib
-            
-        row[3] = df
-        row[4] = down_mix
-        row[5] = trib
-        Inrows.updateRow(row)
+        Inrows.updateRow([row[0]] + list(values[row[0]]))
+
+tables.write_table(out_dilution_table,
+                   [links["HydroID"], links["GridID"],
+                    links["NextDownID"], df, down_mix, trib],
+                   ["HydroID", "GridID", "NextDownID", "DF", "DS_MIX", "TRIB"])
 
 print("8b. dilution factors calculated")
 
 # ---- SSBT streams ---------------------------------------------------------
 
-#focal 3x3 sum of ssbt raster
-if arcpy.Exists(out_ssbt_focal) is False:
-    out_focal = FocalStatistics(in_ssbt_raster, NbrRectangle(3, 3, "CELL"),"SUM","DATA")
-    out_focal.save(out_ssbt_focal)
-print("9. ssbt focal sum done")
-
-# product of 3x3 focal sum and s05_str
-if arcpy.Exists(out_ssbt_product) is False:
-    out_product = arcpy.Raster(out_ssbt_focal) * arcpy.Raster(out_str_raster)
-    out_product.save(out_ssbt_product)
-print("10. ssbt product done")
-
-# select only cells along strlink where con vlaue >=1
-if arcpy.Exists(out_ssbt_strlink) is False:
-    out_con = Con(out_ssbt_product, out_strlink_raster, where_clause="Value >= 1")
-    out_con.save(out_ssbt_strlink)
-print("11. ssbt con done")
+# SSBT and Type F link rasters in one pass. The 3x3 focal sum of each
+# class raster is only evaluated on the stream cells. The link
+# rasters keep only the selected cells, the same as the Con steps, and
+# are made into lines by DrainageLineProcessing below.
+if use_numpy and (arcpy.Exists(out_ssbt_strlink) is False or
+                  arcpy.Exists(out_typef_strlink) is False):
+    link_rasters = streams.class_links(
+        [arcpy_io.raster_to_array(in_ssbt_raster),
+         arcpy_io.raster_to_array(in_typef_raster)],
+        arcpy_io.raster_to_array(out_strlink_raster))
+    for arry, out in zip(link_rasters, [out_ssbt_strlink, out_typef_strlink]):
+        if arcpy.Exists(out) is False:
+            arry = numpy.where(numpy.isnan(arry), -1, arry).astype(numpy.int32)
+            arcpy_io.array_to_raster(arry, out, out_strlink_raster, -1)
+    del link_rasters
+    print("9-11, 14-16. ssbt and type f link rasters done")
+
+if not use_numpy:
+    #focal 3x3 sum of ssbt raster
+    if arcpy.Exists(out_ssbt_focal) is False:
+        out_focal = FocalStatistics(in_ssbt_raster, NbrRectangle(3, 3, "CELL"),"SUM","DATA")
+        out_focal.save(out_ssbt_focal)
+    print("9. ssbt focal sum done")
+
+    # product of 3x3 focal sum and s05_str
+    if arcpy.Exists(out_ssbt_product) is False:
+        out_product = arcpy.Raster(out_ssbt_focal) * arcpy.Raster(out_str_raster)
+        out_product.save(out_ssbt_product)
+    print("10. ssbt product done")
+
+    # select only cells along strlink where con vlaue >=1
+    if arcpy.Exists(out_ssbt_strlink) is False:
+        out_con = Con(out_ssbt_product, out_strlink_raster, where_clause="Value >= 1")
+        out_con.save(out_ssbt_strlink)
+    print("11. ssbt con done")
 
 # convert to feature class
 if arcpy.Exists(out_ssbt_fc) is False:
@@ -483,31 +672,33 @@ if arcpy.Exists(out_ssbt_fc) is False:
             cursor.updateRow(row)    
 print("12. ssbt polyline done")
 
-if arcpy.Exists(out_upstream_fc) is False:
-    arcpy.Erase_analysis(in_features=out_strlink_fc, erase_features=out_ssbt_fc, 
-                        out_feature_class=out_upstream_fc, 
-                        cluster_tolerance=None)
-print("13. upstream polyline done")
+if not use_numpy:
+    if arcpy.Exists(out_upstream_fc) is False:
+        arcpy.Erase_analysis(in_features=out_strlink_fc, erase_features=out_ssbt_fc, 
+                            out_feature_class=out_upstream_fc, 
+                            cluster_tolerance=None)
+    print("13. upstream polyline done")
 
 # ----- Type N ---------------------------------------------------------
 
-#focal 3x3 sum of ssbt raster
-if arcpy.Exists(out_typef_focal) is False:
-    out_focal = FocalStatistics(in_typef_raster, NbrRectangle(3, 3, "CELL"),"SUM","DATA")
-    out_focal.save(out_typef_focal)
-print("14. type f focal sum done")
-
-# product of 3x3 focal sum and s05_str
-if arcpy.Exists(out_typef_product) is False:
-    out_product = arcpy.Raster(out_typef_focal) * arcpy.Raster(out_str_raster)
-    out_product.save(out_typef_product)
-print("15. type f product done")
-
-# select only cells along strlink where con vlaue >=1
-if arcpy.Exists(out_typef_strlink) is False:
-    out_con = Con(out_typef_product, out_strlink_raster, where_clause="Value >= 1")
-    out_con.save(out_typef_strlink)
-print("16. type f con done")
+if not use_numpy:
+    #focal 3x3 sum of ssbt raster
+    if arcpy.Exists(out_typef_focal) is False:
+        out_focal = FocalStatistics(in_typef_raster, NbrRectangle(3, 3, "CELL"),"SUM","DATA")
+        out_focal.save(out_typef_focal)
+    print("14. type f focal sum done")
+
+    # product of 3x3 focal sum and s05_str
+    if arcpy.Exists(out_typef_product) is False:
+        out_product = arcpy.Raster(out_typef_focal) * arcpy.Raster(out_str_raster)
+        out_product.save(out_typef_product)
+    print("15. type f product done")
+
+    # select only cells along strlink where con vlaue >=1
+    if arcpy.Exists(out_typef_strlink) is False:
+        out_con = Con(out_typef_product, out_strlink_raster, where_clause="Value >= 1")
+        out_con.save(out_typef_strlink)
+    print("16. type f con done")
 
 # convert to feature class
 if arcpy.Exists(out_typef_fc) is False:
@@ -517,56 +708,94 @@ if arcpy.Exists(out_typef_fc) is False:
 print("17. type f polyline done")
     
 # ----- Type N ---------------------------------------------------------
-if arcpy.Exists(out_typen_upstream_fc) is False:
-    arcpy.Erase_analysis(in_features=out_strlink_fc, erase_features=out_typef_fc, 
-                        out_feature_class=out_typen_upstream_fc, 
-                        cluster_tolerance=None)
+
+# The reaches upstream of the SSBT reaches from the HydroID/NextDownID
+# graph. Type N and non SSBT Type F are id sets of those reaches so
+# the erase, merge and dissolve feature classes (s13, s18-s20) are not
+# made.
+if use_numpy and arcpy.Exists(out_upstream_final_fc) is False:
+    net = network.Network(links["HydroID"], links["NextDownID"])
+    # the SSBT lines can cover only part of a link
+    ssbt_shapes = {}
+    with arcpy.da.SearchCursor(out_ssbt_fc, ["GridID", "SHAPE@"]) as Inrows:
+        for gid, shape in Inrows:
+            if gid in ssbt_shapes:
+                shape = ssbt_shapes[gid].union(shape)
+            ssbt_shapes[gid] = shape
+    is_ssbt = numpy.isin(links["GridID"], list(ssbt_shapes))
+    upstream = net.upstream(is_ssbt) & ~is_ssbt
     
-    arcpy.AddField_management(out_typen_upstream_fc, "TYPE", "TEXT", "",
-                              "", 25, "",
-                              "NULLABLE", "NON_REQUIRED")
-    with arcpy.da.UpdateCursor(out_typen_upstream_fc,["TYPE"],"", proj) as cursor:
-        for row in cursor:
-            row[0] = "Type N"
-            cursor.updateRow(row)    
+    # The upstream Type F and non Type F reaches are both labelled
+    # Type N, the same as the erase steps, so all of upstream is Type N.
+    # The part of each SSBT link outside the SSBT lines is Type N too,
+    # the same as erasing the SSBT lines from the links.
+    types = {}
+    types.update((hid, "Type N") for hid in links["HydroID"][upstream | is_ssbt].tolist())
+    erase = dict((hid, ssbt_shapes[gid]) for hid, gid in
+                 zip(links["HydroID"][is_ssbt].tolist(),
+                     links["GridID"][is_ssbt].tolist()))
     
-print("18. type n polyline done")
-
-# ----- Non SSBT Type F ------------------------------------------------
-
-if arcpy.Exists(out_typef_non_ssbt) is False:
-    arcpy.Erase_analysis(in_features=out_upstream_fc, erase_features=out_typen_upstream_fc, 
-                        out_feature_class=out_typef_non_ssbt, 
-                        cluster_tolerance=None)
-    arcpy.AddField_management(out_typef_non_ssbt, "TYPE", "TEXT", "",
-                              "", 25, "",
-                              "NULLABLE", "NON_REQUIRED")
-    with arcpy.da.UpdateCursor(out_typef_non_ssbt,["TYPE"],"", proj) as cursor:
-        for row in cursor:
-            row[0] = "Type N"
-            cursor.updateRow(row)    
-print("19. non ssbt type f polyline done")
-
-# ----- Final upstream Merge ---------------------------------------------
-
-if arcpy.Exists(out_upstream_merge) is False:
-    arcpy.Merge_management([out_typen_upstream_fc, out_typef_non_ssbt],
-                           out_upstream_merge)
-print("20 upstream merge done")  
+    proj = arcpy.Describe(out_strlink_fc).SpatialReference
+    dis_fields = ["HydroID", "GridID", "NextDownID", "DF", "DS_MIX", "TRIB"]
+    dissolve_links(out_strlink_fc, out_upstream_final_fc, types, dis_fields,
+                   proj, erase)
+    print("13, 18-21. upstream reaches done")
+
+if not use_numpy:
+    if arcpy.Exists(out_typen_upstream_fc) is False:
+        arcpy.Erase_analysis(in_features=out_strlink_fc, erase_features=out_typef_fc, 
+                            out_feature_class=out_typen_upstream_fc, 
+                            cluster_tolerance=None)
+    
+        arcpy.AddField_management(out_typen_upstream_fc, "TYPE", "TEXT", "",
+                                  "", 25, "",
+                                  "NULLABLE", "NON_REQUIRED")
+        with arcpy.da.UpdateCursor(out_typen_upstream_fc,["TYPE"],"", proj) as cursor:
+            for row in cursor:
+                row[0] = "Type N"
+                cursor.updateRow(row)    
     
-if arcpy.Exists(out_upstream_final_fc) is False:   
-    dis_fields = ["HydroID", "GridID", "NextDownID", "DF", "DS_MIX", "TRIB", "TYPE"]
-    arcpy.Dissolve_management(in_features=out_upstream_merge,
-                              out_feature_class=out_upstream_final_fc, 
-                             dissolve_field=dis_fields, 
-                             statistics_fields=None, 
-                             multi_part="MULTI_PART", 
-                             unsplit_lines="DISSOLVE_LINES")
-print("21 final upstream dissolve done")
+    print("18. type n polyline done")
+
+    # ----- Non SSBT Type F ------------------------------------------------
+
+    if arcpy.Exists(out_typef_non_ssbt) is False:
+        arcpy.Erase_analysis(in_features=out_upstream_fc, erase_features=out_typen_upstream_fc, 
+                            out_feature_class=out_typef_non_ssbt, 
+                            cluster_tolerance=None)
+        arcpy.AddField_management(out_typef_non_ssbt, "TYPE", "TEXT", "",
+                                  "", 25, "",
+                                  "NULLABLE", "NON_REQUIRED")
+        with arcpy.da.UpdateCursor(out_typef_non_ssbt,["TYPE"],"", proj) as cursor:
+            for row in cursor:
+                row[0] = "Type N"
+                cursor.updateRow(row)    
+    print("19. non ssbt type f polyline done")
+
+    # ----- Final upstream Merge ---------------------------------------------
+
+    if arcpy.Exists(out_upstream_merge) is False:
+        arcpy.Merge_management([out_typen_upstream_fc, out_typef_non_ssbt],
+                               out_upstream_merge)
+    print("20 upstream merge done")  
+    
+    if arcpy.Exists(out_upstream_final_fc) is False:   
+        dis_fields = ["HydroID", "GridID", "NextDownID", "DF", "DS_MIX", "TRIB", "TYPE"]
+        arcpy.Dissolve_management(in_features=out_upstream_merge,
+                                  out_feature_class=out_upstream_final_fc, 
+                                 dissolve_field=dis_fields, 
+                                 statistics_fields=None, 
+                                 multi_part="MULTI_PART", 
+                                 unsplit_lines="DISSOLVE_LINES")
+    print("21 final upstream dissolve done")
 
 # ---- Generate Nodes for splitting -------------------------------------
-    
-if arcpy.Exists(out_split_nodes_fc) is False:
+
+buffer_out_list = [target_gdb + r"\s26_buffer_{0}".format(buffer)
+                   for buffer in buffer_widths]
+
+if (arcpy.Exists(out_split_nodes_fc) is False or
+    arcpy.Exists(out_upstream_attr_fc) is False):
     # Get the spatial projecton of the input stream lines
     proj = arcpy.Describe(out_upstream_final_fc).SpatialReference    
     
@@ -582,49 +811,47 @@ if arcpy.Exists(out_split_nodes_fc) is False:
             sys.exit("Input stream line and elevation raster do not have "
                      "the same projection. Please reproject your data.")
     
-    # Create the stream nodes and return them as a list
-    nodeList, attrList = create_node_list(out_upstream_final_fc, out_ssbt_fc, checkDirection, in_dem, node_dx)
+    # Create the stream nodes and the reaches between them
+    nodeList, attrList, reachList = create_node_list(out_upstream_final_fc, out_ssbt_fc, checkDirection, in_dem, node_dx)
     
-    # sort the list by hydro ID and then meters to ssbt
-    nodeList = sorted(nodeList, key=itemgetter(1,7), reverse=True)
+    if arcpy.Exists(out_split_nodes_fc) is False:
+        # sort the list by hydro ID and then meters to ssbt
+        nodeList = sorted(nodeList, key=itemgetter(1,7), reverse=True)
         
-    # Create the output node feature class with the nodes list
-    splitfields = ["NODE_ID", "HydroID","GridID","NextDownID",
-                    "DF", "DS_MIX", "TRIB",
-                    "M_FROM_SSBT", "JUNC_TO_SSBT", "STREAM_AZMTH",
-                    "LONGITUDE","LATITUDE"]     
-    create_nodes_fc(nodeList, out_split_nodes_fc, out_upstream_final_fc, splitfields, proj)
-    
-    attrfields = ["M_FROM_SSBT", "JUNC_TO_SSBT", "STREAM_AZMTH",
-                   "LONGITUDE","LATITUDE"]     
-    create_nodes_fc(attrList, out_attr_nodes_fc, out_upstream_final_fc, attrfields, proj)
-print("23. nodes done")
-
-
-if arcpy.Exists(out_upstream_split_fc) is False:
-    arcpy.SplitLineAtPoint_management(out_upstream_final_fc, out_split_nodes_fc, out_upstream_split_fc, "1 Foot")
-print("24. split done")
-
-if arcpy.Exists(out_upstream_attr_fc) is False:
-    arcpy.SpatialJoin_analysis(target_features=out_upstream_split_fc, join_features=out_attr_nodes_fc, 
-                              out_feature_class=out_upstream_attr_fc, 
-                              join_operation="JOIN_ONE_TO_ONE", 
-                              join_type="KEEP_ALL", 
-                              match_option="INTERSECT", 
-                              search_radius="0.1 Feet")
-print("25. spatial join done")
-
-buffer_out_list = []
-for buffer in buffer_widths:
-    buffer_out_list.append(target_gdb+r"\s26_buffer_{0}".format(buffer))
-    out_buffer_fc = target_gdb + r"\s26_buffer_{0}".format(buffer)
-    
-    if arcpy.Exists(out_buffer_fc) is False:
-        arcpy.Buffer_analysis(in_features=out_upstream_attr_fc, out_feature_class=out_buffer_fc, 
-                             buffer_distance_or_field=str(buffer)+" Feet", 
-                             line_side="FULL", 
-                             line_end_type="FLAT")
-    print("26. buffer {0} done".format(buffer))
+        # Create the output node feature class with the nodes list
+        splitfields = ["NODE_ID", "HydroID","GridID","NextDownID",
+                        "DF", "DS_MIX", "TRIB",
+                        "M_FROM_SSBT", "JUNC_TO_SSBT", "STREAM_AZMTH",
+                        "LONGITUDE","LATITUDE"]     
+        create_nodes_fc(nodeList, out_split_nodes_fc, out_upstream_final_fc, splitfields, proj)
+    
+    if arcpy.Exists(out_attr_nodes_fc) is False:
+        attrfields = ["M_FROM_SSBT", "JUNC_TO_SSBT", "STREAM_AZMTH",
+                       "LONGITUDE","LATITUDE"]     
+        create_nodes_fc(attrList, out_attr_nodes_fc, out_upstream_final_fc, attrfields, proj)
+    print("23. nodes done")
+    
+    # The lines are cut at the node positions so there is no
+    # SplitLineAtPoint or SpatialJoin to get the attribute node
+    if arcpy.Exists(out_upstream_attr_fc) is False:
+        reachfields = ["HydroID","GridID","NextDownID",
+                       "DF", "DS_MIX", "TRIB",
+                       "M_FROM_SSBT", "JUNC_TO_SSBT", "STREAM_AZMTH",
+                       "TYPE"]
+        create_reaches_fc(reachList, out_upstream_attr_fc, out_attr_nodes_fc,
+                          out_upstream_final_fc, reachfields, proj)
+print("24. split reaches done")
+
+# all the buffer widths from one pass over the reaches
+todo = [(w, fc) for w, fc in zip(buffer_widths, buffer_out_list)
+        if arcpy.Exists(fc) is False]
+if todo:
+    proj = arcpy.Describe(out_upstream_attr_fc).SpatialReference
+    # buffer widths are in feet
+    feet_to_fc = 0.3048 * from_meters_con(out_upstream_attr_fc)
+    create_buffer_fcs(out_upstream_attr_fc, [fc for w, fc in todo],
+                      [w * feet_to_fc for w, fc in todo], proj)
+print("26. buffers {0} done".format(buffer_widths))
     
 print("done")
 
@@ -15,6 +15,11 @@ from __future__ import print_function
 import arcpy, os, time
 import arcpy
 from arcpy import env
+from hydrotools import arcpy_io
+from hydrotools import d8
+from hydrotools import flowgraph
+from hydrotools import flowlength
+from hydrotools import pipeline
 
 # Check out the ArcGIS Spatial Analyst extension license
 arcpy.CheckOutExtension("Spatial")
@@ -33,6 +38,18 @@ OUT_FLds = env.workspace + "\\FLds"
 OUT_FLds_minimum = env.workspace + "\\FLds_min_by" + CATCHMENT_zone_field
 OUT_FLus = env.workspace + "\\FLus_by"  + CATCHMENT_zone_field
 
+# saves a hash of the inputs and settings used to make each output
+manifest = os.path.splitext(env.workspace)[0] + "_FlowDistanceCatchment.json"
+
+# Use the numpy flow length engine to get the flow length from the
+# bottom of each catchment in one pass, without the minimum raster.
+# CATCHMENT must have the same extent and cell size as FDR.
+use_numpy = False
+
+# folder with the flow graphs cached by SSN_dem_processing.py for the
+# flow direction rasters in FDR's geodatabase
+graph_dir = os.path.splitext(os.path.dirname(FDR))[0] + "_graphs"
+
 ###########################
 # Set env settings
 env.overwriteOutput = True
@@ -46,37 +63,67 @@ try:
     startTime= time.time()
     print("START FlowDistanceCatchment_py v1.0: %s" % (time.ctime(startTime)))
     
-    ###########################
-    # 1. Flow Length in the downstream direction
+    # each step only runs again if its output is missing or an input
+    # or setting it depends on changed
+    pipe = pipeline.Pipeline(manifest, exists=arcpy.Exists,
+                             fingerprint=arcpy_io.fingerprint,
+                             delete=arcpy.Delete_management)
+    
+    if use_numpy:
+        ###########################
+        # Flow length in the downstream direction and from the bottom
+        # of each catchment in one pass over the flow graph
+        
+        @pipe.step([OUT_FLds, OUT_FLus], [FDR, CATCHMENT],
+                   {"zone_field": CATCHMENT_zone_field, "use_numpy": use_numpy},
+                   name="Generate flow length downstream and from the bottom of each catchment")
+        def flow_lengths():
+            if CATCHMENT_zone_field.upper() == "VALUE":
+                zones = arcpy_io.raster_to_array(CATCHMENT)
+            else:
+                zones = arcpy_io.field_to_array(CATCHMENT, CATCHMENT_zone_field)
+            cellsize = arcpy.Describe(FDR).meanCellWidth
+            fdr = arcpy_io.raster_to_array(FDR, d8.FDR_NODATA)
+            graph = flowgraph.cached_graph(fdr, graph_dir)
+            del fdr
+            FLds_array = flowlength.flow_length(cellsize=cellsize, graph=graph)
+            arcpy_io.array_to_raster(FLds_array.astype("float32"), OUT_FLds, FDR)
+            del FLds_array
+            FLus_array = flowlength.flow_length(cellsize=cellsize, zones=zones,
+                                                graph=graph)
+            arcpy_io.array_to_raster(FLus_array.astype("float32"), OUT_FLus, FDR)
     
-    print("Starting process 1/3: Generate flow length in the downstream direction")
-    if arcpy.Exists(OUT_FLds) == False:
-        FLds = FlowLength(FDR, "DOWNSTREAM", "")
-        FLds.save(OUT_CURVE)
     else:
-        FLds = Raster(OUT_FLds)
-        print("Flow length raster exists")
+        ###########################
+        # 1. Flow Length in the downstream direction
     
-    ###########################
-    # 2. Find Minimum flow length for each catchment and output as a raster
+        @pipe.step([OUT_FLds], [FDR],
+                   name="Starting process 1/3: Generate flow length in the downstream direction")
+        def flow_length():
+            FLds = FlowLength(FDR, "DOWNSTREAM", "")
+            FLds.save(OUT_FLds)
     
-    print("Starting process 2/3: Find Minimum Flow Length for each Catchment")
-    if arcpy.Exists(OUT_FLds_minimum) == False:
-        FLds_minimum = ZonalStatistics(CATCHMENT, CATCHMENT_zone_field, FLds, "MINIMUM")
-        FLds_minimum.save(OUT_FLds_minimum)
-    else:
-        FLds_minimum = Raster(OUT_FLds_minimum)
-        print("Minimum flow length raster by catchment exists")
+        ###########################
+        # 2. Find Minimum flow length for each catchment and output as a raster
     
-    ###########################
-    # 3 Calculate Flow Length upstream from the bottom of each catchement using Minus
+        @pipe.step([OUT_FLds_minimum], [CATCHMENT, OUT_FLds],
+                   {"zone_field": CATCHMENT_zone_field},
+                   name="Starting process 2/3: Find Minimum Flow Length for each Catchment")
+        def catchment_minimum():
+            FLds_minimum = ZonalStatistics(CATCHMENT, CATCHMENT_zone_field,
+                                           Raster(OUT_FLds), "MINIMUM")
+            FLds_minimum.save(OUT_FLds_minimum)
     
-    print("Starting process 3/3: Calculating flow length from the bottom of each catchement")
-    if arcpy.Exists(OUT_FLus) == False:
-        FLus = Minus(FLds, FLds_minimum)
-        FLus.save(OUT_FLus)
-    else:
-        print("Final output raster exists")
+        ###########################
+        # 3 Calculate Flow Length upstream from the bottom of each catchement using Minus
+    
+        @pipe.step([OUT_FLus], [OUT_FLds, OUT_FLds_minimum],
+                   name="Starting process 3/3: Calculating flow length from the bottom of each catchement")
+        def flow_length_upstream():
+            FLus = Minus(Raster(OUT_FLds), Raster(OUT_FLds_minimum))
+            FLus.save(OUT_FLus)
+    
+    pipe.run()
     
     endTime = time.time()
     Elapsed_MIN = (endTime - startTime) / 60
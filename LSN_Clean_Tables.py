@@ -88,23 +88,31 @@ disturbtables = ["tbl_"+ r + "_DISTURB_" + d + "yr_" + y + "_sqm_by_RID" for r i
 disturb_fields = ["DIS" + r + "_" + d + "YR_" + y for r in reachtype for d in durlist for y in yearlist]
 del(reachtype, durlist, yearlist)
 
-# Iterate through each table, add a new field and give it the varibale name, then copy
-# it over. Finally join the table to the edge table.
-
-i = 0
-for tbl in disturbtables:
-    tbl_fieldnames = []
-    tbl_keep_fields = []
-    fields = arcpy.ListFields(tbl,"*","All")
-    arcpy.AddField_management(tbl, disturb_fields[i] , "LONG")
-    arcpy.CalculateField_management(tbl, disturb_fields[i], '!VALUE_1!', "PYTHON_9.3")
-    for field in fields:
-        if field.name.upper() == u"RID":
-            join_field = field.name
-        if field.name.upper() not in [u"RID", u"rid", u"OBJECTID", u"OBJECTID_1", u"VALUE_1", u"SUM_", u"SUM"]:
-            tbl_keep_fields.append(field.name)
-        tbl_fieldnames.append(field.name)
+# tbl_DISTURB_sqm_by_RID (disturbance.py with tabulate_rids) already has
+# every disturbance field by RID so it is joined once. Otherwise iterate
+# through each table, add a new field and give it the varibale name, then
+# copy it over. Finally join the table to the edge table.
+disturb_wide_table = "tbl_DISTURB_sqm_by_RID"
+
+if arcpy.Exists(disturb_wide_table):
+    print("Joining %s"  %disturb_wide_table )
+    arcpy.JoinField_management(edgetable, "rid", disturb_wide_table, "RID",
+                               disturb_fields)
+else:
+    i = 0
+    for tbl in disturbtables:
+        tbl_fieldnames = []
+        tbl_keep_fields = []
+        fields = arcpy.ListFields(tbl,"*","All")
+        arcpy.AddField_management(tbl, disturb_fields[i] , "LONG")
+        arcpy.CalculateField_management(tbl, disturb_fields[i], '!VALUE_1!', "PYTHON_9.3")
+        for field in fields:
+            if field.name.upper() == u"RID":
+                join_field = field.name
+            if field.name.upper() not in [u"RID", u"rid", u"OBJECTID", u"OBJECTID_1", u"VALUE_1", u"SUM_", u"SUM"]:
+                tbl_keep_fields.append(field.name)
+            tbl_fieldnames.append(field.name)
     
-    print("Joining %s"  %tbl )     
-    arcpy.JoinField_management(edgetable, "rid", tbl, join_field, tbl_keep_fields)
-    i = i + 1
\ No newline at end of file
+        print("Joining %s"  %tbl )     
+        arcpy.JoinField_management(edgetable, "rid", tbl, join_field, tbl_keep_fields)
+        i = i + 1
\ No newline at end of file
@@ -8,9 +8,13 @@
 
 from __future__ import print_function
 import arcpy
+import numpy
 from arcpy import env
 from arcpy.sa import *
 
+from hydrotools import arcpy_io
+from hydrotools import reclass
+
 # Check out the ArcGIS Spatial Analyst extension license
 arcpy.CheckOutExtension("Spatial")
 
@@ -27,34 +31,50 @@ rca = r"C:\WorkSpace\Biocriteria\WatershedCharaterization\SSN\Hydro\Hydro.gdb\RC
 out_rsa_table = env.workspace + r"\tbl_OWNRSA_by_RID_sqmeters"
 out_rca_table = env.workspace + r"\tbl_OWNRCA_by_RID_sqmeters"
 
+# Make westfor_rc with numpy (hydrotools.reclass) in one pass instead
+# of Con and Reclassify. westfor_con is not saved.
+use_numpy = False
+
+# Final Reclass
+# 1 = PNI FOREST
+# 2 = STATE FOREST
+# 3 = PI FOREST
+# 4 = MISC
+# 8 = FEDERAL FOREST
+# 9 = URBAN
+# 10= AG
+rc_table = [[2,2],[3,3],[4,4],[5,8],[6,"NoData"],
+            [7,8],[11,"NoData"],[12,1],[21,1],[22,9],[23,9],[24,9],
+            [31,1],[41,1],[42,1],[43,1],[52,1],[71,1],[81,10],
+            [82,10],[90,1],[95,1]]
+
 # ------------------------------------------------------------------------
 # Create the raster that replaces PNI (Value = 1) with the NLCD 2011 values 
-print("con")
-if arcpy.Exists(westfor_con) == False:
-    con1 = Con(Raster(westfor)==1, Raster(nlcd), Raster(westfor))
-    con1.save(westfor_con)
+# and reclass the values
+if use_numpy:
+    print("con and reclass")
+    if arcpy.Exists(westfor_rc) == False:
+        # NoData is read as -1, which is not in rc_table
+        westfor_arry = arcpy_io.RasterArray(westfor, -1)[:, :]
+        nlcd_arry = arcpy_io.RasterArray(nlcd, -1, template=westfor)[:, :]
+        con1 = numpy.where(westfor_arry == 1, nlcd_arry, westfor_arry)
+        rc1 = reclass.reclassify(con1, rc_table, "DATA")
+        rc1 = numpy.where(numpy.isnan(rc1), -1, rc1).astype(numpy.int32)
+        arcpy_io.array_to_raster(rc1, westfor_rc, westfor, -1)
+        print("done")
 else:
-    con1 = Raster(westfor_con)
-    
-# ------------------------------------------------------------------------
-# Reclass the values
-print("reclass")
-if arcpy.Exists(westfor_rc) == False:
-    # Final Reclass
-    # 1 = PNI FOREST
-    # 2 = STATE FOREST
-    # 3 = PI FOREST
-    # 4 = MISC
-    # 8 = FEDERAL FOREST
-    # 9 = URBAN
-    # 10= AG
-    rc = RemapValue([[2,2],[3,3],[4,4],[5,8],[6,"NoData"],
-                     [7,8],[11,"NoData"],[12,1],[21,1],[22,9],[23,9],[24,9],
-                     [31,1],[41,1],[42,1],[43,1],[52,1],[71,1],[81,10],
-                     [82,10],[90,1],[95,1]])
-    rc1 = Reclassify(con1, "Value", rc)
-    rc1.save(westfor_rc)
-    print("done")
+    print("con")
+    if arcpy.Exists(westfor_con) == False:
+        con1 = Con(Raster(westfor)==1, Raster(nlcd), Raster(westfor))
+        con1.save(westfor_con)
+    else:
+        con1 = Raster(westfor_con)
+
+    print("reclass")
+    if arcpy.Exists(westfor_rc) == False:
+        rc1 = Reclassify(con1, "Value", RemapValue(rc_table))
+        rc1.save(westfor_rc)
+        print("done")
     
 # ------------------------------------------------------------------------
 # Tabulate by area
@@ -11,9 +11,13 @@ renamed based on a field in the text file.
 from __future__ import print_function
 import arcpy
 import os
+import sys
 import csv
 from osgeo import ogr, gdal
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hydrotools import index
+
 # -- Start Inputs ------------------------------------------------------
 
 # input comma seperated text file w/ inventory of rasters going into md
@@ -92,8 +96,9 @@ def geo_filter(raster_list, geo_field_name, geo_area, quad_col):
     # Pull the quads
     quads = [feature.GetField("OHIOCODE") for feature in fc]
     
-    # Get all the unique values
-    myquads = set(quads)
+    # Get all the unique values. Only the quads are lowercased, the
+    # raster names are matched with their case as is.
+    myquads = index.Keywords(quads, lower_text=False)
        
     keep_rasters = []
     for row in raster_list:
@@ -106,7 +111,7 @@ def geo_filter(raster_list, geo_field_name, geo_area, quad_col):
             quad_name[5].isalpha() and
             quad_name[6].isdigit()):
             
-            if any(quad.lower() in quad_name for quad in myquads):
+            if myquads.search(quad_name):
                 keep_rasters.append(row)
         else:
             # not an ohio code, keep anyway
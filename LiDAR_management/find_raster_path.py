@@ -14,6 +14,7 @@ projection, Ohio quad name, clean name, new name, raster format.
 """
 import arcpy
 import os
+import sys
 import csv
 import string
 from osgeo import ogr
@@ -21,6 +22,9 @@ from osgeo import gdal
 from collections import defaultdict
 from operator import itemgetter
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hydrotools import index
+
 # -- Start Inputs ------------------------------------------------------
 
 # output csv files
@@ -163,9 +167,7 @@ def write_csv(csvlist, csvheader, csvfile):
             writer.writerow(row)
 
 def get_index_of_duplicate_names(name_list):
-    dupdict = defaultdict(list)
-    for i, item in enumerate(name_list):
-        dupdict[item].append(i)
+    dupdict = index.positions(name_list)
     return ((indx) for key, indx in dupdict.items() if len(indx)>1)
 
 def clean_name(filename):
@@ -259,7 +261,7 @@ def geo_filter(raster_list, geo_field_name, geo_area, clean_col):
     quads = [feature.GetField("OHIOCODE") for feature in fc]
     
     # Get all the unique values
-    myquads = sorted(set(quads), reverse=False)
+    myquads = set(quad.lower() for quad in quads)
        
     keep_rasters = []
     for row in raster_list:
@@ -271,7 +273,7 @@ def geo_filter(raster_list, geo_field_name, geo_area, clean_col):
             row[clean_col][7].isalpha() is True and
             row[clean_col][8].isdigit() is True):
             
-            if any(quad.lower() == row[clean_col][2:] for quad in myquads):
+            if row[clean_col][2:] in myquads:
                 keep_rasters.append(row)
         else:
             # not an ohio code, keep anyway
@@ -283,6 +285,11 @@ rasters_be = []
 rasters_hh = []
 rasters_vh = []
 
+ignore_words = index.Keywords(ignore)
+be_words = index.Keywords(keep_be)
+hh_words = index.Keywords(keep_hh)
+vh_words = index.Keywords(keep_vh)
+
 
 pjctdict = read_csv_dict(csv_year, key_col=0, value_col=1, skipheader=True)
 yeardict = read_csv_dict(csv_year, key_col=0, value_col=2, skipheader=True)
@@ -313,17 +320,17 @@ for workspace in workspaces:
         remove_ = []
         print(dirpath)
         for d in dirnames:
-            if any(word.lower() in d.lower() for word in ignore):
+            if ignore_words.search(d):
                 remove_.append(d)
         
         for r in remove_:
             dirnames.remove(r)        
                     
-        if any(word.lower() in dirpath.lower() for word in keep_be):    
+        if be_words.search(dirpath):    
             for filename in filenames:
-                if all(word.lower() not in filename.lower() for word in ignore):
-                    year = [value for key, value in yeardict.items() if dirpath.startswith(key)]
-                    pjct = [value for key, value in pjctdict.items() if dirpath.startswith(key)]
+                if not ignore_words.search(filename):
+                    year = index.prefix_values(yeardict, dirpath)
+                    pjct = index.prefix_values(pjctdict, dirpath)
                     proj = arcpy.Describe(os.path.join(dirpath, filename)).spatialReference.name
                     form = arcpy.Describe(os.path.join(dirpath, filename)).format
                     
@@ -339,11 +346,11 @@ for workspace in workspaces:
                                        pjct[0], year[0], proj,
                                        quad_key, nameclean, None, form])
                 
-        if any(word.lower() in dirpath.lower() for word in keep_hh):   
+        if hh_words.search(dirpath):   
             for filename in filenames:
-                if all(word.lower() not in filename.lower() for word in ignore):
-                    year = [value for key, value in yeardict.items() if dirpath.startswith(key)]
-                    pjct = [value for key, value in pjctdict.items() if dirpath.startswith(key)]
+                if not ignore_words.search(filename):
+                    year = index.prefix_values(yeardict, dirpath)
+                    pjct = index.prefix_values(pjctdict, dirpath)
                     proj = arcpy.Describe(os.path.join(dirpath, filename)).spatialReference.name
                     
                     if not year:
@@ -357,11 +364,11 @@ for workspace in workspaces:
                                        pjct[0], year[0], proj,
                                        quad_key, nameclean, None, None])
         
-        if any(word.lower() in dirpath.lower() for word in keep_vh):   
+        if vh_words.search(dirpath):   
             for filename in filenames:
-                if all(word.lower() not in filename.lower() for word in ignore):
-                    year = [value for key, value in yeardict.items() if dirpath.startswith(key)]
-                    pjct = [value for key, value in pjctdict.items() if dirpath.startswith(key)]
+                if not ignore_words.search(filename):
+                    year = index.prefix_values(yeardict, dirpath)
+                    pjct = index.prefix_values(pjctdict, dirpath)
                     proj = arcpy.Describe(os.path.join(dirpath, filename)).spatialReference.name
                     
                     if not year:
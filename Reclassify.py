@@ -1,65 +1,42 @@
 # http://geoexamples.blogspot.com/2013/06/gdal-performance-raster-classification.html
 from __future__ import print_function
 import numpy
-from numpy import zeros  
-from numpy import logical_and  
-from osgeo import gdal  
 
+from hydrotools import raster_io
+from hydrotools import reclass
 
 
 inpath_temp = r"\\DEQWQNAS01\Lidar08\LiDAR\VH\vh44122b1a.img"
 out_raster = r"\\DEQWQNAS01\Lidar08\LiDAR\YEAR\yr44122b1a.img"
 year = 2009
 
+# cells strictly between rc_lower and rc_upper get the year in batch mode
 rc_lower = -5000
 rc_upper = 5000
 
-data = gdal.Open(inpath_temp)  
-band = data.GetRasterBand(1)
-nodata = band.GetNoDataValue()
+# Blocks are reclassified on reclass_threads threads
+reclass_threads = 4
 
-block_sizes = band.GetBlockSize()  
-x_block_size = block_sizes[0]  
-y_block_size = block_sizes[1]  
 
-xsize = band.XSize  
-ysize = band.YSize  
+def reclass_year(inpath, out_raster, year, lower, upper, out_format="HFA"):
+    """Writes a UInt32 raster that is year where inpath is strictly
+    between lower and upper and 0 (NoData) everywhere else, including
+    the NoData cells of inpath"""
+    src = raster_io.BandArray(inpath)
+    out = raster_io.create_like(inpath, out_raster, numpy.uint32, nodata=0,
+                                out_format=out_format)
+    # the range table is inclusive so step in from both bounds
+    table = [(numpy.nextafter(lower, numpy.inf),
+              numpy.nextafter(upper, -numpy.inf), year)]
+    reclass.reclassify_blocks(src, out, table, "NODATA", nodata=0,
+                              threads=reclass_threads,
+                              source_nodata=src.nodata)
+    out.close()
+    src.close()
 
-#max_value = band.GetMaximum()  
-#min_value = band.GetMinimum()  
-
-#if max_value == None or min_value == None:  
-#    stats = band.GetStatistics(0, 1)  
-#    max_value = stats[1]  
-#    min_value = stats[0]  
-
-format = "HFA"  
-driver = gdal.GetDriverByName( format )  
-data_reclass = driver.Create(out_raster, xsize, ysize, 1, gdal.GDT_UInt32)
-data_reclass.SetGeoTransform(data.GetGeoTransform())  
-data_reclass.SetProjection(data.GetProjection())
 
 print("reclassifying {0}".format(out_raster))
-for i in range(0, ysize, y_block_size):  
-    if i + y_block_size < ysize:  
-        rows = y_block_size  
-    else:  
-        rows = ysize - i  
-    for j in range(0, xsize, x_block_size):  
-        if j + x_block_size < xsize:  
-            cols = x_block_size  
-        else:  
-            cols = xsize - j  
-
-        data_array = band.ReadAsArray(j, i, cols, rows)
-        
-        r = zeros((rows, cols), numpy.uint16)
-        r = year * logical_and(data_array > -50000, data_array < 50000)
-
-        data_reclass.GetRasterBand(1).WriteArray(r,j,i)
-        data_reclass.GetRasterBand(1).SetNoDataValue(0)
-
-data_reclass = None
+reclass_year(inpath_temp, out_raster, year, -50000, 50000)
 
 print("done")
 
@@ -92,53 +69,9 @@ if buildreclass is True:
                 print("Error: " + inpath_temp + " does not exist")
                 status = "E"
                         
-            # start reclass code
-            data = gdal.Open(inpath_temp)  
-            band = data.GetRasterBand(1)
-            nodata = band.GetNoDataValue()
-            
-            block_sizes = band.GetBlockSize()  
-            x_block_size = block_sizes[0]  
-            y_block_size = block_sizes[1]  
-            
-            xsize = band.XSize  
-            ysize = band.YSize  
-            
-            #max_value = band.GetMaximum()  
-            #min_value = band.GetMinimum()  
-            
-            #if max_value == None or min_value == None:  
-            #    stats = band.GetStatistics(0, 1)  
-            #    max_value = stats[1]  
-            #    min_value = stats[0]  
-             
-            driver = gdal.GetDriverByName(out_format)  
-            data_reclass = driver.Create(out_raster, xsize, ysize, 1, gdal.GDT_UInt32)
-            data_reclass.SetGeoTransform(data.GetGeoTransform())  
-            data_reclass.SetProjection(data.GetProjection())
-            
             print("reclassifying {0}".format(out_raster))
-            for i in range(0, ysize, y_block_size):  
-                if i + y_block_size < ysize:  
-                    rows = y_block_size  
-                else:  
-                    rows = ysize - i  
-                for j in range(0, xsize, x_block_size):  
-                    if j + x_block_size < xsize:  
-                        cols = x_block_size  
-                    else:  
-                        cols = xsize - j  
-            
-                    data_array = band.ReadAsArray(j, i, cols, rows)
-                    
-                    r = zeros((rows, cols), numpy.uint16)
-                    r = year * logical_and(data_array > rc_lower, data_array < rc_upper)
-            
-                    data_reclass.GetRasterBand(1).WriteArray(r,j,i)
-                    data_reclass.GetRasterBand(1).SetNoDataValue(0)
-            
-            data_reclass = None            
-            # end reclass code
+            reclass_year(inpath_temp, out_raster, year, rc_lower, rc_upper,
+                         out_format)
                    
             if status is not "E":
                 status = execute_cmd(cmd_list)
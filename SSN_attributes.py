@@ -1,9 +1,12 @@
 """
-Produces RSA, ARSA, RCA, and ARCA output rasters for an input attribute.
+Produces RSA, ARSA, RCA, and ARCA output rasters for an input attribute,
+or for a list of attributes in batch mode.
 """
 
 # Import modules
 from __future__ import print_function
+import os
+import numpy
 import arcpy
 
 # Check out Spatial Analyst
@@ -11,6 +14,12 @@ arcpy.CheckOutExtension("spatial")
 from arcpy.sa import *
 from arcpy import env
 
+# numpy hydro engine
+from hydrotools import arcpy_io
+from hydrotools import attributes
+from hydrotools import d8
+from hydrotools import flowgraph
+
 # directory where the hydro outputs are stored
 hydro_dir = r"F:\SSN_Test\hydro.gdb"
 
@@ -21,6 +30,24 @@ attr_dir = r"F:\SSN_Test\attrbutes.gdb"
 #attr_name = "disturb_30m"
 attr_name = "shade"
 
+# Batch mode. Names of attribute rasters in attr_dir to process in one
+# run with the numpy engine. The hydro rasters are loaded once and all
+# six outputs are made for every attribute. The attribute rasters must
+# have the same extent and cell size as the hydro rasters.
+# Leave empty to process attr_name with ArcGIS.
+attr_names = []
+
+# number of attributes held in memory at once in batch mode
+batch_size = 10
+
+# number of outputs written at the same time in batch mode. The
+# outputs are saved with arcpy, which is not all thread safe, so 1 is
+# the default.
+write_threads = 1
+
+# folder with the flow graphs cached by SSN_dem_processing.py
+graph_dir = os.path.splitext(hydro_dir)[0] + "_graphs"
+
 # Output Spatial reference
 # Same as Hydro inptus and attribute raster
 # NAD_1983_HARN_Oregon_Statewide_Lambert_Feet_Intl
@@ -49,121 +76,169 @@ CATCHMENT = Raster(env.workspace + "\\catchment")
 RSA_ZONES = Raster(env.workspace + "\\rsa_euc_zone")
 STREAM_SEGS = Raster(env.workspace + "\\stream_seg")
 
-# Raster names output to the attribute directory
-env.workspace = attr_dir
-attr_path = env.workspace + "\\"+ attr_name
-ATTR = Raster(attr_path)
-
-OUT_ATTR_RSA = env.workspace + "\\" + attr_name + "_rsa"
-OUT_ATTR_RCA = env.workspace + "\\" + attr_name + "_rca"
-OUT_ATTR_REACH  = env.workspace + "\\" + attr_name + "_reach"
-OUT_ATTR_ARCA = env.workspace + "\\" + attr_name + "_arca"
-OUT_ATTR_ARSA = env.workspace + "\\" + attr_name + "_arsa"
-OUT_ATTR_AREACH  = env.workspace + "\\" + attr_name + "_areach"
-
-# Set env settings
-cell_size = arcpy.Describe(attr_path).meanCellWidth
-
-env.overwriteOutput = True
-env.cellSize = cell_size
-env.snapRaster = attr_path
-env.extent = attr_path
-env.mask = attr_path
-env.outputCoordinateSystem = sr
-
-def accumulate(attr_raster, fac_raster, fdr_raster, weight=1,
-               fill_outlets=False, catchment_raster=None,
-               outlet_raster=None):
-    """
-    Accumulates the attribute raster
-    """
-    attr_sum = Plus(FlowAccumulation(in_flow_direction_raster=fdr_raster,
-                                     in_weight_raster=Times(attr_raster, weight), 
-                                     data_type="FLOAT"),
-                    attr_raster)
-    attr_accum = Divide(attr_sum, fac_raster)
+
+def batch(attr_names):
+    """Makes the six outputs for every attribute in attr_names with the
+    numpy engine. The hydro rasters and flow graphs are loaded once and
+    the attributes are processed batch_size at a time."""
     
-    if fill_outlets:
-        zonal_raster = ZonalStatistics(in_zone_data=catchment_raster,
-                                       zone_field="Value",
-                                       in_value_raster=attr_raster,
-                                       statistics_type="MEAN",
-                                       ignore_nodata="DATA")
-        
-        return Con(in_conditional_raster=(outlet_raster==1),
-                         in_true_raster_or_constant=zonal_raster,
-                         in_false_raster_or_constant=attr_accum)
-    else:
-        return attr_accum
+    print("loading hydro rasters")
+    hydro = dict((key, arcpy_io.raster_to_array(hydro_dir + "\\" + name))
+                 for key, name in attributes.hydro_rasters.items())
+    
+    graphs = {}
+    for key, name in attributes.fdr_rasters.items():
+        fdr = arcpy_io.raster_to_array(hydro_dir + "\\" + name, d8.FDR_NODATA)
+        graphs[key] = flowgraph.cached_graph(fdr, graph_dir)
+    del fdr
+    
+    def out_path(name, product):
+        return attr_dir + "\\" + name + "_" + product
     
+    def write(arry, out_raster):
+        arcpy_io.array_to_raster(arry.astype(numpy.float32), out_raster,
+                                 attr_dir + "\\" + attr_names[0], sr=sr)
     
-# -- REACH -----------------------------------------
-if not arcpy.Exists(OUT_ATTR_REACH):
-    print("{0} REACH MEAN".format(attr_name))
-    """
-   Calculates the mean reach value from all points on that reach.
-   If no points are on a reach the return value is NULL. NULL reaches
-   will not be accumulated in the downstream direction
-    """    
-    ATTR_REACH = ZonalStatistics(in_zone_data=STREAM_SEGS,
-                                 zone_field="Value",
-                                 in_value_raster=ATTR,
-                                 statistics_type="MEAN",
-                                 ignore_nodata="DATA")     
+    todo = [name for name in attr_names
+            if not all(arcpy.Exists(out_path(name, p)) for p in attributes.products)]
     
-    ATTR_REACH.save(OUT_ATTR_REACH)
+    for i in range(0, len(todo), batch_size):
+        names = todo[i:i + batch_size]
+        print("{0}".format(", ".join(names)))
+        
+        attrs = numpy.array([arcpy_io.raster_to_array(attr_dir + "\\" + name)
+                             for name in names])
+        products = attributes.attribute_products(attrs, hydro, graphs)
+        del attrs
+        
+        jobs = [(products[p][n], out_path(name, p))
+                for n, name in enumerate(names)
+                for p in attributes.products
+                if not arcpy.Exists(out_path(name, p))]
+        attributes.write_products(jobs, write, write_threads)
+        del products, jobs
+
+if attr_names:
+    env.workspace = attr_dir
+    env.overwriteOutput = True
+    batch(attr_names)
+
 else:
-    ATTR_REACH = Raster(OUT_ATTR_REACH)
+    # Raster names output to the attribute directory
+    env.workspace = attr_dir
+    attr_path = env.workspace + "\\"+ attr_name
+    ATTR = Raster(attr_path)
+
+    OUT_ATTR_RSA = env.workspace + "\\" + attr_name + "_rsa"
+    OUT_ATTR_RCA = env.workspace + "\\" + attr_name + "_rca"
+    OUT_ATTR_REACH  = env.workspace + "\\" + attr_name + "_reach"
+    OUT_ATTR_ARCA = env.workspace + "\\" + attr_name + "_arca"
+    OUT_ATTR_ARSA = env.workspace + "\\" + attr_name + "_arsa"
+    OUT_ATTR_AREACH  = env.workspace + "\\" + attr_name + "_areach"
+
+    # Set env settings
+    cell_size = arcpy.Describe(attr_path).meanCellWidth
+
+    env.overwriteOutput = True
+    env.cellSize = cell_size
+    env.snapRaster = attr_path
+    env.extent = attr_path
+    env.mask = attr_path
+    env.outputCoordinateSystem = sr
+
+    def accumulate(attr_raster, fac_raster, fdr_raster, weight=1,
+                   fill_outlets=False, catchment_raster=None,
+                   outlet_raster=None):
+        """
+        Accumulates the attribute raster
+        """
+        attr_sum = Plus(FlowAccumulation(in_flow_direction_raster=fdr_raster,
+                                         in_weight_raster=Times(attr_raster, weight), 
+                                         data_type="FLOAT"),
+                        attr_raster)
+        attr_accum = Divide(attr_sum, fac_raster)
+    
+        if fill_outlets:
+            zonal_raster = ZonalStatistics(in_zone_data=catchment_raster,
+                                           zone_field="Value",
+                                           in_value_raster=attr_raster,
+                                           statistics_type="MEAN",
+                                           ignore_nodata="DATA")
+        
+            return Con(in_conditional_raster=(outlet_raster==1),
+                             in_true_raster_or_constant=zonal_raster,
+                             in_false_raster_or_constant=attr_accum)
+        else:
+            return attr_accum
+    
+    
+    # -- REACH -----------------------------------------
+    if not arcpy.Exists(OUT_ATTR_REACH):
+        print("{0} REACH MEAN".format(attr_name))
+        """
+       Calculates the mean reach value from all points on that reach.
+       If no points are on a reach the return value is NULL. NULL reaches
+       will not be accumulated in the downstream direction
+        """    
+        ATTR_REACH = ZonalStatistics(in_zone_data=STREAM_SEGS,
+                                     zone_field="Value",
+                                     in_value_raster=ATTR,
+                                     statistics_type="MEAN",
+                                     ignore_nodata="DATA")     
+    
+        ATTR_REACH.save(OUT_ATTR_REACH)
+    else:
+        ATTR_REACH = Raster(OUT_ATTR_REACH)
     
-# -- AREACH -----------------------------------------
-if not arcpy.Exists(OUT_ATTR_AREACH):
-    print("{0} AREACH".format(attr_name))
-    ATTR_AREACH = accumulate(attr_raster=ATTR_REACH,
-                             fac_raster=FAC_AREACH,
-                             fdr_raster=FDR,
-                             weight=REACH_WEIGHT)
+    # -- AREACH -----------------------------------------
+    if not arcpy.Exists(OUT_ATTR_AREACH):
+        print("{0} AREACH".format(attr_name))
+        ATTR_AREACH = accumulate(attr_raster=ATTR_REACH,
+                                 fac_raster=FAC_AREACH,
+                                 fdr_raster=FDR,
+                                 weight=REACH_WEIGHT)
     
-    ATTR_AREACH.save(OUT_ATTR_AREACH)
-
-# -- RCA -----------------------------------------
-if not arcpy.Exists(OUT_ATTR_RCA):
-    print("{0} RCA".format(attr_name))
-    ATTR_RCA = accumulate(attr_raster=ATTR,
-                           fac_raster=FAC_RCA,
-                           fdr_raster=FDR_OUTLET,
-                           weight=1, fill_outlets=True,
-                           catchment_raster=CATCHMENT,
-                           outlet_raster=OUTLETS)
+        ATTR_AREACH.save(OUT_ATTR_AREACH)
+
+    # -- RCA -----------------------------------------
+    if not arcpy.Exists(OUT_ATTR_RCA):
+        print("{0} RCA".format(attr_name))
+        ATTR_RCA = accumulate(attr_raster=ATTR,
+                               fac_raster=FAC_RCA,
+                               fdr_raster=FDR_OUTLET,
+                               weight=1, fill_outlets=True,
+                               catchment_raster=CATCHMENT,
+                               outlet_raster=OUTLETS)
     
-    ATTR_RCA.save(OUT_ATTR_RCA)
-
-# -- ARCA -----------------------------------------
-if not arcpy.Exists(OUT_ATTR_ARCA):
-    print("{0} ARCA".format(attr_name))
-    ATTR_ARCA = accumulate(attr_raster=ATTR,
-                           fac_raster=FAC_ARCA,
-                           fdr_raster=FDR,
-                           weight=1)
-    ATTR_ARCA.save(OUT_ATTR_ARCA)
-
-# -- RSA -----------------------------------------
-if not arcpy.Exists(OUT_ATTR_RSA):
-    print("{0} RSA".format(attr_name))
-    ATTR_RSA = accumulate(attr_raster=ATTR,
-                           fac_raster=FAC_RSA,
-                           fdr_raster=FDR_RSA_OUTLET,
-                           weight=RSA_WEIGHT, fill_outlets=True,
-                           catchment_raster=RSA_ZONES,
-                           outlet_raster=OUTLETS)
-    ATTR_RSA.save(OUT_ATTR_RSA)
-
-# -- ARSA -----------------------------------------
-if not arcpy.Exists(OUT_ATTR_ARSA):
-    print("{0} ARSA".format(attr_name))
-    ATTR_ARSA = accumulate(attr_raster=ATTR,
-                           fac_raster=FAC_ARSA,
-                           fdr_raster=FDR_RSA,
-                           weight=RSA_WEIGHT)
-    ATTR_ARSA.save(OUT_ATTR_ARSA)
+        ATTR_RCA.save(OUT_ATTR_RCA)
+
+    # -- ARCA -----------------------------------------
+    if not arcpy.Exists(OUT_ATTR_ARCA):
+        print("{0} ARCA".format(attr_name))
+        ATTR_ARCA = accumulate(attr_raster=ATTR,
+                               fac_raster=FAC_ARCA,
+                               fdr_raster=FDR,
+                               weight=1)
+        ATTR_ARCA.save(OUT_ATTR_ARCA)
+
+    # -- RSA -----------------------------------------
+    if not arcpy.Exists(OUT_ATTR_RSA):
+        print("{0} RSA".format(attr_name))
+        ATTR_RSA = accumulate(attr_raster=ATTR,
+                               fac_raster=FAC_RSA,
+                               fdr_raster=FDR_RSA_OUTLET,
+                               weight=RSA_WEIGHT, fill_outlets=True,
+                               catchment_raster=RSA_ZONES,
+                               outlet_raster=OUTLETS)
+        ATTR_RSA.save(OUT_ATTR_RSA)
+
+    # -- ARSA -----------------------------------------
+    if not arcpy.Exists(OUT_ATTR_ARSA):
+        print("{0} ARSA".format(attr_name))
+        ATTR_ARSA = accumulate(attr_raster=ATTR,
+                               fac_raster=FAC_ARSA,
+                               fdr_raster=FDR_RSA,
+                               weight=RSA_WEIGHT)
+        ATTR_ARSA.save(OUT_ATTR_ARSA)
 
 print("done")
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+Runs SSN_dem_processing.py for every basin listed in a csv file.
+Each basin runs in its own python process with its output written to
+a log file in log_dir. Basins are started as long as fewer than
+max_processes are running and the memory of the running basins stays
+under max_memory_mb.
+
+The csv file has a header row and the columns
+
+    STATUS, HYDRO_DIR, DEM_NAME, MEMORY_MB
+
+STATUS is updated as the basins run: "R" running, "X" done and "E"
+error. Basins marked "X" are skipped so the script can be stopped and
+run again. Basins marked "E" are run again if retry_errors is True.
+MEMORY_MB is the memory one basin is allowed to use. It is passed to
+SSN_dem_processing.py as tile_memory_mb. If it is blank
+default_memory_mb is used.
+"""
+
+from __future__ import print_function
+import csv
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+# input comma seperated text file w/ the basins to process
+basin_csv = r"F:\WorkSpace\Mid_Coast\Hydro\Mid_Coast_basins.csv"
+
+# folder for the basin log files
+log_dir = r"F:\WorkSpace\Mid_Coast\Hydro\logs"
+
+# the hydro script run for each basin
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "SSN_dem_processing.py")
+
+# python used to run the script, e.g. the ArcGIS python
+python_exe = sys.executable
+
+# number of basins that can run at the same time
+max_processes = multiprocessing.cpu_count()
+
+# memory in MB all the running basins can use together
+max_memory_mb = 32000
+default_memory_mb = 4096
+
+retry_errors = False
+
+# seconds between checks on the running basins
+poll_seconds = 10
+
+status_col = 0
+hydro_dir_col = 1
+dem_name_col = 2
+memory_col = 3
+
+header = ["STATUS", "HYDRO_DIR", "DEM_NAME", "MEMORY_MB"]
+
+
+def read_csv(csvfile, skipheader = False):
+    """Reads an input csv file and returns the data as a list"""
+    with open(csvfile, "r") as f:
+        reader = csv.reader(f)
+        if skipheader == True: next(reader)
+        csvlist = [row for row in reader if row]
+    return(csvlist)
+
+def write_csv(csvlist, csvfile):
+    """write the input list to csv. Writes a temp file first so the
+    status file is never left half written."""
+    tmp = csvfile + ".tmp"
+    if sys.version_info[0] < 3:
+        f = open(tmp, "wb")
+    else:
+        f = open(tmp, "w", newline="")
+    with f:
+        linewriter = csv.writer(f)
+        linewriter.writerow(header)
+        for row in csvlist:
+            linewriter.writerow(row)
+    if os.path.exists(csvfile):
+        os.remove(csvfile)
+    os.rename(tmp, csvfile)
+
+def basin_memory(row):
+    """Returns the memory in MB for a basin"""
+    if len(row) > memory_col and row[memory_col].strip():
+        return int(float(row[memory_col]))
+    return default_memory_mb
+
+def basin_name(row):
+    """Returns the name of the basin geodatabase without the extension"""
+    return os.path.splitext(os.path.basename(row[hydro_dir_col].rstrip("\\/")))[0]
+
+def start_basin(row):
+    """Starts SSN_dem_processing.py for one basin. Returns the process
+    and its open log file."""
+    log = open(os.path.join(log_dir, basin_name(row) + ".log"), "a")
+    log.write("START {0}\n".format(time.ctime()))
+    log.flush()
+
+    # one tile process per basin, the basins are already in parallel
+    cmd = [python_exe, script, row[hydro_dir_col], row[dem_name_col],
+           str(basin_memory(row)), "1"]
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                            cwd=os.path.dirname(script))
+    return proc, log
+
+
+# keeping track of time
+startTime= time.time()
+
+if not os.path.exists(log_dir):
+    os.makedirs(log_dir)
+
+basin_list = read_csv(basin_csv, skipheader = True)
+for row in basin_list:
+    while len(row) <= memory_col:
+        row.append("")
+
+# "R" is left in the file if the last run was stopped
+todo = [n for n, row in enumerate(basin_list)
+        if row[status_col] not in ["X", "E"] or
+        (row[status_col] == "E" and retry_errors)]
+print("{0} of {1} basins to process".format(len(todo), len(basin_list)))
+
+running = {}
+while todo or running:
+    used_mb = sum(basin_memory(basin_list[n]) for n in running)
+
+    # start basins in order while there is room. A basin that needs
+    # more than max_memory_mb runs when nothing else is running.
+    while todo and len(running) < max_processes:
+        row = basin_list[todo[0]]
+        if running and used_mb + basin_memory(row) > max_memory_mb:
+            break
+        n = todo.pop(0)
+        print("starting {0}".format(basin_name(row)))
+        running[n] = start_basin(row)
+        used_mb += basin_memory(row)
+        basin_list[n][status_col] = "R"
+        write_csv(basin_list, basin_csv)
+
+    time.sleep(poll_seconds)
+
+    for n in list(running):
+        proc, log = running[n]
+        exit_code = proc.poll()
+        if exit_code is None:
+            continue
+
+        log.write("END {0} exit code {1}\n".format(time.ctime(), exit_code))
+        log.close()
+        del running[n]
+
+        if exit_code:
+            basin_list[n][status_col] = "E"
+            print("Error: {0}, see the log file".format(basin_name(basin_list[n])))
+        else:
+            basin_list[n][status_col] = "X"
+            print("done {0}".format(basin_name(basin_list[n])))
+        write_csv(basin_list, basin_csv)
+
+errors = [basin_name(row) for row in basin_list if row[status_col] == "E"]
+if errors:
+    print("basins with errors: {0}".format(", ".join(errors)))
+
+print("Total process: {0:.1f} minutes".format((time.time() - startTime) / 60))
+print("done")
@@ -7,7 +7,10 @@ and SSN models.
 from __future__ import print_function
 import arcpy
 
+import os
+import sys
 import time
+import numpy
 
 # Check out Spatial Analyst
 arcpy.CheckOutExtension("spatial")
@@ -18,6 +21,17 @@ from arcpy import env
 # ArcHydroTools.pth into the base python site packages folder
 import ArcHydroTools
 
+# numpy hydro engine
+from hydrotools import arcpy_io
+from hydrotools import d8
+from hydrotools import euclidean
+from hydrotools import fill
+from hydrotools import flowgraph
+from hydrotools import flowlength
+from hydrotools import pipeline
+from hydrotools import streams
+from hydrotools import tiled
+
 # output directory for the hydro outputs
 hydro_dir = r"F:\SSN_Test\NHDplus_v21\hydro.gdb"
 #hydro_dir = r"F:\WorkSpace\Mid_Coast\Hydro\Salmon.gdb"
@@ -40,6 +54,57 @@ agg_factor = 5
 
 make_sinks = False
 
+# Use the numpy hydro engine in hydrotools instead of ArcHydroTools
+# and Spatial Analyst for fill, flow direction and flow accumulation
+use_numpy = False
+
+# numpy fill options. fill_epsilon > 0 keeps a small gradient
+# across filled areas. If make_sinks is True the fill depth is saved
+# as a raster.
+fill_epsilon = 0
+
+# Run the numpy fill, flow direction and flow accumulation tile by
+# tile for DEMs that don't fit in memory (e.g. the 3 ft LiDAR in
+# Mid_Coast.gdb) instead of splitting the DEM by sub-basin. tile_size
+# is the tile width in cells; if None it is picked so the tiles in
+# memory stay under tile_memory_mb. Tiles run on tile_processes
+# processes, None uses every core. Tiled flow direction needs
+# fill_epsilon > 0 so flat areas don't drain across tile edges,
+# otherwise it runs on the whole DEM.
+use_tiles = False
+tile_size = None
+tile_memory_mb = 4096
+tile_processes = None
+
+# SSN_dem_basins.py runs this script once per basin with
+# python SSN_dem_processing.py hydro_dir dem_input_name tile_memory_mb tile_processes
+if len(sys.argv) > 1:
+    hydro_dir = sys.argv[1]
+if len(sys.argv) > 2:
+    dem_input_name = sys.argv[2]
+if len(sys.argv) > 3:
+    tile_memory_mb = int(sys.argv[3])
+if len(sys.argv) > 4:
+    tile_processes = int(sys.argv[4])
+
+# folder where the numpy engine caches the flow graph built from each
+# flow direction raster so later steps and scripts can reuse it
+graph_dir = os.path.splitext(hydro_dir)[0] + "_graphs"
+
+# folder for the memory mapped arrays of the tiled steps. It is kept
+# per basin so basins run at the same time by SSN_dem_basins.py don't
+# write over each other's arrays in the shared scratch folder.
+scratch_dir = os.path.splitext(hydro_dir)[0] + "_scratch"
+
+# Every output is saved with a hash of the inputs and parameters used
+# to make it in this manifest. A step only runs again if its outputs
+# are missing or something it depends on changed, e.g. rsa_m. Steps
+# that don't depend on each other, like the euclidean and flow
+# distance RSA branches, run at the same time on pipeline_threads
+# threads. ArcGIS tools are not all thread safe so 1 is the default.
+manifest = os.path.splitext(hydro_dir)[0] + "_manifest.json"
+pipeline_threads = 1
+
 # delete files? preprocssing only
 delete_files = False
 
@@ -90,6 +155,7 @@ OUT_SINKS = env.workspace + "\\sinks"
 OUT_SINK_DRAINAGE = env.workspace + "\\sink_drainage"
 
 OUT_BE_FILL = env.workspace + "\\be_fill"
+OUT_FILL_DEPTH = env.workspace + "\\fill_depth"
 
 OUT_BE_BURN = env.workspace + "\\be_burn"
 OUT_BE_HYDRO_HS = env.workspace + "\\be_fill_hs"
@@ -175,7 +241,81 @@ if delete_files:
 
 # keeping track of time
 startTime= time.time()
-beginTime = startTime
+
+# Every step below is run by the pipeline, which saves a hash of each
+# step's inputs and parameters in the manifest. A step only runs again
+# if one of its outputs is missing or something it depends on changed.
+pipe = pipeline.Pipeline(manifest, exists=arcpy.Exists,
+                         fingerprint=arcpy_io.fingerprint,
+                         delete=arcpy.Delete_management,
+                         threads=pipeline_threads)
+
+def scratch_npy(raster):
+    """Returns a .npy path in the basin's scratch folder for a raster"""
+    if not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+    return os.path.join(scratch_dir, os.path.basename(str(raster)) + ".npy")
+
+def zones_to_raster(arry, out_raster, template):
+    """Saves a zone array with nan as NoData as an integer raster"""
+    zones = numpy.where(numpy.isnan(arry), -1, arry).astype(numpy.int32)
+    arcpy_io.array_to_raster(zones, out_raster, template, -1, sr)
+
+def accumulate_batch(fdr_raster, jobs):
+    """Runs the numpy flow accumulation for each (output, weight raster)
+    pair in jobs in one pass over the flow direction raster. A weight of
+    None counts cells. Cells where the weight is NoData don't pass flow,
+    the same as using Times(FDR, weight) as the flow direction. 1 is
+    added to match the ArcGIS FAC outputs."""
+    
+    print("flow accumulation on {0}: {1}".format(
+        os.path.basename(fdr_raster),
+        ", ".join([os.path.basename(out) for out, weight in jobs])))
+    
+    if use_tiles:
+        fdr_npy = arcpy_io.raster_to_npy(fdr_raster, scratch_npy(fdr_raster),
+                                         numpy.uint8, d8.FDR_NODATA)
+        for out, weight in jobs:
+            weight_npy = None
+            if weight is not None:
+                weight_npy = arcpy_io.raster_to_npy(weight, scratch_npy(weight))
+            fac = tiled.flow_accumulation_tiled(fdr_npy, scratch_npy(out),
+                                                weight_npy, masked=True,
+                                                tile_size=tile_size,
+                                                max_memory_mb=tile_memory_mb,
+                                                processes=tile_processes)
+            fac += 1
+            arcpy_io.npy_to_raster(fac, out, fdr_raster, sr=sr)
+            del fac
+        return
+    
+    weights = []
+    masks = []
+    for out, weight in jobs:
+        if weight is None:
+            weights.append(None)
+            masks.append(None)
+        else:
+            w = arcpy_io.raster_to_array(weight)
+            weights.append(w)
+            masks.append(~numpy.isnan(w))
+    
+    fdr = arcpy_io.raster_to_array(fdr_raster, d8.FDR_NODATA)
+    graph = flowgraph.cached_graph(fdr, graph_dir)
+    del fdr
+    fac = d8.flow_accumulation_stack(None, weights, masks, graph=graph) + 1.0
+    
+    for (out, weight), out_fac in zip(jobs, fac):
+        arcpy_io.array_to_raster(out_fac.astype(numpy.float32), out,
+                                 fdr_raster, sr=sr)
+
+def add_accumulate_batch(fdr_raster, jobs):
+    """Adds a pipeline step running accumulate_batch"""
+    inputs = [fdr_raster] + [weight for out, weight in jobs if weight is not None]
+    pipe.add("numpy flow accumulation on {0}".format(os.path.basename(fdr_raster)),
+             lambda: accumulate_batch(fdr_raster, jobs),
+             [out for out, weight in jobs], inputs,
+             {"use_tiles": use_tiles})
 
 def refineStreams():
     """Creates a feature class (and backup of existing ones) to
@@ -263,180 +403,252 @@ def refineStreams():
     print("Stream Definition using refined streams")
     arcpy.PolylineToRaster_conversion(in_features="stream_refine_1",
                                       value_field="isStream",
-                                      out_rasterdataset=OUT_STREAM1)    
-    
-
+                                      out_rasterdataset=OUT_STREAM1)
 
 #-- 1a. Aggregate -------------------------
 # this is only needed if downscaling from 3ft
-if agg and not arcpy.Exists(OUT_BE_AGG):
-    print("elevation aggregate")
-    BE_AGG = Aggregate(in_raster=OUT_BE, cell_factor=agg_factor,
-                       aggregation_type="MEAN")
-    BE_AGG.save(OUT_BE_AGG)
-    
-    BE = Raster(OUT_BE_AGG)
-    con_to_m = arcpy.Describe(BE).SpatialReference.metersPerUnit
-    con_from_m = 1 / con_to_m
-    cell_size = arcpy.Describe(BE).meanCellWidth
-    init_cells_sqkm = int(stream_init_sqkm / ((cell_size * con_to_m / 1000) ** 2))
-    
-    print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-    beginTime = time.time()    
-    
-    # Set env settings
-    env.overwriteOutput = True
-    env.cellSize = cell_size
-    env.snapRaster = OUT_BE_AGG
-    env.extent = OUT_BE_AGG
-    env.mask = OUT_BE_AGG
-    env.outputCoordinateSystem = sr
-    
-elif agg:
-    BE = Raster(OUT_BE_AGG)
-    
-    con_to_m = arcpy.Describe(BE).SpatialReference.metersPerUnit
-    con_from_m = 1 / con_to_m
-    cell_size = arcpy.Describe(BE).meanCellWidth
-    init_cells_sqkm = int(stream_init_sqkm / ((cell_size * con_to_m / 1000) ** 2))
-    
-    # Set env settings
-    env.overwriteOutput = True
-    env.cellSize = cell_size
-    env.snapRaster = OUT_BE_AGG
-    env.extent = OUT_BE_AGG
-    env.mask = OUT_BE_AGG
-    env.outputCoordinateSystem = sr
-    
+if agg:
+    @pipe.step([OUT_BE_AGG], [OUT_BE], {"agg_factor": agg_factor},
+               name="elevation aggregate")
+    def aggregate():
+        BE_AGG = Aggregate(in_raster=OUT_BE, cell_factor=agg_factor,
+                           aggregation_type="MEAN")
+        BE_AGG.save(OUT_BE_AGG)
+    
+    # the environment settings need the aggregated DEM
+    pipe.run()
+    dem = OUT_BE_AGG
 else:
-    BE = Raster(OUT_BE)
-
-    con_to_m = arcpy.Describe(BE).SpatialReference.metersPerUnit
-    con_from_m = 1 / con_to_m
-    cell_size = arcpy.Describe(BE).meanCellWidth
-    init_cells_sqkm = int(stream_init_sqkm / ((cell_size * con_to_m / 1000) ** 2))
-    
-    # Set env settings
-    env.overwriteOutput = True
-    env.cellSize = cell_size
-    env.snapRaster = OUT_BE
-    env.extent = OUT_BE
-    env.mask = OUT_BE
-    env.outputCoordinateSystem = sr
+    dem = OUT_BE
+
+BE = Raster(dem)
+
+con_to_m = arcpy.Describe(BE).SpatialReference.metersPerUnit
+con_from_m = 1 / con_to_m
+cell_size = arcpy.Describe(BE).meanCellWidth
+init_cells_sqkm = int(stream_init_sqkm / ((cell_size * con_to_m / 1000) ** 2))
+
+# Set env settings
+env.overwriteOutput = True
+env.cellSize = cell_size
+env.snapRaster = dem
+env.extent = dem
+env.mask = dem
+env.outputCoordinateSystem = sr
  
 #-- 1b. Sinks -------------------------
-if make_sinks and not arcpy.Exists(OUT_SINKS):
-    print("Sinks")
-    
-    ArcHydroTools.SinkEvaluation(Input_DEM_Raster=BE,
-                                 Output_Sink_Polygon_Feature_Class=OUT_SINKS,
-                                 Output_Sink_Drainage_Area_Feature_Class=OUT_SINK_DRAINAGE)
-    
-    print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-    beginTime = time.time()    
-    
-if refine_streams:
-    refineStreams()
+if make_sinks:
+    @pipe.step([OUT_SINKS, OUT_SINK_DRAINAGE], [dem], name="Sinks")
+    def sinks():
+        ArcHydroTools.SinkEvaluation(Input_DEM_Raster=dem,
+                                     Output_Sink_Polygon_Feature_Class=OUT_SINKS,
+                                     Output_Sink_Drainage_Area_Feature_Class=OUT_SINK_DRAINAGE)
             
 if burn: 
     #-- Burn existing stream features into the DEM
-    if not arcpy.Exists(OUT_BE_BURN):
-        print("burn stream features")
-        ArcHydroTools.DEMReconditioning(Input_Raw_DEM_Raster=BE, 
+    @pipe.step([OUT_BE_BURN], [dem, burn_stream_fc],
+               {"burn_buffer": burn_buffer, "burn_drop": burn_drop},
+               name="burn stream features")
+    def burn_streams():
+        ArcHydroTools.DEMReconditioning(Input_Raw_DEM_Raster=dem, 
                                        Input_Stream_Raster_or_Feature_Class=burn_stream_fc, 
                                        Number_of_Cells_for_Stream_Buffer=burn_buffer, 
                                        Smooth_Drop_in_Z_Units=burn_drop, 
                                        Sharp_Drop_in_Z_Units=burn_drop, 
                                        Output_AGREE_DEM_Raster=OUT_BE_BURN)
     
-    BE = Raster(OUT_BE_BURN)
-    
-    print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-    beginTime = time.time()
+    hydro_input = OUT_BE_BURN
+else:
+    hydro_input = dem
         
 #-- 2. Fill to make hydro dem-------------------------
-if not arcpy.Exists(OUT_BE_FILL):
-    print("fill")
+fill_outputs = [OUT_BE_FILL]
+if use_numpy and make_sinks:
+    fill_outputs.append(OUT_FILL_DEPTH)
+
+@pipe.step(fill_outputs, [hydro_input],
+           {"use_numpy": use_numpy, "use_tiles": use_tiles,
+            "fill_epsilon": fill_epsilon},
+           name="fill")
+def fill_dem():
+    BE = Raster(hydro_input)
+    
+    if use_numpy and use_tiles:
+        # fill into memory mapped arrays in the scratch folder
+        be_fill = tiled.create_array(scratch_npy(OUT_BE_FILL),
+                                     (BE.height, BE.width), numpy.float32)
+        fill_depth = None
+        if make_sinks:
+            fill_depth = tiled.create_array(scratch_npy(OUT_FILL_DEPTH),
+                                            (BE.height, BE.width),
+                                            numpy.float32)
+        
+        # the tiles are flooded on tile_processes processes from a
+        # copy of the DEM in the scratch folder
+        fill_stats = fill.fill_depressions_tiled(arcpy_io.raster_to_npy(BE, scratch_npy(BE)),
+                                                 be_fill, tile_size,
+                                                 epsilon=fill_epsilon,
+                                                 depth=fill_depth,
+                                                 max_memory_mb=tile_memory_mb,
+                                                 processes=tile_processes)
+        arcpy_io.npy_to_raster(be_fill, OUT_BE_FILL, BE, sr=sr)
+        if make_sinks:
+            arcpy_io.npy_to_raster(fill_depth, OUT_FILL_DEPTH, BE, sr=sr)
+        del be_fill, fill_depth
+    
+    elif use_numpy:
+        be = arcpy_io.raster_to_array(BE)
+        be_fill, fill_stats = fill.fill_depressions(be, epsilon=fill_epsilon)
+        arcpy_io.array_to_raster(be_fill.astype(numpy.float32), OUT_BE_FILL,
+                                 BE, sr=sr)
+        if make_sinks:
+            arcpy_io.array_to_raster((be_fill - be).astype(numpy.float32),
+                                     OUT_FILL_DEPTH, BE, sr=sr)
+        del be, be_fill
+        
+    else:
+        ArcHydroTools.FillSinks(Input_DEM_Raster=BE,
+                                       Output_Hydro_DEM_Raster=OUT_BE_FILL)
     
-    ArcHydroTools.FillSinks(Input_DEM_Raster=BE,
-                                   Output_Hydro_DEM_Raster=OUT_BE_FILL)
+    if use_numpy:
+        print("filled {0} depressions, {1} cells, max depth {2:.2f}".format(
+            fill_stats["depressions"], fill_stats["cells_filled"],
+            fill_stats["max_depth"]))
     
     # stats need to be recalculated if the DEM is large
     arcpy.CalculateStatistics_management(in_raster_dataset=OUT_BE_FILL,skip_existing="OVERWRITE")    
-    
-BE_HYDRO = Raster(OUT_BE_FILL)
 
 #if not arcpy.Exists(OUT_BE_HYDRO_HS):
 #    print("hydro hillshade")
 #    BE_HYDRO_HS = Hillshade(BE_HYDRO, 315, 45, "NO_SHADOWS", 1)
 #    BE_HYDRO_HS.save(OUT_BE_HYDRO_HS)
-    
-print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-beginTime = time.time()
 
 # ----------------------------------------------------------------------
 # Generate Base Hydro outputs
 # ----------------------------------------------------------------------
 
 #-- 3. Flow Direction -------------------------    
-if not arcpy.Exists(OUT_FDR):
-    print("flow direction")
-    
-    ArcHydroTools.FlowDirection(BE_HYDRO, OUT_FDR)
-    
-    print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-    beginTime = time.time()         
-    
-FDR = Raster(OUT_FDR)
+@pipe.step([OUT_FDR], [OUT_BE_FILL],
+           {"use_numpy": use_numpy,
+            "use_tiles": use_tiles and fill_epsilon > 0},
+           name="flow direction")
+def flow_direction():
+    BE_HYDRO = Raster(OUT_BE_FILL)
+    
+    if use_numpy and use_tiles and fill_epsilon > 0:
+        fdr = tiled.run_local(d8.flow_direction,
+                              [arcpy_io.raster_to_npy(BE_HYDRO, scratch_npy(BE_HYDRO))],
+                              scratch_npy(OUT_FDR), halo=1, args=(cell_size,),
+                              dtype=numpy.uint8, tile_size=tile_size,
+                              max_memory_mb=tile_memory_mb,
+                              processes=tile_processes)
+        arcpy_io.npy_to_raster(fdr, OUT_FDR, BE_HYDRO, d8.FDR_NODATA, sr)
+        del fdr
+    elif use_numpy:
+        fdr = d8.flow_direction(arcpy_io.raster_to_array(BE_HYDRO), cell_size)
+        arcpy_io.array_to_raster(fdr, OUT_FDR, BE_HYDRO, d8.FDR_NODATA, sr)
+        del fdr
+    else:
+        ArcHydroTools.FlowDirection(BE_HYDRO, OUT_FDR)
 
 # -- 4. Flow Accumulation  -------------------------
-if not arcpy.Exists(OUT_FAC):
-    print("flow accumulation")
-    ArcHydroTools.FlowAccumulation(FDR, OUT_FAC)
-    
-    print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-    beginTime = time.time()     
+@pipe.step([OUT_FAC], [OUT_FDR], {"use_numpy": use_numpy},
+           name="flow accumulation")
+def flow_accumulation():
+    FDR = Raster(OUT_FDR)
+    
+    if use_numpy and use_tiles:
+        fac = tiled.flow_accumulation_tiled(
+            arcpy_io.raster_to_npy(FDR, scratch_npy(FDR), numpy.uint8, d8.FDR_NODATA),
+            scratch_npy(OUT_FAC), tile_size=tile_size,
+            max_memory_mb=tile_memory_mb, processes=tile_processes)
+        arcpy_io.npy_to_raster(fac, OUT_FAC, FDR, sr=sr)
+        del fac
+    elif use_numpy:
+        fac = d8.flow_accumulation(arcpy_io.raster_to_array(FDR, d8.FDR_NODATA))
+        arcpy_io.array_to_raster(fac.astype("float32"), OUT_FAC, FDR, sr=sr)
+        del fac
+    else:
+        ArcHydroTools.FlowAccumulation(FDR, OUT_FAC)
+    
+    # stats need to be recalculated if the FAC is large
+    arcpy.CalculateStatistics_management(in_raster_dataset=OUT_FAC,skip_existing="OVERWRITE")
+
+if use_numpy:
+    # -- 5, 6, 7, 12, 13. Streams, links and outlets ------------------
+    # in one pass. The outlets are the most downstream cell of each
+    # link and hold the link id instead of the DrainID.
+    stream_outputs = [OUT_STREAM2, OUT_STREAM_SEG1,
+                      OUT_OUTLET_RASTER1, OUT_OUTLET_RASTER2]
+    if refine_streams:
+        # the refined streams replace the stream definition
+        stream_inputs = [OUT_FDR, OUT_STREAM1]
+    else:
+        stream_outputs.insert(0, OUT_STREAM1)
+        stream_inputs = [OUT_FDR, OUT_FAC]
+    
+    @pipe.step(stream_outputs, stream_inputs,
+               {"init_cells_sqkm": init_cells_sqkm,
+                "refine_streams": refine_streams},
+               name="Stream Definition, Segmentation and Outlets")
+    def stream_network():
+        fdr = arcpy_io.raster_to_array(OUT_FDR, d8.FDR_NODATA)
+        graph = flowgraph.cached_graph(fdr, graph_dir)
+        del fdr
+        if refine_streams:
+            net = streams.stream_network(None, streams=arcpy_io.raster_to_array(OUT_STREAM1),
+                                         graph=graph)
+        else:
+            net = streams.stream_network(None, arcpy_io.raster_to_array(OUT_FAC),
+                                         init_cells_sqkm, graph=graph)
         
-FAC = Raster(OUT_FAC)
-
-# stats need to be recalculated if the FAC is large
-arcpy.CalculateStatistics_management(in_raster_dataset=FAC,skip_existing="OVERWRITE")
-
-# -- 5. Stream Raster with NoData  -------------------------
-if not arcpy.Exists(OUT_STREAM1):
-    print("Stream Definition")
-    ArcHydroTools.StreamDefinition(Input_Flow_Accumulation_Raster=FAC,
-                                   Number_of_cells_to_define_stream=init_cells_sqkm,
-                                   Output_Stream_Raster=OUT_STREAM1,
-                                   Area_Sqkm_to_define_stream=stream_init_sqkm)
-STREAM1 = Raster(OUT_STREAM1)
-
-# -- 6. Stream Raster excluding NoData -------------------------
-if not arcpy.Exists(OUT_STREAM2):
-    print("Stream NoData")
-    STREAM2 = Con(in_conditional_raster=IsNull(STREAM1),
-                       in_true_raster_or_constant=0, in_false_raster_or_constant=1)
-    STREAM2.save(OUT_STREAM2)
+        stream = net["stream"]
+        if not refine_streams:
+            arcpy_io.array_to_raster(numpy.where(stream == 1, 1, numpy.nan).astype(numpy.float32),
+                                     OUT_STREAM1, OUT_FDR, sr=sr)
+        arcpy_io.array_to_raster(stream.astype(numpy.float32),
+                                 OUT_STREAM2, OUT_FDR, sr=sr)
+        
+        zones_to_raster(net["link"], OUT_STREAM_SEG1, OUT_FDR)
+        zones_to_raster(net["outlet"], OUT_OUTLET_RASTER1, OUT_FDR)
+        
+        outlets2 = numpy.where(net["outlet"] > 0, 1.0, 0.0)
+        outlets2[numpy.isnan(stream)] = numpy.nan
+        arcpy_io.array_to_raster(outlets2.astype(numpy.float32),
+                                 OUT_OUTLET_RASTER2, OUT_FDR, sr=sr)
 
 else:
-    STREAM2 = Raster(OUT_STREAM2)
-    
-# -- 7. Stream Segmentation -------------------------
-if not arcpy.Exists(OUT_STREAM_SEG1):
-    print("Stream Segmentation Raster")
-    ArcHydroTools.StreamSegmentation(Input_Stream_Raster=STREAM1, 
-                                    Input_Flow_Direction_Raster=FDR, 
-                                    Output_Stream_Link_Raster=OUT_STREAM_SEG1)
-    STREAM_SEGS = Raster(OUT_STREAM_SEG1)
-    
-else:
-    STREAM_SEGS = Raster(OUT_STREAM_SEG1)
+    # -- 5. Stream Raster with NoData  -------------------------
+    @pipe.step([OUT_STREAM1], [OUT_FAC],
+               {"stream_init_sqkm": stream_init_sqkm,
+                "init_cells_sqkm": init_cells_sqkm},
+               name="Stream Definition")
+    def stream_definition():
+        ArcHydroTools.StreamDefinition(Input_Flow_Accumulation_Raster=Raster(OUT_FAC),
+                                       Number_of_cells_to_define_stream=init_cells_sqkm,
+                                       Output_Stream_Raster=OUT_STREAM1,
+                                       Area_Sqkm_to_define_stream=stream_init_sqkm)
+
+    # -- 6. Stream Raster excluding NoData -------------------------
+    @pipe.step([OUT_STREAM2], [OUT_STREAM1], name="Stream NoData")
+    def stream_nodata():
+        STREAM2 = Con(in_conditional_raster=IsNull(Raster(OUT_STREAM1)),
+                           in_true_raster_or_constant=0, in_false_raster_or_constant=1)
+        STREAM2.save(OUT_STREAM2)
+    
+    # -- 7. Stream Segmentation -------------------------
+    @pipe.step([OUT_STREAM_SEG1], [OUT_STREAM1, OUT_FDR],
+               name="Stream Segmentation Raster")
+    def stream_segmentation():
+        ArcHydroTools.StreamSegmentation(Input_Stream_Raster=Raster(OUT_STREAM1), 
+                                        Input_Flow_Direction_Raster=Raster(OUT_FDR), 
+                                        Output_Stream_Link_Raster=OUT_STREAM_SEG1)
 
 # -- 8. Stream Poly -------------------------
-if not arcpy.Exists(OUT_STREAM_POLY):
-    print("Stream Poly")
-    ArcHydroTools.DrainageLineProcessing(Input_Stream_Link_Raster=STREAM_SEGS,
-                                         Input_Flow_Direction_Raster=FDR,
+@pipe.step([OUT_STREAM_POLY], [OUT_STREAM_SEG1, OUT_FDR], name="Stream Poly")
+def stream_poly():
+    ArcHydroTools.DrainageLineProcessing(Input_Stream_Link_Raster=Raster(OUT_STREAM_SEG1),
+                                         Input_Flow_Direction_Raster=Raster(OUT_FDR),
                                          Output_Drainage_Line_Feature_Class=OUT_STREAM_POLY)
     
     # Add Strahler stream order
@@ -447,149 +659,187 @@ if not arcpy.Exists(OUT_STREAM_POLY):
     ArcHydroTools.AssignRiverOrder(Input_Feature_Class_or_Table=OUT_STREAM_POLY, 
                                   Input_River_Order_Field="Strahler", 
                                   River_Order_Type="Strahler")
-
-    print("{0:.1f} minutes".format((time.time() - beginTime) / 60))
-    beginTime = time.time()
-    
-print("Total process: {0:.1f} minutes".format((time.time() - startTime) / 60))
  
-# -- 9. Catchment Raster -------------------------
-if not arcpy.Exists(OUT_CATCHMENT):
-    print("Catchment Raster")
-    ArcHydroTools.CatchmentGridDelineation(Input_Flow_Direction_Raster=FDR, 
-                                           Input_Link_Raster=STREAM_SEGS, 
-                                           Output_Catchment_Raster=OUT_CATCHMENT)
+if use_numpy:
+    # -- 9, 19. Catchment Raster and RCA fac raster -------------------
+    # from one sweep of the cached flow graph
+    @pipe.step([OUT_CATCHMENT, OUT_FAC_RCA],
+               [OUT_FDR, OUT_STREAM_SEG1, OUT_OUTLET_RASTER2],
+               name="Catchment Raster and RCA fac raster")
+    def catchment():
+        fdr = arcpy_io.raster_to_array(OUT_FDR, d8.FDR_NODATA)
+        graph = flowgraph.cached_graph(fdr, graph_dir)
+        del fdr
+        result = streams.catchments(arcpy_io.raster_to_array(OUT_STREAM_SEG1),
+                                    outlets=arcpy_io.raster_to_array(OUT_OUTLET_RASTER2),
+                                    graph=graph)
+        zones_to_raster(result["catchment"], OUT_CATCHMENT, OUT_FDR)
+        arcpy_io.array_to_raster(result["fac_rca"].astype(numpy.float32),
+                                 OUT_FAC_RCA, OUT_FDR, sr=sr)
+        print("{0} catchments".format(result["ids"].size))
+
+else:
+    # -- 9. Catchment Raster -------------------------
+    @pipe.step([OUT_CATCHMENT], [OUT_FDR, OUT_STREAM_SEG1], name="Catchment Raster")
+    def catchment():
+        ArcHydroTools.CatchmentGridDelineation(Input_Flow_Direction_Raster=Raster(OUT_FDR), 
+                                               Input_Link_Raster=Raster(OUT_STREAM_SEG1), 
+                                               Output_Catchment_Raster=OUT_CATCHMENT)
 
-CATCHMENT = Raster(OUT_CATCHMENT)
 
 # -- 10. Catchment Poly -------------------------
-if not arcpy.Exists(OUT_CATCHMENT_POLY):
-    print("Catchment Poly")
-    ArcHydroTools.CatchmentPolyProcessing(Input_Catchment_Raster=CATCHMENT, 
+@pipe.step([OUT_CATCHMENT_POLY], [OUT_CATCHMENT], name="Catchment Poly")
+def catchment_poly():
+    ArcHydroTools.CatchmentPolyProcessing(Input_Catchment_Raster=Raster(OUT_CATCHMENT), 
                                           Output_Catchment_Feature_Class=OUT_CATCHMENT_POLY)
     
 # -- 11. Outlet Points -------------------------
-if not arcpy.Exists(OUT_OUTLET_POINTS):
-    print("Outlet Points")
-    ArcHydroTools.DrainagePointProcessing(FAC, 
-                                          CATCHMENT, 
+@pipe.step([OUT_OUTLET_POINTS], [OUT_FAC, OUT_CATCHMENT, OUT_CATCHMENT_POLY],
+           name="Outlet Points")
+def outlet_points():
+    ArcHydroTools.DrainagePointProcessing(Raster(OUT_FAC), 
+                                          Raster(OUT_CATCHMENT), 
                                           OUT_CATCHMENT_POLY, 
                                           OUT_OUTLET_POINTS)
 
-# -- 12. Outlet Raster with NoData -------------------------
-if not arcpy.Exists(OUT_OUTLET_RASTER1):
-    print("Outlet Points Raster1")
-    arcpy.PointToRaster_conversion(in_features=OUT_OUTLET_POINTS, value_field="DrainID", 
-                                  out_rasterdataset=OUT_OUTLET_RASTER1, 
-                                  cell_assignment="MOST_FREQUENT",
-                                  priority_field=None,
-                                  cellsize=cell_size)        
-OUTLETS1 = Raster(OUT_OUTLET_RASTER1)
-
-# -- 13. Outlet Points Raster excluding NoData -------------------------
-if not arcpy.Exists(OUT_OUTLET_RASTER2):
-    print("Outlet Points Raster2")
-    
-    OUTLETS2 = Con(in_conditional_raster=IsNull(OUTLETS1),
-                       in_true_raster_or_constant=0, in_false_raster_or_constant=1)
-    OUTLETS2.save(OUT_OUTLET_RASTER2)
-else:
-    OUTLETS2 = Raster(OUT_OUTLET_RASTER2)
+if not use_numpy:
+    # -- 12. Outlet Raster with NoData -------------------------
+    @pipe.step([OUT_OUTLET_RASTER1], [OUT_OUTLET_POINTS], {"cell_size": cell_size},
+               name="Outlet Points Raster1")
+    def outlet_raster1():
+        arcpy.PointToRaster_conversion(in_features=OUT_OUTLET_POINTS, value_field="DrainID", 
+                                      out_rasterdataset=OUT_OUTLET_RASTER1, 
+                                      cell_assignment="MOST_FREQUENT",
+                                      priority_field=None,
+                                      cellsize=cell_size)
+
+    # -- 13. Outlet Points Raster excluding NoData -------------------------
+    @pipe.step([OUT_OUTLET_RASTER2], [OUT_OUTLET_RASTER1], name="Outlet Points Raster2")
+    def outlet_raster2():
+        OUTLETS2 = Con(in_conditional_raster=IsNull(Raster(OUT_OUTLET_RASTER1)),
+                           in_true_raster_or_constant=0, in_false_raster_or_constant=1)
+        OUTLETS2.save(OUT_OUTLET_RASTER2)
 
 # -- 14. Upstream Area -------------------------
-if not arcpy.Exists(OUT_UP_AREA):
-    print("upstream area")
-    
+@pipe.step([OUT_UP_AREA], [OUT_FAC],
+           {"cell_size": cell_size, "con_to_m": con_to_m},
+           name="upstream area")
+def upstream_area():
     # this will be in square meters
-    UP_AREA = FAC * ((cell_size * con_to_m)**2)
+    UP_AREA = Raster(OUT_FAC) * ((cell_size * con_to_m)**2)
     UP_AREA.save(OUT_UP_AREA)
-else:
-    UP_AREA = Raster(OUT_UP_AREA)
     
 # -- 15. Flow Direction w/ NULL streams  -------------------------
-if not arcpy.Exists(OUT_FDR_STREAM):
-    print("flow direction w/ null streams")
-    
-    # square meters
-    stream_init_sqm = stream_init_sqkm * 1000000              
-                
-    FDR_STREAM = SetNull(in_conditional_raster=((UP_AREA >= stream_init_sqm) | (STREAM2==1)),
-                         in_false_raster_or_constant=FDR)          
+@pipe.step([OUT_FDR_STREAM], [OUT_UP_AREA, OUT_STREAM2, OUT_FDR],
+           {"stream_init_sqm": stream_init_sqm},
+           name="flow direction w/ null streams")
+def fdr_stream():
+    FDR_STREAM = SetNull(in_conditional_raster=((Raster(OUT_UP_AREA) >= stream_init_sqm) | (Raster(OUT_STREAM2)==1)),
+                         in_false_raster_or_constant=Raster(OUT_FDR))          
 
     FDR_STREAM.save(OUT_FDR_STREAM)
-else:
-    FDR_STREAM = Raster(OUT_FDR_STREAM)
     
 # -- 16. Flow Direction w/ NULL Outlets  -------------------------
-if not arcpy.Exists(OUT_FDR_OUTLET):
-    print("flow direction w/ null outlets")
-    
-    FDR_OUTLET = SetNull(in_conditional_raster=(OUTLETS2==1),
-                         in_false_raster_or_constant=FDR)          
+@pipe.step([OUT_FDR_OUTLET], [OUT_OUTLET_RASTER2, OUT_FDR],
+           name="flow direction w/ null outlets")
+def fdr_outlet():
+    FDR_OUTLET = SetNull(in_conditional_raster=(Raster(OUT_OUTLET_RASTER2)==1),
+                         in_false_raster_or_constant=Raster(OUT_FDR))          
 
     FDR_OUTLET.save(OUT_FDR_OUTLET)
-else:
-    FDR_OUTLET = Raster(OUT_FDR_OUTLET)
     
-# -- 17. Flow Length to stream -------------------------
-if not arcpy.Exists(OUT_TO_STREAM1):
-    print("flow length to streams1")
-    TO_STREAM1 = FlowLength(FDR_STREAM, "DOWNSTREAM") * con_to_m
-    
-    TO_STREAM1.save(OUT_TO_STREAM1)
-else:
-    TO_STREAM1 = Raster(OUT_TO_STREAM1)
-
-if not arcpy.Exists(OUT_TO_STREAM2):
-    print("flow length to streams2")
-    # It's null at the stream so fix that
-    TO_STREAM2 = Con(in_conditional_raster=((UP_AREA >= stream_init_sqm) | (STREAM2==1)),
-                     in_true_raster_or_constant=0.0,
-                     in_false_raster_or_constant=TO_STREAM1)           
-    
-    TO_STREAM2.save(OUT_TO_STREAM2)
+if use_numpy:
+    def flow_length_to(target):
+        """Returns the flow length in meters from each cell to the first
+        target cell on its flow path"""
+        fdr = arcpy_io.raster_to_array(OUT_FDR, d8.FDR_NODATA)
+        graph = flowgraph.cached_graph(fdr, graph_dir)
+        del fdr
+        return flowlength.flow_length(cellsize=cell_size * con_to_m,
+                                      target=target, graph=graph)
+    
+    # -- 17. Flow Length to stream -------------------------
+    @pipe.step([OUT_TO_STREAM1, OUT_TO_STREAM2], [OUT_FDR, OUT_UP_AREA, OUT_STREAM2],
+               {"stream_init_sqm": stream_init_sqm, "con_to_m": con_to_m},
+               name="flow length to streams")
+    def to_stream():
+        with numpy.errstate(invalid="ignore"):
+            streams2 = ((arcpy_io.raster_to_array(OUT_UP_AREA) >= stream_init_sqm) |
+                        (arcpy_io.raster_to_array(OUT_STREAM2) == 1))
+        to_stream2 = flow_length_to(streams2)
+        arcpy_io.array_to_raster(to_stream2.astype(numpy.float32),
+                                 OUT_TO_STREAM2, OUT_FDR, sr=sr)
+        to_stream2[streams2] = numpy.nan
+        arcpy_io.array_to_raster(to_stream2.astype(numpy.float32),
+                                 OUT_TO_STREAM1, OUT_FDR, sr=sr)
+    
+    # -- 18. Flow Length to Outlets -------------------------
+    @pipe.step([OUT_TO_OUTLET1, OUT_TO_OUTLET2], [OUT_FDR, OUT_OUTLET_RASTER2],
+               {"con_to_m": con_to_m},
+               name="flow length to outlets")
+    def to_outlet():
+        outlets = arcpy_io.raster_to_array(OUT_OUTLET_RASTER2) == 1
+        to_outlet2 = flow_length_to(outlets)
+        arcpy_io.array_to_raster(to_outlet2.astype(numpy.float32),
+                                 OUT_TO_OUTLET2, OUT_FDR, sr=sr)
+        to_outlet2[outlets] = numpy.nan
+        arcpy_io.array_to_raster(to_outlet2.astype(numpy.float32),
+                                 OUT_TO_OUTLET1, OUT_FDR, sr=sr)
 
 else:
-    TO_STREAM2 = Raster(OUT_TO_STREAM2)
-    
-# -- 18. Flow Length to Outlets -------------------------
-if not arcpy.Exists(OUT_TO_OUTLET1):
-    print("flow length to outlet1")
-    TO_OUTLET1 = FlowLength(FDR_OUTLET, "DOWNSTREAM") * con_to_m
-    
-    TO_OUTLET1.save(OUT_TO_OUTLET1)
-
-else:
-    TO_OUTLET1 = Raster(OUT_TO_OUTLET1)
+    # -- 17. Flow Length to stream -------------------------
+    @pipe.step([OUT_TO_STREAM1], [OUT_FDR_STREAM], {"con_to_m": con_to_m},
+               name="flow length to streams1")
+    def to_stream1():
+        TO_STREAM1 = FlowLength(Raster(OUT_FDR_STREAM), "DOWNSTREAM") * con_to_m
+    
+        TO_STREAM1.save(OUT_TO_STREAM1)
+
+    @pipe.step([OUT_TO_STREAM2], [OUT_UP_AREA, OUT_STREAM2, OUT_TO_STREAM1],
+               {"stream_init_sqm": stream_init_sqm},
+               name="flow length to streams2")
+    def to_stream2():
+        # It's null at the stream so fix that
+        TO_STREAM2 = Con(in_conditional_raster=((Raster(OUT_UP_AREA) >= stream_init_sqm) | (Raster(OUT_STREAM2)==1)),
+                         in_true_raster_or_constant=0.0,
+                         in_false_raster_or_constant=Raster(OUT_TO_STREAM1))           
+    
+        TO_STREAM2.save(OUT_TO_STREAM2)
+    
+    # -- 18. Flow Length to Outlets -------------------------
+    @pipe.step([OUT_TO_OUTLET1], [OUT_FDR_OUTLET], {"con_to_m": con_to_m},
+               name="flow length to outlet1")
+    def to_outlet1():
+        TO_OUTLET1 = FlowLength(Raster(OUT_FDR_OUTLET), "DOWNSTREAM") * con_to_m
+    
+        TO_OUTLET1.save(OUT_TO_OUTLET1)
  
-if not arcpy.Exists(OUT_TO_OUTLET2):
-    print("flow length to outlet2")
-    # It's null at the outlet point so fix that
-    TO_OUTLET2 = Con(in_conditional_raster=IsNull(TO_OUTLET1),
-                     in_true_raster_or_constant=0.0,
-                     in_false_raster_or_constant=TO_OUTLET1)
-    TO_OUTLET2.save(OUT_TO_OUTLET2)
-    
-else:
-    TO_OUTLET2 = Raster(OUT_TO_OUTLET2)
-      
+    @pipe.step([OUT_TO_OUTLET2], [OUT_TO_OUTLET1], name="flow length to outlet2")
+    def to_outlet2():
+        # It's null at the outlet point so fix that
+        TO_OUTLET1 = Raster(OUT_TO_OUTLET1)
+        TO_OUTLET2 = Con(in_conditional_raster=IsNull(TO_OUTLET1),
+                         in_true_raster_or_constant=0.0,
+                         in_false_raster_or_constant=TO_OUTLET1)
+        TO_OUTLET2.save(OUT_TO_OUTLET2)
+
 # ----------------------------------------------------------------------
 # Generate Base RCA and ARCA Flow Accumulation outputs
 # ----------------------------------------------------------------------
 
 # -- 19. Generate RCA FAC raster -------------------------
-if not arcpy.Exists(OUT_FAC_RCA):
-    print("RCA fac raster")
+if not use_numpy:
+    @pipe.step([OUT_FAC_RCA], [OUT_FDR_OUTLET], name="RCA fac raster")
+    def fac_rca():
+        FAC_RCA = Plus(FlowAccumulation(in_flow_direction_raster=Raster(OUT_FDR_OUTLET), 
+                                   data_type="FLOAT"), 1.0)
     
-    FAC_RCA = Plus(FlowAccumulation(in_flow_direction_raster=FDR_OUTLET, 
-                               data_type="FLOAT"), 1.0)
-
-    FAC_RCA.save(OUT_FAC_RCA)
+        FAC_RCA.save(OUT_FAC_RCA)
     
 # -- 20. Generate ARCA FAC raster -------------------------
-if not arcpy.Exists(OUT_FAC_ARCA):
-    print("ARCA fac raster")
-    FAC_ARCA = Plus(FAC, 1.0)
+@pipe.step([OUT_FAC_ARCA], [OUT_FAC], name="ARCA fac raster")
+def fac_arca():
+    FAC_ARCA = Plus(Raster(OUT_FAC), 1.0)
     FAC_ARCA.save(OUT_FAC_ARCA)
     
 
@@ -598,241 +848,328 @@ if not arcpy.Exists(OUT_FAC_ARCA):
 # ----------------------------------------------------------------------
 
 if distance_euc:
-    # -- 21. Generate a rsa zone raster based on euclidean distance --------
-    if not arcpy.Exists(OUT_RSA_EUC_ZONE):
-        print("Euclidean RSA allocation zones")
-        RSA_EUC_ZONES = EucAllocation(in_source_data=STREAM_SEGS,
-                                  maximum_distance=rsa_m*con_from_m,
-                                  source_field="Value")
-        RSA_EUC_ZONES.save(OUT_RSA_EUC_ZONE)
-    else:
-        RSA_EUC_ZONES = Raster(OUT_RSA_EUC_ZONE)
-    
-    # -- 22. Generate an euclidean distance raster -------------------------
-    if not arcpy.Exists(OUT_TO_STREAM_EUC):
-        print("Euclidean flow direction raster")
-        TO_STREAM_EUC = EucDistance(STREAM1, maximum_distance=rsa_m*con_from_m) * con_to_m
-        TO_STREAM_EUC.save(OUT_TO_STREAM_EUC)
+    if use_numpy:
+        # -- 21, 22, 23. Allocation, distance and direction -------------
+        # from one distance transform limited to rsa_m. The stream
+        # segments are the sources for all three.
+        @pipe.step([OUT_RSA_EUC_ZONE, OUT_TO_STREAM_EUC, OUT_FDR_EUC3],
+                   [OUT_STREAM_SEG1, OUT_FDR],
+                   {"rsa_m": rsa_m, "con_to_m": con_to_m, "use_numpy": use_numpy},
+                   name="Euclidean RSA allocation, distance and direction")
+        def euclidean_rsa():
+            segs = arcpy_io.raster_to_array(OUT_STREAM_SEG1)
+            dist, nearest = euclidean.distance_transform(~numpy.isnan(segs),
+                                                         cell_size * con_to_m,
+                                                         rsa_m)
+            zones_to_raster(euclidean.allocation(segs, nearest),
+                            OUT_RSA_EUC_ZONE, OUT_STREAM_SEG1)
+            arcpy_io.array_to_raster(dist.astype(numpy.float32),
+                                     OUT_TO_STREAM_EUC, OUT_STREAM_SEG1, sr=sr)
+            del segs, dist
+            
+            # zero is the stream
+            fdr_euc = euclidean.direction_to_d8(euclidean.direction(nearest))
+            del nearest
+            fdr = arcpy_io.raster_to_array(OUT_FDR, d8.FDR_NODATA)
+            fdr_euc = numpy.where(fdr_euc == 0, fdr, fdr_euc)
+            fdr_euc[numpy.isnan(fdr_euc)] = d8.FDR_NODATA
+            arcpy_io.array_to_raster(fdr_euc.astype(numpy.uint8), OUT_FDR_EUC3,
+                                     OUT_FDR, d8.FDR_NODATA, sr)
     else:
-        TO_STREAM_EUC = Raster(OUT_TO_STREAM_EUC)
-
-    # -- 23. Generate an euclidean distance flow direction raster -----------
-    if not arcpy.Exists(OUT_FDR_EUC3):
-        print("Euclidean flow direction raster")
-        FDR_EUC1 = EucDirection(STREAM1, maximum_distance=rsa_m*con_from_m)
+        # -- 21. Generate a rsa zone raster based on euclidean distance --------
+        @pipe.step([OUT_RSA_EUC_ZONE], [OUT_STREAM_SEG1],
+                   {"rsa_m": rsa_m, "con_from_m": con_from_m},
+                   name="Euclidean RSA allocation zones")
+        def rsa_euc_zone():
+            RSA_EUC_ZONES = EucAllocation(in_source_data=Raster(OUT_STREAM_SEG1),
+                                      maximum_distance=rsa_m*con_from_m,
+                                      source_field="Value")
+            RSA_EUC_ZONES.save(OUT_RSA_EUC_ZONE)
+    
+        # -- 22. Generate an euclidean distance raster -------------------------
+        @pipe.step([OUT_TO_STREAM_EUC], [OUT_STREAM1],
+                   {"rsa_m": rsa_m, "con_from_m": con_from_m},
+                   name="Euclidean distance raster")
+        def to_stream_euc():
+            TO_STREAM_EUC = EucDistance(Raster(OUT_STREAM1), maximum_distance=rsa_m*con_from_m) * con_to_m
+            TO_STREAM_EUC.save(OUT_TO_STREAM_EUC)
+
+        # -- 23. Generate an euclidean distance flow direction raster -----------
+        @pipe.step([OUT_FDR_EUC3], [OUT_STREAM1, OUT_FDR],
+                   {"rsa_m": rsa_m, "con_from_m": con_from_m},
+                   name="Euclidean flow direction raster")
+        def fdr_euc():
+            FDR_EUC1 = EucDirection(Raster(OUT_STREAM1), maximum_distance=rsa_m*con_from_m)
          
-        rc_table = RemapRange([[1, 22.5, 64],
-                               [22.5,67.5, 128],
-                               [67.5, 112.5, 1],
-                               [112.5, 157.5, 2],
-                               [157.5, 202.5, 4],
-                               [202.5, 247.5, 8],
-                               [247.5, 292.5, 16],
-                               [292.5, 337.5, 32],
-                               [337.5, 360, 64]
-                               ])
+            rc_table = RemapRange([[1, 22.5, 64],
+                                   [22.5,67.5, 128],
+                                   [67.5, 112.5, 1],
+                                   [112.5, 157.5, 2],
+                                   [157.5, 202.5, 4],
+                                   [202.5, 247.5, 8],
+                                   [247.5, 292.5, 16],
+                                   [292.5, 337.5, 32],
+                                   [337.5, 360, 64]
+                                   ])
         
-        # reclass
-        FDR_EUC2 = Reclassify(in_raster=FDR_EUC1,
-                                reclass_field="value",
-                                remap=rc_table,
-                                missing_values="DATA")
+            # reclass
+            FDR_EUC2 = Reclassify(in_raster=FDR_EUC1,
+                                    reclass_field="value",
+                                    remap=rc_table,
+                                    missing_values="DATA")
         
-        # zero is the stream
-        FDR_EUC3 = Con(in_conditional_raster=(FDR_EUC2==0),
-                             in_true_raster_or_constant=FDR,
-                             in_false_raster_or_constant=FDR_EUC2)     
+            # zero is the stream
+            FDR_EUC3 = Con(in_conditional_raster=(FDR_EUC2==0),
+                                 in_true_raster_or_constant=Raster(OUT_FDR),
+                                 in_false_raster_or_constant=FDR_EUC2)     
         
-        FDR_EUC3.save(OUT_FDR_EUC3)
-    else:
-        FDR_EUC3 = Raster(OUT_FDR_EUC3)
-        
-    
+            FDR_EUC3.save(OUT_FDR_EUC3)
+
     # -- 24. Generate an euclidean distance flow direction w/ null outlets 
-    if not arcpy.Exists(OUT_FDR_EUC_OUTLET):
-        print("euclidean flow direction w/ null outlets")
-        
-        FDR_EUC_OUTLET = SetNull(in_conditional_raster=(OUTLETS2==1),
-                             in_false_raster_or_constant=FDR_EUC3)
+    @pipe.step([OUT_FDR_EUC_OUTLET], [OUT_OUTLET_RASTER2, OUT_FDR_EUC3],
+               name="euclidean flow direction w/ null outlets")
+    def fdr_euc_outlet():
+        FDR_EUC_OUTLET = SetNull(in_conditional_raster=(Raster(OUT_OUTLET_RASTER2)==1),
+                             in_false_raster_or_constant=Raster(OUT_FDR_EUC3))
     
         FDR_EUC_OUTLET.save(OUT_FDR_EUC_OUTLET)
-    else:
-        FDR_EUC_OUTLET = Raster(OUT_FDR_EUC_OUTLET)
         
     # -- 25. Generate RSA euclidean distance weight raster -----------------
-    if not arcpy.Exists(OUT_RSA_EUC_WEIGHT):
-        print("RSA weight raster")
-        
-        RSA_EUC_WEIGHT = SetNull(in_conditional_raster=(TO_STREAM_EUC > rsa_m),
+    @pipe.step([OUT_RSA_EUC_WEIGHT], [OUT_TO_STREAM_EUC], {"rsa_m": rsa_m},
+               name="RSA weight raster")
+    def rsa_euc_weight():
+        RSA_EUC_WEIGHT = SetNull(in_conditional_raster=(Raster(OUT_TO_STREAM_EUC) > rsa_m),
                              in_false_raster_or_constant=1)
     
         RSA_EUC_WEIGHT.save(OUT_RSA_EUC_WEIGHT)
-    else:
-        RSA_EUC_WEIGHT = Raster(OUT_RSA_EUC_WEIGHT)
     
-    # -- 26. Generate Euclidean distance RSA FAC raster ---------------------
-    if not arcpy.Exists(OUT_FAC_RSA_EUCQ):
-        print("RSA Euclidean distance fac raster")
+    if not use_numpy:
+        # -- 26. Generate Euclidean distance RSA FAC raster -----------------
+        @pipe.step([OUT_FAC_RSA_EUC], [OUT_FDR_EUC_OUTLET, OUT_RSA_EUC_WEIGHT],
+                   name="RSA Euclidean distance fac raster")
+        def fac_rsa_euc():
+            RSA_EUC_WEIGHT = Raster(OUT_RSA_EUC_WEIGHT)
+            FAC_RSA_EUC = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR_EUC_OUTLET), RSA_EUC_WEIGHT),
+                                         in_weight_raster=RSA_EUC_WEIGHT, 
+                                         data_type="FLOAT"), 1.0)
         
-        FAC_RSA_EUC = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR_EUC_OUTLET, RSA_EUC_WEIGHT),
-                                     in_weight_raster=RSA_EUC_WEIGHT, 
-                                     data_type="FLOAT"), 1.0)
-    
-        FAC_RSA_EUC.save(OUT_FAC_RSA_EUC)
-    
-    # -- 27. Generate euclidean distance ARSA FAC raster --------------------
-    if not arcpy.Exists(OUT_FAC_ARSA_EUCQ):
-        print("ARSA Euclidean distance fac raster")
+            FAC_RSA_EUC.save(OUT_FAC_RSA_EUC)
         
-        FAC_ARSA_EUC = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR_EUC3, RSA_EUC_WEIGHT),
-                                     in_weight_raster=RSA_EUC_WEIGHT, 
-                                     data_type="FLOAT"), 1.0)
-    
-        FAC_ARSA_EUC.save(OUT_FAC_ARSA_EUC)
+        # -- 27. Generate euclidean distance ARSA FAC raster ----------------
+        @pipe.step([OUT_FAC_ARSA_EUC], [OUT_FDR_EUC3, OUT_RSA_EUC_WEIGHT],
+                   name="ARSA Euclidean distance fac raster")
+        def fac_arsa_euc():
+            RSA_EUC_WEIGHT = Raster(OUT_RSA_EUC_WEIGHT)
+            FAC_ARSA_EUC = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR_EUC3), RSA_EUC_WEIGHT),
+                                         in_weight_raster=RSA_EUC_WEIGHT, 
+                                         data_type="FLOAT"), 1.0)
+        
+            FAC_ARSA_EUC.save(OUT_FAC_ARSA_EUC)
 
 # ----------------------------------------------------------------------
 # RSA and ARSA outputs based on Flow distance
 # ----------------------------------------------------------------------
 if distance_flow:
     # -- 28. Generate RSA flow weight raster -------------------------
-    if not arcpy.Exists(OUT_RSA_Q_WEIGHT):
-        print("RSA flow distance weight raster")
-        
-        RSA_Q_WEIGHT = SetNull(in_conditional_raster=(TO_STREAM2 > rsa_m),
+    @pipe.step([OUT_RSA_Q_WEIGHT], [OUT_TO_STREAM2], {"rsa_m": rsa_m},
+               name="RSA flow distance weight raster")
+    def rsa_q_weight():
+        RSA_Q_WEIGHT = SetNull(in_conditional_raster=(Raster(OUT_TO_STREAM2) > rsa_m),
                              in_false_raster_or_constant=1)
     
         RSA_Q_WEIGHT.save(OUT_RSA_Q_WEIGHT)
-    else:
-        RSA_Q_WEIGHT = Raster(OUT_RSA_Q_WEIGHT)
     
     # -- 29. Generate RSA flow distance zone raster -------------------------
-    if not arcpy.Exists(OUT_RSA_Q_ZONE):
-        print("RSA flow distance zone raster")
+    @pipe.step([OUT_RSA_Q_ZONE], [OUT_RSA_Q_WEIGHT, OUT_CATCHMENT],
+               {"use_numpy": use_numpy},
+               name="RSA flow distance zone raster")
+    def rsa_q_zone():
+        if use_numpy:
+            zones = arcpy_io.raster_to_array(OUT_CATCHMENT)
+            zones[arcpy_io.raster_to_array(OUT_RSA_Q_WEIGHT) != 1] = numpy.nan
+            zones_to_raster(zones, OUT_RSA_Q_ZONE, OUT_CATCHMENT)
+            return
         
-        RSA_Q_ZONE = Con(in_conditional_raster=(RSA_Q_WEIGHT==1),
-                             in_true_raster_or_constant=CATCHMENT)
+        RSA_Q_ZONE = Con(in_conditional_raster=(Raster(OUT_RSA_Q_WEIGHT)==1),
+                             in_true_raster_or_constant=Raster(OUT_CATCHMENT))
         
         RSA_Q_ZONE.save(OUT_RSA_Q_ZONE)
-        
     
-    # -- 30. Generate flow distance RSA FAC raster -------------------------
-    if not arcpy.Exists(OUT_FAC_RSA_Q):
-        print("RSA flow distance fac raster")
+    if not use_numpy:
+        # -- 30. Generate flow distance RSA FAC raster ----------------------
+        @pipe.step([OUT_FAC_RSA_Q], [OUT_FDR_OUTLET, OUT_RSA_Q_WEIGHT],
+                   name="RSA flow distance fac raster")
+        def fac_rsa_q():
+            RSA_Q_WEIGHT = Raster(OUT_RSA_Q_WEIGHT)
+            FAC_RSA_Q = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR_OUTLET), RSA_Q_WEIGHT),
+                                         in_weight_raster=RSA_Q_WEIGHT, 
+                                         data_type="FLOAT"), 1.0)
         
-        FAC_RSA_EUCQ = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR_OUTLET, RSA_Q_WEIGHT),
-                                     in_weight_raster=RSA_Q_WEIGHT, 
-                                     data_type="FLOAT"), 1.0)
-    
-        FAC_RSA_EUCQ.save(OUT_FAC_RSA_Q)
-    
-    # -- 31. Generate flow distance ARSA FAC raster -------------------------
-    if not arcpy.Exists(OUT_FAC_ARSA_Q):
-        print("ARSA flow distance fac raster")
+            FAC_RSA_Q.save(OUT_FAC_RSA_Q)
         
-        FAC_ARSA_Q = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR, RSA_Q_WEIGHT),
-                                     in_weight_raster=RSA_Q_WEIGHT, 
-                                     data_type="FLOAT"), 1.0)
-    
-        FAC_ARSA_Q.save(OUT_FAC_ARSA_Q)
+        # -- 31. Generate flow distance ARSA FAC raster ---------------------
+        @pipe.step([OUT_FAC_ARSA_Q], [OUT_FDR, OUT_RSA_Q_WEIGHT],
+                   name="ARSA flow distance fac raster")
+        def fac_arsa_q():
+            RSA_Q_WEIGHT = Raster(OUT_RSA_Q_WEIGHT)
+            FAC_ARSA_Q = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR), RSA_Q_WEIGHT),
+                                         in_weight_raster=RSA_Q_WEIGHT, 
+                                         data_type="FLOAT"), 1.0)
+        
+            FAC_ARSA_Q.save(OUT_FAC_ARSA_Q)
     
 # ----------------------------------------------------------------------
 # RSA and ARSA outputs based on combination of Euclidean and Flow distance
 # ----------------------------------------------------------------------
 if distance_combo:
+    def in_euc_zone():
+        """Returns a raster that is True where the euclidean RSA zone
+        and the catchment agree"""
+        CATCHMENT = Raster(OUT_CATCHMENT)
+        RSA_EUC_ZONES = Raster(OUT_RSA_EUC_ZONE)
+        return Divide(Plus(Times(CATCHMENT, 10), Times(RSA_EUC_ZONES, 10)), 2) == Times(RSA_EUC_ZONES, 10)
+    
     # -- 32. Reconcile RSA zones and catchments ---------------------------
-    if not arcpy.Exists(OUT_RSA_EUCQ_ZONE):
-        print("Reconcile RSA euclidean zones and catchments")
-            
-        RSA_EUCQ_ZONE = Con(in_conditional_raster=Divide(Plus(Times(CATCHMENT, 10),
-                                                              Times(RSA_EUC_ZONES, 10)), 2) == Times(RSA_EUC_ZONES, 10),
-                            in_true_raster_or_constant=RSA_EUC_ZONES,
-                            in_false_raster_or_constant=SetNull(in_conditional_raster=(TO_STREAM2 > rsa_m),
-                                in_false_raster_or_constant=CATCHMENT))
+    @pipe.step([OUT_RSA_EUCQ_ZONE], [OUT_CATCHMENT, OUT_RSA_EUC_ZONE, OUT_TO_STREAM2],
+               {"rsa_m": rsa_m, "use_numpy": use_numpy},
+               name="Reconcile RSA euclidean zones and catchments")
+    def rsa_eucq_zone():
+        if use_numpy:
+            catchment = arcpy_io.raster_to_array(OUT_CATCHMENT)
+            euc_zone = arcpy_io.raster_to_array(OUT_RSA_EUC_ZONE)
+            to_stream = arcpy_io.raster_to_array(OUT_TO_STREAM2)
+            with numpy.errstate(invalid="ignore"):
+                zones = numpy.where(catchment == euc_zone, euc_zone,
+                                    numpy.where(to_stream > rsa_m, numpy.nan,
+                                                catchment))
+            zones[numpy.isnan(catchment) | numpy.isnan(euc_zone)] = numpy.nan
+            zones_to_raster(zones, OUT_RSA_EUCQ_ZONE, OUT_CATCHMENT)
+            return
+        
+        RSA_EUCQ_ZONE = Con(in_conditional_raster=in_euc_zone(),
+                            in_true_raster_or_constant=Raster(OUT_RSA_EUC_ZONE),
+                            in_false_raster_or_constant=SetNull(in_conditional_raster=(Raster(OUT_TO_STREAM2) > rsa_m),
+                                in_false_raster_or_constant=Raster(OUT_CATCHMENT)))
         RSA_EUCQ_ZONE.save(OUT_RSA_EUCQ_ZONE)
     
-    
     # -- 33. Generate a FDR based on the euclidean flow reconciliation ----
-    if not arcpy.Exists(OUT_FDR_EUCQ):
-        print("FDR for the euclidean-flow reconciliation ")
-            
-        FDR_EUCQ = Con(in_conditional_raster=Divide(Plus(Times(CATCHMENT, 10),
-                                                              Times(RSA_EUC_ZONES, 10)), 2) == Times(RSA_EUC_ZONES, 10),
-                            in_true_raster_or_constant=FDR_EUC3,
-                            in_false_raster_or_constant=SetNull(in_conditional_raster=(TO_STREAM2 > rsa_m),
-                                in_false_raster_or_constant=FDR))
+    @pipe.step([OUT_FDR_EUCQ], [OUT_CATCHMENT, OUT_RSA_EUC_ZONE, OUT_FDR_EUC3,
+                                OUT_TO_STREAM2, OUT_FDR],
+               {"rsa_m": rsa_m},
+               name="FDR for the euclidean-flow reconciliation")
+    def fdr_eucq():
+        FDR_EUCQ = Con(in_conditional_raster=in_euc_zone(),
+                            in_true_raster_or_constant=Raster(OUT_FDR_EUC3),
+                            in_false_raster_or_constant=SetNull(in_conditional_raster=(Raster(OUT_TO_STREAM2) > rsa_m),
+                                in_false_raster_or_constant=Raster(OUT_FDR)))
         FDR_EUCQ.save(OUT_FDR_EUCQ)
     
-    
     # -- 34. Generate an euclidean distance flow reconciled flow direction w/ null outlets 
-    if not arcpy.Exists(OUT_FDR_EUCQ_OUTLET):
-        print("euclidean-flow reconciled flow direction w/ null outlets")
-        
-        FDR_EUCQ_OUTLET = SetNull(in_conditional_raster=(OUTLETS2==1),
-                             in_false_raster_or_constant=FDR_EUCQ)
+    @pipe.step([OUT_FDR_EUCQ_OUTLET], [OUT_OUTLET_RASTER2, OUT_FDR_EUCQ],
+               name="euclidean-flow reconciled flow direction w/ null outlets")
+    def fdr_eucq_outlet():
+        FDR_EUCQ_OUTLET = SetNull(in_conditional_raster=(Raster(OUT_OUTLET_RASTER2)==1),
+                             in_false_raster_or_constant=Raster(OUT_FDR_EUCQ))
     
         FDR_EUCQ_OUTLET.save(OUT_FDR_EUCQ_OUTLET)
-    else:
-        FDR_EUCQ_OUTLET = Raster(OUT_FDR_EUCQ_OUTLET)
         
     # -- 35. Generate an euclidean distance flow reconciled weight raster --
-    if not arcpy.Exists(OUT_RSA_EUCQ_WEIGHT):
-        print("RSA euclidean-flow reconciled weight raster")
-        
-        RSA_EUCQ_WEIGHT = Con(in_conditional_raster=Divide(Plus(Times(CATCHMENT, 10),
-                                                                Times(RSA_EUC_ZONES, 10)), 2) == Times(RSA_EUC_ZONES, 10),
+    @pipe.step([OUT_RSA_EUCQ_WEIGHT], [OUT_CATCHMENT, OUT_RSA_EUC_ZONE, OUT_TO_STREAM2],
+               {"rsa_m": rsa_m},
+               name="RSA euclidean-flow reconciled weight raster")
+    def rsa_eucq_weight():
+        RSA_EUCQ_WEIGHT = Con(in_conditional_raster=in_euc_zone(),
                               in_true_raster_or_constant=1,
-                              in_false_raster_or_constant=SetNull(in_conditional_raster=(TO_STREAM2 > rsa_m),
+                              in_false_raster_or_constant=SetNull(in_conditional_raster=(Raster(OUT_TO_STREAM2) > rsa_m),
                                   in_false_raster_or_constant=1))
     
         RSA_EUCQ_WEIGHT.save(OUT_RSA_EUCQ_WEIGHT)
-    else:
-        RSA_EUCQ_WEIGHT = Raster(OUT_RSA_EUCQ_WEIGHT)
-        
          
-    # -- 36. Generate Euclidean-flow reconciled RSA FAC raster --------------
-    if not arcpy.Exists(OUT_FAC_RSA_EUCQ):
-        print("RSA euclidean-flow reconciled fac raster")
+    if not use_numpy:
+        # -- 36. Generate Euclidean-flow reconciled RSA FAC raster ----------
+        @pipe.step([OUT_FAC_RSA_EUCQ], [OUT_FDR_EUCQ_OUTLET, OUT_RSA_EUCQ_WEIGHT],
+                   name="RSA euclidean-flow reconciled fac raster")
+        def fac_rsa_eucq():
+            RSA_EUCQ_WEIGHT = Raster(OUT_RSA_EUCQ_WEIGHT)
+            FAC_RSA_EUCQ = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR_EUCQ_OUTLET), RSA_EUCQ_WEIGHT),
+                                         in_weight_raster=RSA_EUCQ_WEIGHT, 
+                                         data_type="FLOAT"), 1.0)
         
-        FAC_RSA_EUCQ = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR_EUCQ_OUTLET, RSA_EUCQ_WEIGHT),
-                                     in_weight_raster=RSA_EUCQ_WEIGHT, 
-                                     data_type="FLOAT"), 1.0)
-    
-        FAC_RSA_EUCQ.save(OUT_FAC_RSA_EUCQ)
-    
-    # -- 37. Generate Euclidean-flow reconciled ARSA FAC raster ------------
-    if not arcpy.Exists(OUT_FAC_ARSA_EUCQ):
-        print("ARSA euclidean-flow reconciled fac raster")
+            FAC_RSA_EUCQ.save(OUT_FAC_RSA_EUCQ)
         
-        FAC_ARSA_EUCQ = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR_EUCQ, RSA_EUCQ_WEIGHT),
-                                     in_weight_raster=RSA_EUCQ_WEIGHT, 
-                                     data_type="FLOAT"), 1.0)
-    
-        FAC_ARSA_EUCQ.save(OUT_FAC_ARSA_EUCQ)
+        # -- 37. Generate Euclidean-flow reconciled ARSA FAC raster ---------
+        @pipe.step([OUT_FAC_ARSA_EUCQ], [OUT_FDR_EUCQ, OUT_RSA_EUCQ_WEIGHT],
+                   name="ARSA euclidean-flow reconciled fac raster")
+        def fac_arsa_eucq():
+            RSA_EUCQ_WEIGHT = Raster(OUT_RSA_EUCQ_WEIGHT)
+            FAC_ARSA_EUCQ = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR_EUCQ), RSA_EUCQ_WEIGHT),
+                                         in_weight_raster=RSA_EUCQ_WEIGHT, 
+                                         data_type="FLOAT"), 1.0)
+        
+            FAC_ARSA_EUCQ.save(OUT_FAC_ARSA_EUCQ)
 
 # ----------------------------------------------------------------------
 # REACH and AREACH outputs
 # ----------------------------------------------------------------------
 
-# -- 30. Generate REACH FAC raster -------------------------
-if not arcpy.Exists(OUT_FAC_REACH):
-    print("REACH fac raster")
+if not use_numpy:
+    # -- 30. Generate REACH FAC raster -------------------------
+    @pipe.step([OUT_FAC_REACH], [OUT_FDR_OUTLET, OUT_STREAM1],
+               name="REACH fac raster")
+    def fac_reach():
+        STREAM1 = Raster(OUT_STREAM1)
+        FAC_REACH = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR_OUTLET), STREAM1),
+                                     in_weight_raster=STREAM1, 
+                                     data_type="FLOAT"), 1.0)
+    
+        FAC_REACH.save(OUT_FAC_REACH)
     
-    FAC_REACH = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR_OUTLET, STREAM1),
-                                 in_weight_raster=STREAM1, 
-                                 data_type="FLOAT"), 1.0)
+    # -- 31. Generate AREACH FAC raster -------------------------
+    @pipe.step([OUT_FAC_AREACH], [OUT_FDR, OUT_STREAM1],
+               name="AREACH fac raster")
+    def fac_areach():
+        STREAM1 = Raster(OUT_STREAM1)
+        FAC_AREACH = Plus(FlowAccumulation(in_flow_direction_raster=Times(Raster(OUT_FDR), STREAM1),
+                                     in_weight_raster=STREAM1, 
+                                     data_type="FLOAT"), 1.0)
+    
+        FAC_AREACH.save(OUT_FAC_AREACH)
 
-    FAC_REACH.save(OUT_FAC_REACH)
 
-# -- 31. Generate AREACH FAC raster -------------------------
-if not arcpy.Exists(OUT_FAC_AREACH):
-    print("AREACH fac raster")
-    
-    FAC_AREACH = Plus(FlowAccumulation(in_flow_direction_raster=Times(FDR, STREAM1),
-                                 in_weight_raster=STREAM1, 
-                                 data_type="FLOAT"), 1.0)
+# ----------------------------------------------------------------------
+# numpy FAC outputs. Every output sharing a flow direction raster is
+# accumulated in a single pass.
+# ----------------------------------------------------------------------
+if use_numpy:
+    # -- 30, REACH. 19 is made with the catchments ----------------
+    jobs = [(OUT_FAC_REACH, OUT_STREAM1)]
+    if distance_flow:
+        jobs.append((OUT_FAC_RSA_Q, OUT_RSA_Q_WEIGHT))
+    add_accumulate_batch(OUT_FDR_OUTLET, jobs)
+    
+    # -- 31, AREACH -------------------------
+    jobs = [(OUT_FAC_AREACH, OUT_STREAM1)]
+    if distance_flow:
+        jobs.append((OUT_FAC_ARSA_Q, OUT_RSA_Q_WEIGHT))
+    add_accumulate_batch(OUT_FDR, jobs)
+    
+    # -- 26, 27 -------------------------
+    if distance_euc:
+        add_accumulate_batch(OUT_FDR_EUC_OUTLET, [(OUT_FAC_RSA_EUC, OUT_RSA_EUC_WEIGHT)])
+        add_accumulate_batch(OUT_FDR_EUC3, [(OUT_FAC_ARSA_EUC, OUT_RSA_EUC_WEIGHT)])
+    
+    # -- 36, 37 -------------------------
+    if distance_combo:
+        add_accumulate_batch(OUT_FDR_EUCQ_OUTLET, [(OUT_FAC_RSA_EUCQ, OUT_RSA_EUCQ_WEIGHT)])
+        add_accumulate_batch(OUT_FDR_EUCQ, [(OUT_FAC_ARSA_EUCQ, OUT_RSA_EUCQ_WEIGHT)])
 
-    FAC_AREACH.save(OUT_FAC_AREACH)
+if refine_streams:
+    refineStreams()
+    if not use_numpy:
+        # the refined stream raster replaces the stream definition output
+        pipe.mark_done([OUT_STREAM1])
 
+pipe.run()
 
 print("Total process: {0:.1f} minutes".format((time.time() - startTime) / 60))
-print("done")
\ No newline at end of file
+print("done")
@@ -28,6 +28,7 @@ Oregon Department of Environmental Quality
 
 # Import modules
 import arcpy
+import numpy
 import os
 import time
 from arcpy import env
@@ -36,7 +37,12 @@ from arcpy import env
 arcpy.CheckOutExtension("spatial")
 from arcpy.sa import *
 
-ver = 2.4.1
+from hydrotools import arcpy_io
+from hydrotools import landslide
+from hydrotools import pipeline
+from hydrotools import tiled
+
+ver = "2.4.1"
 
 # INPUT FILES
 isLiDAR = True
@@ -62,6 +68,21 @@ OUT_PLAN = env.workspace + "\\PLAN"
 OUT_PLAN_Focal = env.workspace + "\\PLAN_Focal"
 OUT_PLAN_reclass = env.workspace + "\\PLAN_reclass"
 
+# Run all eight steps as one numpy kernel tile by tile
+# (hydrotools.landslide) so only SUSCEP_reclass_Final is written.
+# keep_intermediates also saves the other outputs. tile_size is the
+# tile width in cells; if None it is picked so the tiles in memory stay
+# under tile_memory_mb. Tiles run on tile_processes processes, None
+# uses every core.
+use_numpy = False
+keep_intermediates = False
+tile_size = None
+tile_memory_mb = 4096
+tile_processes = None
+
+# saves a hash of the inputs and settings used to make each output
+manifest = env.workspace.replace(".gdb", "") + "_manifest.json"
+
 # OUTPUT FILES THAT MAY ALREADY EXIST BUT NOT IN env.workspace
 # OUT_SLOPE = "C:\\WorkSpace\\Biocriteria\\WatershedCharaterization\\BareEarth_all.gdb\\be_all"
 
@@ -77,98 +98,172 @@ startTime= time.time()
 print "START ShallowLandslide_py v{0}: {1}".format(ver, time.ctime(startTime))
 
 ###########################
-# 1. Landform shape, use Planform only
+# Each step only runs again if its outputs are missing or an input,
+# reclass table or setting it depends on changed
+pipe = pipeline.Pipeline(manifest, exists=arcpy.Exists,
+                         fingerprint=arcpy_io.fingerprint,
+                         delete=arcpy.Delete_management)
+
+def scratch_npy(raster):
+        """Returns a .npy path in the scratch folder for a raster"""
+        return os.path.join(arcpy.env.scratchFolder,
+                            os.path.basename(str(raster)) + ".npy")
+
+def read_reclass_table(table):
+        """Returns the FROM, TO, OUT rows of a reclass table"""
+        return arcpy.da.TableToNumPyArray(table, ["FROM", "TO", "OUT"]).tolist()
+
+if isLiDAR == True:
+        Plan_Reclassification_Table = Plan_Reclassification_Table1
+else:
+        Plan_Reclassification_Table = Plan_Reclassification_Table2
+
+if use_numpy:
+        ###########################
+        # 1-8 in one pass over the DEM. The reclass outputs are integer.
+        layer_outputs = {"suscep_reclass": OUT_SUSCEP_reclass,
+                         "suscep": OUT_SUSCEP,
+                         "slope": OUT_SLOPE,
+                         "slope_reclass": OUT_SLOPE_reclass,
+                         "lith_reclass": OUT_LITH_reclass,
+                         "curve": OUT_CURVE,
+                         "profile": OUT_PROFILE,
+                         "plan": OUT_PLAN,
+                         "plan_focal": OUT_PLAN_Focal,
+                         "plan_reclass": OUT_PLAN_reclass}
+        integer_layers = ["suscep_reclass", "suscep", "slope_reclass",
+                          "lith_reclass", "plan_reclass"]
+        save_layers = ["suscep_reclass"]
+        if keep_intermediates:
+                save_layers = [name for name in landslide.layers
+                               if isLiDAR or name != "plan_focal"]
+        # This assumes a 3 ft / 1 meter cell resolution. (15 foot rectangle neighborhood window)
+        focal_size = 5 if isLiDAR else None
 
-print "Starting process 1/8: Generate Planform Curvature"
-if arcpy.Exists(OUT_PLAN) == False:
-        CURVE = Curvature(DEM_raster_input, 1.0, OUT_PROFILE, OUT_PLAN)
-        CURVE.save(OUT_CURVE)
+        @pipe.step([layer_outputs[name] for name in save_layers],
+                   [DEM_raster_input, FSP_raster_input,
+                    Plan_Reclassification_Table, Lith_Reclassification_Table,
+                    Slope_Reclassification_Table,
+                    Susceptability_Reclassification_Table],
+                   {"isLiDAR": isLiDAR},
+                   name="Starting process 1-8/8: Susceptibility kernel")
+        def susceptibility():
+                dem = arcpy.Raster(DEM_raster_input)
+                sources = [arcpy_io.raster_to_npy(dem, scratch_npy(DEM_raster_input)),
+                           arcpy_io.raster_to_npy(FSP_raster_input, scratch_npy(FSP_raster_input),
+                                                  template=DEM_raster_input)]
+                tables = [read_reclass_table(table) for table in
+                          [Plan_Reclassification_Table, Lith_Reclassification_Table,
+                           Slope_Reclassification_Table,
+                           Susceptability_Reclassification_Table]]
+                outs = [scratch_npy(name) for name in landslide.layers]
+                if not keep_intermediates:
+                        outs = outs[0]
+                result = tiled.run_local(landslide.susceptibility, sources, outs,
+                                         halo=landslide.halo(focal_size),
+                                         args=tuple([dem.meanCellWidth] + tables +
+                                                    [focal_size, keep_intermediates]),
+                                         tile_size=tile_size,
+                                         max_memory_mb=tile_memory_mb,
+                                         processes=tile_processes)
+                if not keep_intermediates:
+                        result = [result]
+                
+                for name, arry in zip(landslide.layers, result):
+                        if name not in save_layers:
+                                continue
+                        # written block by block so the memmaps are
+                        # never read whole
+                        if name in integer_layers:
+                                arcpy_io.npy_to_raster(arry, layer_outputs[name], dem, -1,
+                                                       dtype=numpy.int32)
+                        else:
+                                arcpy_io.npy_to_raster(arry, layer_outputs[name], dem)
+                        del arry
 else:
-        OUT_PLAN = Raster(OUT_PLAN)
-        print "PLAN raster exists"
+        ###########################
+        # 1. Landform shape, use Planform only
+
+        @pipe.step([OUT_CURVE, OUT_PROFILE, OUT_PLAN], [DEM_raster_input],
+                   name="Starting process 1/8: Generate Planform Curvature")
+        def planform():
+                CURVE = Curvature(DEM_raster_input, 1.0, OUT_PROFILE, OUT_PLAN)
+                CURVE.save(OUT_CURVE)
         
-###########################
-# 2. Perform a focal mean on Planform Curvature
+        ###########################
+        # 2. Perform a focal mean on Planform Curvature
 
-print "Starting process 2/8: Focal statistics on Planform Curvature"
-if arcpy.Exists(OUT_PLAN_Focal) == False:
         if isLiDAR == True:
-                # This assumes a 3 ft / 1 meter cell resolution. (15 foot rectangle neighborhood window)
-                PLAN_Focal = FocalStatistics(OUT_PLAN, NbrRectangle(5, 5, "CELL"), "MEAN", "DATA")
-                PLAN_Focal.save(OUT_PLAN_Focal)
+                @pipe.step([OUT_PLAN_Focal], [OUT_PLAN],
+                           name="Starting process 2/8: Focal statistics on Planform Curvature")
+                def plan_focal():
+                        # This assumes a 3 ft / 1 meter cell resolution. (15 foot rectangle neighborhood window)
+                        PLAN_Focal = FocalStatistics(OUT_PLAN, NbrRectangle(5, 5, "CELL"), "MEAN", "DATA")
+                        PLAN_Focal.save(OUT_PLAN_Focal)
+        
+                PLAN_Focal = OUT_PLAN_Focal
         else:
                 print "10m DEM, skipping focal statistics"
-                PLAN_Focal = Raster(OUT_PLAN)
-else:
-        PLAN_Focal = Raster(OUT_PLAN_Focal)
-        print "PLAN_focal raster exists"
+                PLAN_Focal = OUT_PLAN
         
-###########################
-# 3. Reclassify PLAN
-print "Starting process 3/8: Reclassify PLAN"
+        ###########################
+        # 3. Reclassify PLAN
 
-if isLiDAR == True:
-        Plan_Reclassification_Table = Plan_Reclassification_Table1
-else:
-        Plan_Reclassification_Table = Plan_Reclassification_Table2
-        
+        @pipe.step([OUT_PLAN_reclass], [PLAN_Focal, Plan_Reclassification_Table],
+                   name="Starting process 3/8: Reclassify PLAN")
+        def plan_reclass():
+                PLAN_reclass = ReclassByTable(PLAN_Focal, Plan_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
+                PLAN_reclass.save(OUT_PLAN_reclass)
 
-if arcpy.Exists(OUT_PLAN_reclass) == False:
-        PLAN_reclass = ReclassByTable(PLAN_Focal, Plan_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
-        PLAN_reclass.save(OUT_PLAN_reclass)
-else:
-        PLAN_reclass = OUT_PLAN_reclass
-        print "PLAN_reclass raster exists"
+        ###########################
+        # 4. Reclassify LITH
 
-###########################
-# 4. Reclassify LITH
-print "Starting process 4/8: Reclassify LITH"
-if arcpy.Exists(OUT_LITH_reclass) == False:
-        LITH_reclass = ReclassByTable(FSP_raster_input, Lith_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
-        LITH_reclass.save(OUT_LITH_reclass)
-else:
-        LITH_reclass = Raster(OUT_LITH_reclass)
-        print "LITH_reclass raster exists"
+        @pipe.step([OUT_LITH_reclass], [FSP_raster_input, Lith_Reclassification_Table],
+                   name="Starting process 4/8: Reclassify LITH")
+        def lith_reclass():
+                LITH_reclass = ReclassByTable(FSP_raster_input, Lith_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
+                LITH_reclass.save(OUT_LITH_reclass)
         
-###########################
-# 5. Slope
-print "Starting process 5/8: Slope"
-if arcpy.Exists(OUT_SLOPE) == False:
-        SLOPE = Slope(DEM_raster_input, "PERCENT_RISE", 1.0)
-        SLOPE.save(OUT_SLOPE)
-else:
-        SLOPE = Raster(OUT_SLOPE)
-        print "SLOPE raster exists"
+        ###########################
+        # 5. Slope
 
-###########################
-# 6. Reclassify SLOPE
-print "Starting process 6/8: Reclassify SLOPE"
-if arcpy.Exists(OUT_SLOPE_reclass) == False:
-        SLOPE_reclass = ReclassByTable(SLOPE, Slope_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
-        SLOPE_reclass.save(OUT_SLOPE_reclass)
-else:
-        SLOPE_reclass = Raster(OUT_SLOPE_reclass)
-        print "SLOPE_reclass raster exists"
+        @pipe.step([OUT_SLOPE], [DEM_raster_input], name="Starting process 5/8: Slope")
+        def slope():
+                SLOPE = Slope(DEM_raster_input, "PERCENT_RISE", 1.0)
+                SLOPE.save(OUT_SLOPE)
+
+        ###########################
+        # 6. Reclassify SLOPE
+
+        @pipe.step([OUT_SLOPE_reclass], [OUT_SLOPE, Slope_Reclassification_Table],
+                   name="Starting process 6/8: Reclassify SLOPE")
+        def slope_reclass():
+                SLOPE_reclass = ReclassByTable(OUT_SLOPE, Slope_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
+                SLOPE_reclass.save(OUT_SLOPE_reclass)
         
-###########################
-# 7. Build Raster Codes for SUSCEP (Plus)
-print "Starting process 7/8: Calculate SUSCEP Raster Codes (Plus)"
-if arcpy.Exists(OUT_SUSCEP) == False:
-        SUSCEP = (LITH_reclass + SLOPE_reclass + PLAN_reclass)
-        SUSCEP.save(OUT_SUSCEP)
-        # In arcgis use raster calculator:
-        # arcpy.gp.RasterCalculator_sa("\"%LITH_reclass%\" + \"%SLOPE_reclass%\" + \"%PLAN_reclass%\"", SUSCEP) 
-else:
-        SUSCEP = Raster(OUT_SUSCEP)
-        print "SUSCEP raster exists"
+        ###########################
+        # 7. Build Raster Codes for SUSCEP (Plus)
 
-###########################
-# 8. Reclassify SUSCEP
-print "Starting process 8/8: Reclassify SUSCEP"
-SUSCEP_relcass = ReclassByTable(SUSCEP, Susceptability_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
-SUSCEP_relcass.save(OUT_SUSCEP_reclass)
+        @pipe.step([OUT_SUSCEP], [OUT_LITH_reclass, OUT_SLOPE_reclass, OUT_PLAN_reclass],
+                   name="Starting process 7/8: Calculate SUSCEP Raster Codes (Plus)")
+        def suscep():
+                SUSCEP = (Raster(OUT_LITH_reclass) + Raster(OUT_SLOPE_reclass) + Raster(OUT_PLAN_reclass))
+                SUSCEP.save(OUT_SUSCEP)
+                # In arcgis use raster calculator:
+                # arcpy.gp.RasterCalculator_sa("\"%LITH_reclass%\" + \"%SLOPE_reclass%\" + \"%PLAN_reclass%\"", SUSCEP) 
+
+        ###########################
+        # 8. Reclassify SUSCEP
+
+        @pipe.step([OUT_SUSCEP_reclass], [OUT_SUSCEP, Susceptability_Reclassification_Table],
+                   name="Starting process 8/8: Reclassify SUSCEP")
+        def suscep_reclass():
+                SUSCEP_relcass = ReclassByTable(OUT_SUSCEP, Susceptability_Reclassification_Table, "FROM", "TO", "OUT", "DATA")
+                SUSCEP_relcass.save(OUT_SUSCEP_reclass)
+
+pipe.run()
 
 endTime = time.time()
 Elapsed_MIN = (endTime - startTime) / 60
 print "All processes complete in {0} minutes".format(Elapsed_MIN)
-print "END ShallowLandslide_py v{0}: {1}".format(ver, (time.ctime(endTime))
+print "END ShallowLandslide_py v{0}: {1}".format(ver, time.ctime(endTime))
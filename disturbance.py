@@ -43,12 +43,19 @@ ftp://ftp.fsl.orst.edu/pub/landtrendr/nwfp_disturbance_03012011/
 # Import modules
 from __future__ import print_function
 import arcpy
+import numpy
+import os
 from arcpy import env
 
 # Check out Spatial Analyst
 arcpy.CheckOutExtension("spatial")
 from arcpy.sa import *
 
+from hydrotools import arcpy_io
+from hydrotools import disturbance
+from hydrotools import pipeline
+from hydrotools import reclass
+
 
 work_dir = r"C:\WorkSpace\Biocriteria\WatershedCharaterization\Disturbance.gdb"
 env.workspace = work_dir
@@ -64,19 +71,59 @@ d_periods = [1, 3, 10]
 # the index years 
 years = range(1996, 2009, 1)
 
-YOD = Raster(path_yod)
-NLCD = Raster(path_nlcd)
 out_disturb1 = env.workspace + "\\Disturbance_ssn"
 
+# Reclassify with hydrotools.reclass instead of Reclassify. Blocks of
+# rows are looked up on reclass_threads threads.
+use_numpy = False
+reclass_threads = 4
+
+# Make every year and period in one pass over Disturbance_ssn into a
+# bit packed cube (hydrotools.disturbance) instead of one raster each.
+# The DISTURB rasters are only saved from the cube with export_rasters.
+use_cube = False
+export_rasters = False
+out_cube = work_dir.replace(".gdb", "") + "_disturb_cube.npy"
+
+# Tabulate the disturbed area of every year and period by RID in one
+# pass over Disturbance_ssn and the RCA and RSA zones, into one table
+# with a field for each (DISRCA_1YR_1996, ...) that LSN_Clean_Tables.py
+# joins to the edges, in place of TabulateArea of each DISTURB raster.
+tabulate_rids = False
+path_rca = r"C:\WorkSpace\Biocriteria\WatershedCharaterization\SSN\Hydro\Hydro.gdb\RCA_RID_30m"
+path_rsa = r"C:\WorkSpace\Biocriteria\WatershedCharaterization\SSN\Hydro\Hydro.gdb\RSA_SSN_RID_30m"
+out_disturb_table = env.workspace + "\\tbl_DISTURB_sqm_by_RID"
+
+# saves a hash of the inputs and settings used to make each output so
+# only the rasters affected by a change are made again
+manifest = work_dir.replace(".gdb", "") + "_manifest.json"
+
 # Set env settings
 env.overwriteOutput = True
 env.cellSize = path_nlcd
 env.snapRaster = path_nlcd
 env.extent = path_nlcd
 
+def exists(path):
+    """arcpy.Exists that also finds the cube .npy file"""
+    return os.path.isfile(path) or arcpy.Exists(path)
+
+def delete(path):
+    """Deletes a dataset or the cube .npy file"""
+    if os.path.isfile(path):
+        os.remove(path)
+    else:
+        arcpy.Delete_management(path)
+
+pipe = pipeline.Pipeline(manifest, exists=exists,
+                         fingerprint=arcpy_io.fingerprint,
+                         delete=delete)
+
 # -- Combine YOD and NLCD
-if not arcpy.Exists(out_disturb1):
-    print("combine YOD and NLCD")
+@pipe.step([out_disturb1], [path_yod, path_nlcd], name="combine YOD and NLCD")
+def combine():
+    YOD = Raster(path_yod)
+    NLCD = Raster(path_nlcd)
     
     # YOD = 0 means it was not classifed because there was no change
     DISTURB1 = Con(YOD == 0,
@@ -84,29 +131,90 @@ if not arcpy.Exists(out_disturb1):
                        in_false_raster_or_constant=YOD)    
 
     DISTURB1.save(out_disturb1)
-    
-else:
-    DISTURB1 = Raster(out_disturb1)
-
-for year in years:
-    for d_period in d_periods:
-        
-        out_disturb2 = "DISTURB_{0}yr_{1}".format(d_period, year)
-        if not arcpy.Exists(out_disturb2):
-            print("processing {0}".format(out_disturb2))
-            
-            rc_table = RemapRange([[0, 10, 1],
-                                   [10, 100, "NODATA"],
-                                   [1984, year - d_period, "NODATA"], 
-                                   [year - d_period, year, 1],
-                                   [year, 2009, "NODATA"]
-                                   ])
-        
-            DISTURB2 = Reclassify(in_raster=DISTURB1,
-                                  reclass_field="Value",
-                                  remap=rc_table, 
-                                  missing_values="NODATA")
-            
-            DISTURB2.save(out_disturb2)
 
+def disturb_raster(year, d_period):
+    """Returns the path of the disturbance raster for one index year
+    and period"""
+    return env.workspace + "\\DISTURB_{0}yr_{1}".format(d_period, year)
 
+def add_disturb(year, d_period):
+    """Adds the step making the disturbance raster for one index year
+    and period"""
+    
+    out_disturb2 = disturb_raster(year, d_period)
+    
+    @pipe.step([out_disturb2], [out_disturb1],
+               {"year": year, "d_period": d_period},
+               name="processing {0}".format(os.path.basename(out_disturb2)))
+    def disturb():
+        rc_table = [[0, 10, 1],
+                    [10, 100, "NODATA"],
+                    [1984, year - d_period, "NODATA"],
+                    [year - d_period, year, 1],
+                    [year, 2009, "NODATA"]
+                    ]
+
+        if use_numpy:
+            # NoData is read as -1, which is not in any range
+            src = arcpy_io.RasterArray(out_disturb1, -1)
+            DISTURB2 = numpy.empty(src.shape, dtype=numpy.int32)
+            reclass.reclassify_blocks(src, DISTURB2, rc_table, "NODATA",
+                                      nodata=-1, threads=reclass_threads)
+            arcpy_io.array_to_raster(DISTURB2, out_disturb2, out_disturb1, -1)
+            return
+
+        DISTURB2 = Reclassify(in_raster=Raster(out_disturb1),
+                              reclass_field="Value",
+                              remap=RemapRange(rc_table),
+                              missing_values="NODATA")
+        
+        DISTURB2.save(out_disturb2)
+
+def add_export(k, year, d_period):
+    """Adds the step saving band k of the cube as the disturbance
+    raster for one index year and period"""
+
+    out_disturb2 = disturb_raster(year, d_period)
+
+    @pipe.step([out_disturb2], [out_cube], {"band": k},
+               name="exporting {0}".format(os.path.basename(out_disturb2)))
+    def export():
+        packed = numpy.load(out_cube, mmap_mode="r")
+        DISTURB2 = numpy.where(disturbance.band(packed, k), 1, -1).astype(numpy.int32)
+        del packed
+        arcpy_io.array_to_raster(DISTURB2, out_disturb2, out_disturb1, -1)
+
+if use_cube:
+    @pipe.step([out_cube], [out_disturb1],
+               {"years": list(years), "d_periods": d_periods},
+               name="disturbance cube")
+    def make_cube():
+        # NoData is read as -1, which is never disturbed
+        disturbance.cube(arcpy_io.RasterArray(out_disturb1, -1), out_cube,
+                         years, d_periods)
+
+    if export_rasters:
+        for k, (year, d_period) in enumerate(disturbance.bands(years, d_periods)):
+            add_export(k, year, d_period)
+else:
+    for year in years:
+        for d_period in d_periods:
+            add_disturb(year, d_period)
+
+if tabulate_rids:
+    @pipe.step([out_disturb_table], [out_disturb1, path_rca, path_rsa],
+               {"years": list(years), "d_periods": d_periods},
+               name="tabulate disturbance by RID")
+    def tabulate():
+        # NoData is read as -1, which is never disturbed or a RID
+        src = arcpy_io.RasterArray(out_disturb1, -1)
+        zones = [arcpy_io.RasterArray(path, -1, template=out_disturb1)
+                 for path in [path_rca, path_rsa]]
+        cell = arcpy.Raster(out_disturb1)
+        rids, areas = disturbance.tabulate(src, zones, years, d_periods,
+                                           cell.meanCellWidth * cell.meanCellHeight)
+        names = disturbance.field_names(["RCA", "RSA"], years, d_periods)
+        arcpy.da.NumPyArrayToTable(disturbance.table(rids, areas, names),
+                                   out_disturb_table)
+
+pipe.run()
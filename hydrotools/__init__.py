@@ -0,0 +1,7 @@
+"""
+NumPy implementations of the raster hydrology steps used by the SSN,
+Dilution and related scripts in this repository. The modules work on
+plain numpy arrays so the hydro chain can run without an ArcGIS
+license. Reading and writing rasters is handled by raster_io (GDAL)
+or arcpy_io (ArcGIS geodatabases).
+"""
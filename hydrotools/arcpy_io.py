@@ -0,0 +1,207 @@
+"""
+arcpy helpers to move geodatabase rasters in and out of numpy arrays.
+"""
+
+from __future__ import print_function
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy
+import arcpy
+
+# MosaicToNewRaster pixel types of numpy dtypes
+pixel_types = {numpy.dtype(numpy.uint8): "8_BIT_UNSIGNED",
+               numpy.dtype(numpy.int8): "8_BIT_SIGNED",
+               numpy.dtype(numpy.uint16): "16_BIT_UNSIGNED",
+               numpy.dtype(numpy.int16): "16_BIT_SIGNED",
+               numpy.dtype(numpy.uint32): "32_BIT_UNSIGNED",
+               numpy.dtype(numpy.int32): "32_BIT_SIGNED",
+               numpy.dtype(numpy.float32): "32_BIT_FLOAT",
+               numpy.dtype(numpy.float64): "64_BIT"}
+
+
+def raster_to_array(raster, nodata=numpy.nan):
+    """Returns a raster as a numpy array. NoData cells are set to
+    nodata. The default of nan returns a float64 array."""
+    r = arcpy.Raster(raster)
+    if not (isinstance(nodata, float) and numpy.isnan(nodata)):
+        return arcpy.RasterToNumPyArray(r, nodata_to_value=nodata)
+    if not r.isInteger:
+        return arcpy.RasterToNumPyArray(
+            r, nodata_to_value=numpy.nan).astype(numpy.float64)
+
+    # integer rasters can't hold nan so flag NoData first
+    flag = r.minimum - 1
+    arry = arcpy.RasterToNumPyArray(r, nodata_to_value=flag)
+    arry = arry.astype(numpy.float64)
+    arry[arry == flag] = numpy.nan
+    return arry
+
+
+def field_to_array(raster, field):
+    """Returns an integer raster as a float64 array of the values in
+    one of its attribute table fields, like Lookup. Cells with NoData
+    or a value not in the table are nan."""
+    arry = raster_to_array(raster)
+    with arcpy.da.SearchCursor(raster, ["Value", field]) as rows:
+        table = sorted(rows)
+    values = numpy.array([row[0] for row in table], dtype=numpy.float64)
+    lookup = numpy.array([numpy.nan if row[1] is None else row[1]
+                          for row in table], dtype=numpy.float64)
+
+    out = numpy.full(arry.shape, numpy.nan)
+    valid = ~numpy.isnan(arry)
+    if values.size:
+        cells = arry[valid]
+        pos = numpy.minimum(numpy.searchsorted(values, cells), values.size - 1)
+        found = numpy.where(values[pos] == cells, lookup[pos], numpy.nan)
+        out[valid] = found
+    return out
+
+
+def array_to_raster(arry, out_raster, template, nodata=None, sr=None):
+    """Saves a numpy array as a raster aligned to the template raster.
+    nan values in float arrays are written as NoData."""
+    desc = arcpy.Describe(template)
+    lower_left = arcpy.Point(desc.extent.XMin, desc.extent.YMin)
+    if nodata is None and arry.dtype.kind == "f":
+        out = arcpy.NumPyArrayToRaster(arry, lower_left,
+                                       desc.meanCellWidth,
+                                       desc.meanCellHeight)
+    else:
+        out = arcpy.NumPyArrayToRaster(arry, lower_left,
+                                       desc.meanCellWidth,
+                                       desc.meanCellHeight, nodata)
+    out.save(out_raster)
+
+    if sr is None:
+        sr = desc.spatialReference
+    arcpy.DefineProjection_management(out_raster, sr)
+
+
+def npy_to_raster(arry, out_raster, template, nodata=None, sr=None,
+                  block_rows=1024, dtype=None):
+    """Saves a 2d array that doesn't fit in memory, e.g. a numpy
+    memmap from hydrotools.tiled, as a raster aligned to the template
+    raster. block_rows rows at a time are saved to a temporary raster
+    in the scratch folder and the blocks are mosaicked into
+    out_raster, so the whole array is never read at once. nan values
+    in float arrays are written as NoData. With dtype each block is
+    cast to dtype with nan set to nodata first, e.g. to save a float
+    array as an integer raster with -1 as NoData."""
+    desc = arcpy.Describe(template)
+    if sr is None:
+        sr = desc.spatialReference
+    dtype = numpy.dtype(dtype or arry.dtype)
+    rows = arry.shape[0]
+    blocks_dir = tempfile.mkdtemp(dir=arcpy.env.scratchFolder)
+    blocks = []
+    try:
+        for r0 in range(0, rows, block_rows):
+            r1 = min(r0 + block_rows, rows)
+            block = os.path.join(blocks_dir, "b{0}.tif".format(len(blocks)))
+            lower_left = arcpy.Point(desc.extent.XMin,
+                                     desc.extent.YMax - r1 * desc.meanCellHeight)
+            data = numpy.asarray(arry[r0:r1, :])
+            if data.dtype != dtype:
+                if nodata is not None and data.dtype.kind == "f":
+                    data = numpy.where(numpy.isnan(data), nodata, data)
+                data = data.astype(dtype)
+            if nodata is None and data.dtype.kind == "f":
+                out = arcpy.NumPyArrayToRaster(data, lower_left,
+                                               desc.meanCellWidth,
+                                               desc.meanCellHeight)
+            else:
+                out = arcpy.NumPyArrayToRaster(data, lower_left,
+                                               desc.meanCellWidth,
+                                               desc.meanCellHeight, nodata)
+            out.save(block)
+            del out, data
+            blocks.append(block)
+        arcpy.MosaicToNewRaster_management(";".join(blocks),
+                                           os.path.dirname(out_raster),
+                                           os.path.basename(out_raster), sr,
+                                           pixel_types[dtype],
+                                           desc.meanCellWidth, 1)
+    finally:
+        for block in blocks:
+            arcpy.Delete_management(block)
+        shutil.rmtree(blocks_dir, ignore_errors=True)
+
+
+def fingerprint(dataset):
+    """Returns a summary of a dataset that changes when its contents
+    change, for pipeline.Pipeline. Rasters are summarized by their
+    extent, cell size and statistics and feature classes by their
+    extent and row count. Tables (e.g. reclass tables) are small, so
+    their rows are hashed and an edit to any value is picked up.
+    Returns None if the dataset doesn't exist."""
+    if not arcpy.Exists(dataset):
+        return None
+    desc = arcpy.Describe(dataset)
+    out = [desc.dataType]
+    if hasattr(desc, "extent"):
+        e = desc.extent
+        out.append([e.XMin, e.YMin, e.XMax, e.YMax])
+    if desc.dataType in ("RasterDataset", "RasterBand"):
+        r = arcpy.Raster(dataset)
+        out.append([r.meanCellWidth, r.width, r.height, r.minimum,
+                    r.maximum, r.mean, r.standardDeviation])
+    elif desc.dataType in ("Table", "DbaseTable"):
+        fields = [f.name for f in arcpy.ListFields(dataset)
+                  if f.type not in ("OID", "Geometry", "Blob", "Raster")]
+        sha = hashlib.sha1()
+        with arcpy.da.SearchCursor(dataset, fields) as rows:
+            for row in rows:
+                sha.update(repr(row).encode("utf-8"))
+        out.append([fields, sha.hexdigest()])
+    elif desc.dataType in ("FeatureClass", "ShapeFile"):
+        out.append(int(arcpy.GetCount_management(dataset).getOutput(0)))
+    return out
+
+
+class RasterArray(object):
+    """
+    Read only wrapper around a raster so windows can be read with
+    numpy style slicing, e.g. raster[0:512, 1024:1536]. NoData is
+    returned as nodata. The default of nan is meant for floating point
+    rasters like DEMs. With a template raster the windows are read on
+    the template's grid, so a raster snapped to the template but with
+    a different extent lines up with it.
+    """
+
+    def __init__(self, raster, nodata=numpy.nan, template=None):
+        self.raster = arcpy.Raster(raster)
+        grid = self.raster if template is None else arcpy.Raster(template)
+        self.extent = grid.extent
+        self.cellsize = (grid.meanCellWidth, grid.meanCellHeight)
+        self.shape = (grid.height, grid.width)
+        self.fill = nodata
+        self.nodata = None if numpy.isnan(nodata) else nodata
+
+    def __getitem__(self, key):
+        rows, cols = key
+        r0, r1, step = rows.indices(self.shape[0])
+        c0, c1, step = cols.indices(self.shape[1])
+        lower_left = arcpy.Point(self.extent.XMin + c0 * self.cellsize[0],
+                                 self.extent.YMax - r1 * self.cellsize[1])
+        return arcpy.RasterToNumPyArray(self.raster, lower_left, c1 - c0,
+                                        r1 - r0, self.fill)
+
+
+def raster_to_npy(raster, out_npy, dtype=numpy.float32, nodata=numpy.nan,
+                  block_rows=1024, template=None):
+    """Copies a raster to a .npy file block by block so it can be
+    opened as a memory map, e.g. by hydrotools.tiled. NoData cells
+    are set to nodata. With a template raster the raster is copied on
+    the template's grid (see RasterArray). Returns out_npy."""
+    src = RasterArray(raster, nodata, template)
+    out = numpy.lib.format.open_memmap(out_npy, mode="w+", dtype=dtype,
+                                       shape=src.shape)
+    for r0 in range(0, src.shape[0], block_rows):
+        r1 = min(r0 + block_rows, src.shape[0])
+        out[r0:r1, :] = src[r0:r1, :]
+    out.flush()
+    del out
+    return out_npy
@@ -0,0 +1,110 @@
+"""
+Batch version of the SSN_attributes.py products. Makes the REACH,
+AREACH, RCA, ARCA, RSA, and ARSA rasters for a stack of attribute
+arrays at once. Every flow accumulation that shares a flow direction
+is done in one sweep and each zone raster is indexed once for all
+attributes.
+"""
+
+from __future__ import division, print_function
+from multiprocessing.pool import ThreadPool
+import numpy
+
+from hydrotools import d8
+from hydrotools import zonal
+
+products = ["reach", "areach", "rca", "arca", "rsa", "arsa"]
+
+# hydro raster names in the hydro geodatabase, keyed by the names
+# used in attribute_products
+hydro_rasters = {"fac_rca": "fac_rca",
+                 "fac_rsa": "fac_rsa_euc",
+                 "fac_reach": "fac_reach",
+                 "fac_arca": "fac_arca",
+                 "fac_arsa": "fac_arsa_euc",
+                 "fac_areach": "fac_areach",
+                 "reach_weight": "stream1",
+                 "rsa_weight": "rsa_euc_weight",
+                 "outlets": "outlets2",
+                 "catchment": "catchment",
+                 "rsa_zones": "rsa_euc_zone",
+                 "stream_segs": "stream_seg"}
+
+fdr_rasters = {"fdr": "fdr",
+               "fdr_rsa": "fdr_euc",
+               "fdr_outlet": "fdr_outlet",
+               "fdr_rsa_outlet": "fdr_euc_outlet"}
+
+
+def attribute_products(attrs, hydro, graphs):
+    """Returns a dictionary of the six SSN attribute products for a
+    (layers, rows, cols) stack of attribute arrays. hydro is a
+    dictionary of the arrays in hydro_rasters (NoData as nan) and
+    graphs a dictionary of flowgraph.FlowGraph for the flow directions
+    in fdr_rasters. Each product is a (layers, rows, cols) array."""
+
+    attrs = numpy.asarray(attrs, dtype=numpy.float64)
+    k = attrs.shape[0]
+    shape = attrs.shape
+    a = attrs.reshape(k, -1)
+    h = dict((key, numpy.asarray(value, dtype=numpy.float64).ravel())
+             for key, value in hydro.items())
+
+    # REACH, the mean of all the cells on each reach
+    reach = zonal.Zones(h["stream_segs"]).mean(a)
+
+    # AREACH and ARCA share the same flow direction
+    acc = _accumulate(graphs["fdr"],
+                      numpy.vstack([reach * h["reach_weight"], a]))
+    areach = _divide(acc[:k] + reach, h["fac_areach"])
+    arca = _divide(acc[k:] + a, h["fac_arca"])
+
+    acc = _accumulate(graphs["fdr_outlet"], a)
+    rca = _divide(acc + a, h["fac_rca"])
+    _fill_outlets(rca, a, h["catchment"], h["outlets"])
+
+    acc = _accumulate(graphs["fdr_rsa_outlet"], a * h["rsa_weight"])
+    rsa = _divide(acc + a, h["fac_rsa"])
+    _fill_outlets(rsa, a, h["rsa_zones"], h["outlets"])
+
+    acc = _accumulate(graphs["fdr_rsa"], a * h["rsa_weight"])
+    arsa = _divide(acc + a, h["fac_arsa"])
+
+    out = {"reach": reach, "areach": areach, "rca": rca,
+           "arca": arca, "rsa": rsa, "arsa": arsa}
+    return dict((key, value.reshape(shape)) for key, value in out.items())
+
+
+def _accumulate(graph, weights):
+    """Flow accumulation of a (layers, cells) weight stack"""
+    acc = d8.flow_accumulation_stack(None, weights, graph=graph)
+    return acc.reshape(weights.shape)
+
+
+def _divide(num, den):
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return num / den
+
+
+def _fill_outlets(out, values, zones, outlets):
+    """Sets the outlet cells to the zonal mean of their zone. The
+    outlet cells have NoData flow direction so they don't accumulate."""
+    is_outlet = outlets == 1
+    zmean = zonal.Zones(zones).mean(values)
+    out[:, is_outlet] = zmean[:, is_outlet]
+
+
+def write_products(jobs, write, threads=1):
+    """Writes (array, output) jobs with write(array, output), one at a
+    time or on a pool of threads. Only use threads if write is thread
+    safe (arcpy_io.array_to_raster is not)."""
+    if threads <= 1:
+        for job in jobs:
+            write(*job)
+        return
+    pool = ThreadPool(threads)
+    try:
+        pool.map(lambda job: write(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,275 @@
+"""
+D8 flow direction and flow accumulation on numpy arrays.
+
+Flow directions use the ESRI/ArcHydro encoding:
+
+    32  64 128
+    16   x   1
+     8   4   2
+
+Cells that do not drain anywhere (NoData or unresolved pits) have no
+downstream cell. Accumulation is done in topological order, one
+"wave" of cells at a time, so each wave is a single vectorized
+operation instead of a per-cell python loop.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+# ESRI direction codes in the order they are tested.
+# Ties between equally steep directions go to the first code.
+d8_codes = numpy.array([1, 2, 4, 8, 16, 32, 64, 128])
+d8_row = numpy.array([0, 1, 1, 1, 0, -1, -1, -1])
+d8_col = numpy.array([1, 1, 0, -1, -1, -1, 0, 1])
+d8_diagonal = numpy.array([False, True, False, True,
+                           False, True, False, True])
+
+# NoData value used for uint8 flow direction outputs
+FDR_NODATA = 255
+
+
+def valid_cells(arry, nodata):
+    """Returns a boolean array of cells that are not NoData"""
+    valid = numpy.ones(arry.shape, dtype=bool)
+    if arry.dtype.kind == "f":
+        valid &= ~numpy.isnan(arry)
+    if nodata is not None:
+        valid &= arry != nodata
+    return valid
+
+
+def _shift(arry, dr, dc, fill):
+    """Returns an array where each cell holds the value of the
+    neighbor at row + dr, col + dc. Off grid neighbors get fill."""
+    out = numpy.full(arry.shape, fill, dtype=arry.dtype)
+    rows, cols = arry.shape
+    out[max(0, -dr):rows - max(0, dr), max(0, -dc):cols - max(0, dc)] = \
+        arry[max(0, dr):rows - max(0, -dr), max(0, dc):cols - max(0, -dc)]
+    return out
+
+
+def flow_direction(dem, cellsize=1.0, nodata=None, force_edge=False):
+    """Returns a uint8 D8 flow direction array for a filled DEM.
+
+    Each cell drains to the neighbor with the steepest distance
+    weighted drop. Cells on the grid edge or next to NoData drain
+    outward when there is no drop to an interior neighbor, or always
+    if force_edge is True. Flat areas drain toward their lowest
+    outflow cell. Cells that can't drain anywhere are 0 and NoData
+    cells are FDR_NODATA."""
+
+    dem = numpy.asarray(dem, dtype=numpy.float64)
+    valid = valid_cells(dem, nodata)
+    z = numpy.where(valid, dem, numpy.nan)
+
+    rows, cols = z.shape
+    fdr = numpy.zeros(z.shape, dtype=numpy.uint8)
+    max_drop = numpy.full(z.shape, -numpy.inf)
+    edge = numpy.zeros(z.shape, dtype=numpy.uint8)
+    diag = cellsize * numpy.sqrt(2.0)
+
+    with numpy.errstate(invalid="ignore"):
+        for k in range(8):
+            nb = _shift(z, d8_row[k], d8_col[k], numpy.nan)
+            off = numpy.isnan(nb) & valid
+            # keep the first outward direction for edge cells
+            edge[(edge == 0) & off] = d8_codes[k]
+
+            drop = (z - nb) / (diag if d8_diagonal[k] else cellsize)
+            steeper = drop > max_drop
+            fdr[steeper & (drop > 0)] = d8_codes[k]
+            max_drop[steeper] = drop[steeper]
+
+    if force_edge:
+        fdr[edge > 0] = edge[edge > 0]
+    else:
+        outward = (edge > 0) & (max_drop <= 0)
+        fdr[outward] = edge[outward]
+
+    # flat cells have an equal neighbor but no lower one
+    flats = numpy.flatnonzero(valid & (fdr == 0) & (max_drop == 0))
+    if flats.size:
+        _resolve_flats(z, fdr, flats)
+
+    fdr[~valid] = FDR_NODATA
+    return fdr
+
+
+def _resolve_flats(z, fdr, flats):
+    """Drains flat cells toward the nearest cell of equal elevation
+    that already has a flow direction. Works outward from the flat
+    outlets one ring at a time, updating fdr in place."""
+
+    rows, cols = z.shape
+    zf = z.ravel()
+    ff = fdr.ravel()
+    r = flats // cols
+    c = flats % cols
+
+    while flats.size:
+        resolved = numpy.zeros(flats.size, dtype=bool)
+        codes = numpy.zeros(flats.size, dtype=numpy.uint8)
+        for k in range(8):
+            nr = r + d8_row[k]
+            nc = c + d8_col[k]
+            inside = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+            nb = numpy.where(inside, nr * cols + nc, 0)
+            hit = (inside & ~resolved & (ff[nb] > 0) & (ff[nb] != FDR_NODATA) &
+                   (zf[nb] == zf[flats]))
+            codes[hit] = d8_codes[k]
+            resolved |= hit
+
+        if not resolved.any():
+            break
+        ff[flats[resolved]] = codes[resolved]
+        keep = ~resolved
+        flats, r, c = flats[keep], r[keep], c[keep]
+
+
+def downstream_index(fdr, nodata=FDR_NODATA):
+    """Returns a flat int64 array with the flat index of the cell each
+    cell drains to, or -1 if it drains off the grid, into NoData, or
+    nowhere."""
+
+    fdr = numpy.asarray(fdr)
+    rows, cols = fdr.shape
+    f = fdr.ravel()
+    valid = valid_cells(f, nodata)
+
+    down = numpy.full(f.size, -1, dtype=numpy.int64)
+    idx = numpy.arange(f.size, dtype=numpy.int64)
+    r = idx // cols
+    c = idx % cols
+    for k in range(8):
+        sel = valid & (f == d8_codes[k])
+        nr = r[sel] + d8_row[k]
+        nc = c[sel] + d8_col[k]
+        inside = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+        down[idx[sel][inside]] = nr[inside] * cols + nc[inside]
+
+    # flow into NoData goes nowhere
+    into = down >= 0
+    into[into] = ~valid[down[into]]
+    down[into] = -1
+    return down
+
+
+def topological_order(down):
+    """Orders every cell that has a downstream cell so that all of a
+    cell's upstream neighbors come before it. Returns the ordered flat
+    indices and the offsets of each wave in that order. Within a wave
+    cells are sorted by their downstream cell. Cells caught in a flow
+    loop are left out."""
+
+    down = numpy.asarray(down)
+    n = down.size
+    has_down = down >= 0
+    indegree = numpy.bincount(down[has_down], minlength=n)
+    frontier = numpy.flatnonzero(indegree == 0)
+
+    waves = []
+    offsets = [0]
+    while frontier.size:
+        frontier = frontier[has_down[frontier]]
+        if not frontier.size:
+            break
+        d = down[frontier]
+        sort = numpy.argsort(d, kind="mergesort")
+        frontier = frontier[sort]
+        d = d[sort]
+        waves.append(frontier)
+        offsets.append(offsets[-1] + frontier.size)
+
+        targets, counts = numpy.unique(d, return_counts=True)
+        indegree[targets] -= counts
+        frontier = targets[indegree[targets] == 0]
+
+    if waves:
+        order = numpy.concatenate(waves)
+    else:
+        order = numpy.zeros(0, dtype=numpy.int64)
+    return order, numpy.array(offsets, dtype=numpy.int64)
+
+
+def _sweep(total, down, order, offsets, active=None):
+    """Adds each cell's total to its downstream cell in topological
+    order. total is a (layers, cells) array and is updated in place.
+    If active is given, a layer only passes flow from a cell where
+    active is True."""
+    for w in range(offsets.size - 1):
+        seg = order[offsets[w]:offsets[w + 1]]
+        d = down[seg]
+        starts = numpy.flatnonzero(numpy.r_[True, d[1:] != d[:-1]])
+        flow = total[:, seg]
+        if active is not None:
+            flow = flow * active[:, seg]
+        total[:, d[starts]] += numpy.add.reduceat(flow, starts, axis=1)
+    return total
+
+
+def _graph(fdr, nodata, graph):
+    """Returns the shape, valid cells, downstream index, order and
+    wave offsets from a flowgraph.FlowGraph, or builds them from the
+    flow direction array if graph is None"""
+    if graph is not None:
+        return (graph.shape, graph.valid, graph.down,
+                graph.order, graph.offsets)
+    fdr = numpy.asarray(fdr)
+    down = downstream_index(fdr, nodata)
+    order, offsets = topological_order(down)
+    return fdr.shape, valid_cells(fdr, nodata).ravel(), down, order, offsets
+
+
+def flow_accumulation_stack(fdr, weights, masks=None, nodata=FDR_NODATA,
+                            graph=None):
+    """Accumulates a stack of weight arrays over one flow direction
+    array in a single pass. weights is a sequence of 2d arrays (None
+    for an unweighted count) or a 3d array. masks is an optional
+    sequence of boolean arrays, one per weight, marking the cells flow
+    can pass through. This is the same as using Times(FDR, mask) as the
+    flow direction in ArcGIS. A cached flowgraph.FlowGraph can be
+    passed instead of fdr. Returns a (layers, rows, cols) float64
+    array. nan weights add nothing and cells with NoData flow direction
+    or outside the mask are nan."""
+
+    shape, valid, down, order, offsets = _graph(fdr, nodata, graph)
+    size = valid.size
+
+    w = numpy.empty((len(weights), size), dtype=numpy.float64)
+    for k, weight in enumerate(weights):
+        if weight is None:
+            w[k] = valid
+        else:
+            w[k] = numpy.asarray(weight, dtype=numpy.float64).ravel()
+    w[numpy.isnan(w)] = 0.0
+
+    active = None
+    outside = None
+    if masks is not None:
+        active = numpy.ones(w.shape, dtype=bool)
+        for k, mask in enumerate(masks):
+            if mask is not None:
+                active[k] = numpy.asarray(mask, dtype=bool).ravel()
+        outside = ~active
+        # flow into a masked cell is lost
+        has_down = down >= 0
+        active[:, has_down] &= active[:, down[has_down]]
+
+    total = _sweep(w.copy(), down, order, offsets, active)
+    fac = total - w
+    fac[:, ~valid] = numpy.nan
+    if outside is not None:
+        fac[outside] = numpy.nan
+    return fac.reshape((len(weights),) + tuple(shape))
+
+
+def flow_accumulation(fdr, weight=None, mask=None, nodata=FDR_NODATA,
+                      graph=None):
+    """Returns a float64 flow accumulation array. Each cell holds the
+    number of upstream cells that drain through it, or the sum of
+    their weights if a weight array is given. The cell itself is not
+    included, matching ArcGIS. NoData flow direction cells are nan.
+    See flow_accumulation_stack for mask and graph."""
+
+    masks = None if mask is None else [mask]
+    return flow_accumulation_stack(fdr, [weight], masks, nodata, graph)[0]
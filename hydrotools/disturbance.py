@@ -0,0 +1,145 @@
+"""
+Disturbance rasters for every index year and period in one pass (see
+disturbance.py), in place of one Reclassify per year and period. Each
+block of the combined YOD/NLCD raster is read once and compared with
+all the (year, period) rules at the same time. The result is one cube
+with a bit per band, packed 8 bands to a byte along the first axis, so
+39 bands take 5 bytes a cell. tabulate sums the disturbed area of
+every band by RID in the same pass, without making the cube.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+# NLCD percent canopy cover counted as disturbed in every year
+canopy = (0, 10)
+
+
+def bands(years, d_periods):
+    """Returns the (year, period) of each band of the cube"""
+    return [(year, d_period) for year in years for d_period in d_periods]
+
+
+def disturbed(arry, years, d_periods):
+    """Returns a (bands, rows, cols) boolean stack that is True where a
+    cell is disturbed for each band. The same as Reclassify with
+    missing NODATA and RemapRange([[0, 10, 1], [10, 100, "NODATA"],
+    [1984, year - d_period, "NODATA"], [year - d_period, year, 1],
+    [year, 2009, "NODATA"]]), where a value on a boundary gets the
+    lower range, so a cell is disturbed if it is 0 to 10 or
+    year - d_period < value <= year."""
+    table = numpy.array(bands(years, d_periods), dtype=numpy.float64)
+    year = table[:, 0, None, None]
+    start = year - table[:, 1, None, None]
+    v = numpy.asarray(arry, dtype=numpy.float64)[None]
+    with numpy.errstate(invalid="ignore"):
+        low = (v >= canopy[0]) & (v <= canopy[1])
+        return low | ((v > start) & (v <= year))
+
+
+def cube(source, out_npy, years, d_periods, block_rows=256):
+    """Writes the packed disturbance cube of source (sliced like a 2d
+    array, e.g. arcpy_io.RasterArray) to a .npy file of shape
+    (bytes, rows, cols). Each block of source is read once. Returns
+    out_npy."""
+    n = len(bands(years, d_periods))
+    rows, cols = source.shape
+    out = numpy.lib.format.open_memmap(out_npy, mode="w+", dtype=numpy.uint8,
+                                       shape=((n + 7) // 8, rows, cols))
+    for r0 in range(0, rows, block_rows):
+        r1 = min(r0 + block_rows, rows)
+        block = numpy.asarray(source[r0:r1, :])
+        out[:, r0:r1, :] = numpy.packbits(disturbed(block, years, d_periods),
+                                          axis=0)
+    out.flush()
+    del out
+    return out_npy
+
+
+def band(packed, k):
+    """Returns band k of a packed cube as a boolean array without
+    unpacking the other bands"""
+    return (packed[k // 8] >> (7 - k % 8)) & 1 == 1
+
+
+def unpack(packed, n):
+    """Returns the first n bands of a packed cube as a boolean stack"""
+    return numpy.unpackbits(packed, axis=0)[:n].astype(bool)
+
+
+def field_names(zone_names, years, d_periods):
+    """Returns the field name of each column from tabulate, e.g.
+    DISRCA_1YR_1996, in the order LSN_Clean_Tables.py joins them"""
+    return ["DIS{0}_{1}YR_{2}".format(zone, d_period, year)
+            for zone in zone_names for d_period in d_periods
+            for year in years]
+
+
+def _grow(arry, size):
+    """Returns arry padded with zeros to size"""
+    if arry.size >= size:
+        return arry
+    return numpy.r_[arry, numpy.zeros(size - arry.size, dtype=arry.dtype)]
+
+
+def tabulate(source, zones, years, d_periods, cell_area=1.0, block_rows=256):
+    """Returns the RIDs in any of zones and a (RIDs, len(zones) * bands)
+    array of the disturbed area of each RID for every year and period,
+    in the column order of field_names, like TabulateArea of each
+    disturbance raster. source and zones are sliced like 2d arrays and
+    the zones are RID rasters with NoData as a negative value. Each
+    block of every raster is read once and no disturbance raster is
+    made."""
+
+    table = bands(years, d_periods)
+    n = len(table)
+    # the band of each column, by zone then period then year
+    order = [table.index((year, d_period)) for d_period in d_periods
+             for year in years]
+    counts = [numpy.zeros((n, 0)) for zone in zones]
+    seen = numpy.zeros(0, dtype=bool)
+
+    rows = source.shape[0]
+    for r0 in range(0, rows, block_rows):
+        r1 = min(r0 + block_rows, rows)
+        v = numpy.asarray(source[r0:r1, :], dtype=numpy.float64)
+        for i, zone in enumerate(zones):
+            z = numpy.asarray(zone[r0:r1, :])
+            with numpy.errstate(invalid="ignore"):
+                valid = z >= 0
+            ids = z[valid].astype(numpy.int64)
+            if not ids.size:
+                continue
+            size = int(ids.max()) + 1
+            seen = _grow(seen, size)
+            seen[ids] = True
+            if counts[i].shape[1] < size:
+                counts[i] = numpy.hstack([counts[i],
+                                          numpy.zeros((n, size - counts[i].shape[1]))])
+            # the same test as disturbed, one band at a time so the
+            # block is never copied for every band
+            zv = v[valid]
+            with numpy.errstate(invalid="ignore"):
+                low = (zv >= canopy[0]) & (zv <= canopy[1])
+                for k, (year, d_period) in enumerate(table):
+                    hit = low | ((zv > year - d_period) & (zv <= year))
+                    counts[i][k, :size] += numpy.bincount(ids, weights=hit,
+                                                          minlength=size)
+
+    rids = numpy.flatnonzero(seen)
+    out = numpy.zeros((rids.size, len(zones) * n))
+    for i, c in enumerate(counts):
+        c = numpy.hstack([c, numpy.zeros((n, seen.size - c.shape[1]))])
+        out[:, i * n:(i + 1) * n] = c[order][:, rids].T
+    return rids, out * cell_area
+
+
+def table(rids, areas, names):
+    """Returns a numpy structured array with a RID field and a field of
+    areas for each of names, for arcpy.da.NumPyArrayToTable"""
+    dtype = [("RID", numpy.int64)] + [(name, numpy.float64) for name in names]
+    out = numpy.zeros(len(rids), dtype=dtype)
+    out["RID"] = rids
+    for i, name in enumerate(names):
+        out[name] = areas[:, i]
+    return out
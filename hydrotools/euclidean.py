@@ -0,0 +1,184 @@
+"""
+Exact Euclidean distance, allocation and direction to the nearest
+source cell, like EucDistance, EucAllocation and EucDirection, from a
+single distance transform.
+
+The transform is separable (Felzenszwalb and Huttenlocher 2012). The
+first pass finds the nearest source row in each column. The second
+pass takes the lower envelope of the parabolas along each row, with
+all the rows of a block processed together. Both passes keep the
+index of the nearest source so allocation and direction come from
+the same result. With max_distance set only the cells within that
+distance of the sources' bounding box are processed.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+from hydrotools import d8
+from hydrotools import local
+
+# RemapRange from EucDirection degrees to D8 codes, the same as
+# SSN_dem_processing.py. Source cells (0) don't match and stay 0.
+d8_table = [[1, 22.5, 64],
+            [22.5, 67.5, 128],
+            [67.5, 112.5, 1],
+            [112.5, 157.5, 2],
+            [157.5, 202.5, 4],
+            [202.5, 247.5, 8],
+            [247.5, 292.5, 16],
+            [292.5, 337.5, 32],
+            [337.5, 360, 64]]
+
+
+def _nearest_row(sources):
+    """Returns the row of the nearest source above or below each cell
+    in the same column, -1 where the column has no source"""
+    rows = sources.shape[0]
+    r = numpy.arange(rows)[:, None]
+    above = numpy.where(sources, r, -1)
+    numpy.maximum.accumulate(above, axis=0, out=above)
+    below = numpy.where(sources, r, rows * 2 + 1)
+    below = numpy.minimum.accumulate(below[::-1], axis=0)[::-1]
+    out = numpy.where((above >= 0) & (r - above <= below - r), above, below)
+    out[out > rows] = -1
+    return out
+
+
+def _lower_envelope(f):
+    """Returns the 1d squared distance transform of each row of f and
+    the column of the parabola each cell falls under (-1 where the row
+    has no finite value). Every row is stepped through together and
+    the stack of each row is popped with masks."""
+
+    lines, n = f.shape
+    col = numpy.arange(n, dtype=numpy.float64)
+    v = numpy.zeros((lines, n), dtype=numpy.int64)
+    z = numpy.full((lines, n + 1), numpy.inf)
+    k = numpy.full(lines, -1, dtype=numpy.int64)
+
+    def intersect(ls, q):
+        top = v[ls, k[ls]]
+        return (((f[ls, q] + q * q) - (f[ls, top] + col[top] ** 2)) /
+                (2.0 * q - 2.0 * top))
+
+    for q in range(n):
+        ls = numpy.flatnonzero(numpy.isfinite(f[:, q]))
+        if not ls.size:
+            continue
+
+        # pop parabolas hidden by the new one
+        pop = ls[k[ls] >= 0]
+        while pop.size:
+            s = intersect(pop, q)
+            pop = pop[s <= z[pop, k[pop]]]
+            k[pop] -= 1
+            pop = pop[k[pop] >= 0]
+
+        has = k[ls] >= 0
+        s = numpy.full(ls.size, -numpy.inf)
+        s[has] = intersect(ls[has], q)
+        k[ls] += 1
+        v[ls, k[ls]] = q
+        z[ls, k[ls]] = s
+        z[ls, k[ls] + 1] = numpy.inf
+
+    # walk the envelope of each row from left to right
+    d = numpy.full((lines, n), numpy.inf)
+    nearest = numpy.full((lines, n), -1, dtype=numpy.int64)
+    ls = numpy.flatnonzero(k >= 0)
+    j = numpy.zeros(ls.size, dtype=numpy.int64)
+    for q in range(n):
+        step = ls[z[ls, j + 1] < q]
+        while step.size:
+            pos = numpy.searchsorted(ls, step)
+            j[pos] += 1
+            step = step[z[step, j[pos] + 1] < q]
+        top = v[ls, j]
+        d[ls, q] = (q - top) ** 2 + f[ls, top]
+        nearest[ls, q] = top
+    return d, nearest
+
+
+def distance_transform(sources, cellsize=1.0, max_distance=None,
+                       block_rows=1024):
+    """Returns the distance from each cell to the nearest source cell
+    and the flat index of that source. sources is a boolean array or
+    an array where sources are not 0 or nan. Cells farther than
+    max_distance (in the units of cellsize) or with no source are nan
+    with an index of -1."""
+
+    sources = numpy.asarray(sources)
+    if sources.dtype != bool:
+        with numpy.errstate(invalid="ignore"):
+            sources = (sources != 0) & d8.valid_cells(sources, None)
+    rows, cols = sources.shape
+    dist = numpy.full((rows, cols), numpy.nan)
+    nearest = numpy.full((rows, cols), -1, dtype=numpy.int64)
+
+    src_r, src_c = numpy.nonzero(sources)
+    if not src_r.size:
+        return dist, nearest
+
+    # only the cells within max_distance of the sources' bounding box
+    # can be within max_distance of a source
+    if max_distance is None:
+        reach = max(rows, cols)
+    else:
+        reach = int(numpy.floor(max_distance / cellsize))
+    r0 = max(src_r.min() - reach, 0)
+    r1 = min(src_r.max() + reach + 1, rows)
+    c0 = max(src_c.min() - reach, 0)
+    c1 = min(src_c.max() + reach + 1, cols)
+    window = sources[r0:r1, c0:c1]
+
+    near_row = _nearest_row(window)
+    dr = numpy.abs(near_row - numpy.arange(r1 - r0)[:, None]).astype(numpy.float64)
+    dr[(near_row < 0) | (dr > reach)] = numpy.inf
+    f = dr ** 2
+
+    limit = numpy.inf if max_distance is None else (max_distance / cellsize) ** 2
+    for b0 in range(0, r1 - r0, block_rows):
+        b1 = min(b0 + block_rows, r1 - r0)
+        d, near_col = _lower_envelope(f[b0:b1])
+        keep = d <= limit
+        rr, cc = numpy.nonzero(keep)
+        dist[r0 + b0:r0 + b1, c0:c1][keep] = numpy.sqrt(d[keep]) * cellsize
+        nearest[r0 + b0:r0 + b1, c0:c1][keep] = (
+            (r0 + near_row[b0 + rr, near_col[rr, cc]]) * cols +
+            c0 + near_col[rr, cc])
+    return dist, nearest
+
+
+def allocation(values, nearest):
+    """Returns the value of the nearest source of each cell, like
+    EucAllocation. Cells without a source are nan."""
+    values = numpy.asarray(values, dtype=numpy.float64).ravel()
+    out = numpy.full(nearest.shape, numpy.nan)
+    has = nearest >= 0
+    out[has] = values[nearest[has]]
+    return out
+
+
+def direction(nearest):
+    """Returns the compass direction in degrees from each cell to its
+    nearest source, like EucDirection: 90 is east, 360 north and
+    source cells are 0. Cells without a source are nan."""
+    rows, cols = nearest.shape
+    has = nearest >= 0
+    r, c = numpy.nonzero(has)
+    src = nearest[has]
+    dx = (src % cols) - c
+    dy = r - (src // cols)
+    deg = numpy.degrees(numpy.arctan2(dx, dy)) % 360.0
+    deg[deg == 0] = 360.0
+    deg[(dx == 0) & (dy == 0)] = 0.0
+    out = numpy.full(nearest.shape, numpy.nan)
+    out[has] = deg
+    return out
+
+
+def direction_to_d8(degrees):
+    """Returns EucDirection degrees as D8 codes using d8_table. Source
+    cells are 0 and cells without a source nan."""
+    return local.reclass(degrees, d8_table, "DATA")
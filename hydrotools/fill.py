@@ -0,0 +1,347 @@
+"""
+Priority-flood depression filling (Barnes et al. 2014) on numpy
+arrays, with an optional epsilon gradient across filled areas and a
+tiled version (Barnes 2016) for DEMs that don't fit in memory.
+
+Barnes, R., Lehman, C., Mulla, D. 2014. Priority-flood: An optimal
+depression-filling and watershed-labeling algorithm for digital
+elevation models. Computers & Geosciences 62:117-127.
+
+Barnes, R. 2016. Parallel priority-flood depression filling for
+trillion cell digital elevation models on desktops or clusters.
+Computers & Geosciences 96:56-68.
+"""
+
+from __future__ import division, print_function
+import heapq
+from array import array
+from collections import deque
+import numpy
+
+from hydrotools import d8
+from hydrotools import tiled
+
+# label for cells that drain to the DEM edge or NoData
+OCEAN = 0
+
+# peak bytes of memory a tile takes per cell while it is flooded
+# (the tile read, the flood arrays, the heap and the result), used to
+# size the tiles of fill_depressions_tiled
+bytes_per_cell = 64
+
+_offsets = list(zip(d8.d8_row.tolist(), d8.d8_col.tolist()))
+
+
+def _edge_cells(valid, edge_top=True, edge_bottom=True,
+                edge_left=True, edge_right=True):
+    """Returns a boolean array of valid cells that touch NoData or
+    one of the flagged grid edges"""
+    padded = numpy.pad(valid, 1, mode="constant", constant_values=True)
+    if edge_top:
+        padded[0, :] = False
+    if edge_bottom:
+        padded[-1, :] = False
+    if edge_left:
+        padded[:, 0] = False
+    if edge_right:
+        padded[:, -1] = False
+
+    rows, cols = valid.shape
+    touch = numpy.zeros(valid.shape, dtype=bool)
+    for dr, dc in _offsets:
+        touch |= ~padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+    return touch & valid
+
+
+def _flood(z, seeds, seed_z, epsilon=0.0, seed_labels=None):
+    """Priority-flood from the seed cells. Returns the filled
+    elevations, the number of depressions that were filled and, when
+    seed_labels are given, the label of each cell plus a dictionary
+    of the lowest spill elevation between each pair of labels."""
+
+    rows, cols = z.shape
+    z = numpy.ascontiguousarray(z, dtype=numpy.float64)
+    # flat arrays of machine numbers rather than lists of Python
+    # objects, 8 bytes a cell instead of about 32
+    filled = array("d", z.tobytes())
+    closed = bytearray(numpy.isnan(z).ravel().astype(numpy.uint8).tobytes())
+    # cells below the level they are filled to, not counting epsilon
+    below = bytearray(len(filled))
+    level = filled[:]
+
+    track = seed_labels is not None
+    if track:
+        label = array("l", [-1]) * len(filled)
+    edges = {}
+
+    heap = []
+    for i, s in enumerate(seeds.tolist()):
+        filled[s] = seed_z[i]
+        closed[s] = 1
+        heap.append((seed_z[i], s))
+        if track:
+            label[s] = seed_labels[i]
+    heapq.heapify(heap)
+    pit = deque()
+
+    while heap or pit:
+        if pit:
+            c = pit.popleft()
+            zc = filled[c]
+        else:
+            zc, c = heapq.heappop(heap)
+            level[c] = zc
+        r, col = divmod(c, cols)
+        for dr, dc in _offsets:
+            rr = r + dr
+            cc = col + dc
+            if rr < 0 or rr >= rows or cc < 0 or cc >= cols:
+                continue
+            nb = rr * cols + cc
+            if closed[nb]:
+                if track and label[nb] >= 0 and label[nb] != label[c]:
+                    key = (min(label[c], label[nb]), max(label[c], label[nb]))
+                    spill = max(zc, filled[nb])
+                    if spill < edges.get(key, numpy.inf):
+                        edges[key] = spill
+                continue
+            closed[nb] = 1
+            if track:
+                label[nb] = label[c]
+            if filled[nb] <= zc:
+                if filled[nb] < level[c]:
+                    below[nb] = 1
+                level[nb] = level[c]
+                filled[nb] = zc + epsilon
+                pit.append(nb)
+            else:
+                heapq.heappush(heap, (filled[nb], nb))
+
+    filled = numpy.frombuffer(filled, dtype=numpy.float64).reshape(z.shape)
+    n_dep = _regions(below, rows, cols)
+    if track:
+        label = numpy.frombuffer(label, dtype="i{0}".format(label.itemsize))
+        return filled, n_dep, label.reshape(z.shape), edges
+    return filled, n_dep
+
+
+def _regions(mask, rows, cols):
+    """Returns the number of 8-connected regions of the cells set in
+    mask. Each region of cells below their fill level is one
+    depression, so a flat is not counted and a depression reached
+    from more than one cell of a flat is counted once."""
+    mask = bytearray(mask)
+    n = 0
+    for start in range(len(mask)):
+        if not mask[start]:
+            continue
+        n += 1
+        mask[start] = 0
+        stack = [start]
+        while stack:
+            r, col = divmod(stack.pop(), cols)
+            for dr, dc in _offsets:
+                rr = r + dr
+                cc = col + dc
+                if 0 <= rr < rows and 0 <= cc < cols and mask[rr * cols + cc]:
+                    mask[rr * cols + cc] = 0
+                    stack.append(rr * cols + cc)
+    return n
+
+
+def _stats(dem, filled, n_dep):
+    """Returns a dictionary summarizing the fill"""
+    with numpy.errstate(invalid="ignore"):
+        depth = filled - dem
+        raised = depth > 0
+    return {"depressions": n_dep,
+            "cells_filled": int(raised.sum()),
+            "max_depth": float(depth[raised].max()) if raised.any() else 0.0,
+            "total_depth": float(depth[raised].sum())}
+
+
+def fill_depressions(dem, nodata=None, epsilon=0.0):
+    """Fills every depression in the DEM so all cells can drain to
+    the grid edge or NoData. If epsilon is > 0 filled cells are
+    raised by epsilon per cell away from the spill point so they
+    keep a gradient. Returns the filled DEM (float64, NoData as nan)
+    and a dictionary with the number of depressions filled, the
+    number of cells raised, and the maximum and total fill depth."""
+
+    dem = numpy.asarray(dem, dtype=numpy.float64)
+    z = numpy.where(d8.valid_cells(dem, nodata), dem, numpy.nan)
+    seeds = numpy.flatnonzero(_edge_cells(~numpy.isnan(z)))
+    filled, n_dep = _flood(z, seeds, z.ravel()[seeds].tolist(), epsilon)
+    return filled, _stats(z, filled, n_dep)
+
+
+def _label_task(task):
+    """Pass 1. Floods one tile from its perimeter, labelling each seed
+    1, 2, ... in the tile or OCEAN if it drains off the DEM. Returns
+    the seeds with their labels and elevations and the lowest spill
+    elevation between each pair of labels."""
+    t, dem, nodata, bounds = task
+    z, seeds, ocean = _read_tile(tiled.open_array(dem), nodata, *bounds)
+    seed_labels = numpy.where(ocean, OCEAN, OCEAN + 1 + numpy.arange(seeds.size))
+    seed_z = z.ravel()[seeds]
+    edges = _flood(z, seeds, seed_z.tolist(), 0.0, seed_labels.tolist())[3]
+    return t, seeds, seed_labels, seed_z, edges
+
+
+def _fill_task(task):
+    """Pass 3. Floods one tile with its seeds raised to their spill
+    levels. Returns the filled tile, its statistics and, if asked
+    for, the fill depth."""
+    dem, nodata, bounds, seed_level, epsilon, want_depth = task
+    z, seeds, ocean = _read_tile(tiled.open_array(dem), nodata, *bounds)
+    seed_z = numpy.maximum(z.ravel()[seeds], seed_level)
+    f, n_dep = _flood(z, seeds, seed_z.tolist(), epsilon)
+    return bounds, f, _stats(z, f, n_dep), f - z if want_depth else None
+
+
+def fill_depressions_tiled(dem, out, tile_size=None, nodata=None,
+                           epsilon=0.0, depth=None, max_memory_mb=1024,
+                           processes=None):
+    """Fills depressions tile by tile so only the tiles being flooded
+    (plus a one cell overlap) are in memory. dem, out and depth are
+    .npy or raster paths or anything that supports 2d slicing, see
+    tiled.open_array. With paths the tiles are flooded on a pool of
+    processes, otherwise in this process. If tile_size is None it is
+    picked from bytes_per_cell so the tiles in flight stay under
+    max_memory_mb. Optionally writes the fill depth to depth. With
+    epsilon the gradient is built within each tile. Returns the same
+    statistics as fill_depressions. Depressions that cross a tile
+    edge are counted once in each tile."""
+
+    processes = tiled._processes([dem], processes)
+    rows, cols = tiled.open_array(dem).shape
+    if tile_size is None:
+        tile_size = tiled.tile_size_for_memory(max_memory_mb, bytes_per_cell,
+                                               1, processes, itemsize=1)
+    bounds = tiled.tiles((rows, cols), tile_size)
+
+    # perimeter cells by global index -> (tile, label, elevation)
+    ring = {}
+    edges = {}
+    next_label = OCEAN + 1
+    seeds_by_tile = [None] * len(bounds)
+
+    # -- pass 1. Flood each tile from its perimeter and label each cell
+    # with the perimeter cell it was flooded from. The tile labels are
+    # numbered across the DEM as the tiles come back.
+    tasks = [(t, dem, nodata, b) for t, b in enumerate(bounds)]
+    for t, seeds, seed_labels, seed_z, tile_edges in tiled._run(_label_task, tasks,
+                                                              processes):
+        offset = next_label - (OCEAN + 1)
+        next_label += seeds.size
+        seed_labels = numpy.where(seed_labels == OCEAN, OCEAN, seed_labels + offset)
+        for (la, lb), spill in tile_edges.items():
+            key = (la if la == OCEAN else la + offset,
+                   lb if lb == OCEAN else lb + offset)
+            if spill < edges.get(key, numpy.inf):
+                edges[key] = spill
+
+        r0, c0, r1, c1 = bounds[t]
+        tile_cols = c1 - c0
+        sr = seeds // tile_cols + r0
+        sc = seeds % tile_cols + c0
+        on_ring = ((sr == r0) | (sr == r1 - 1) | (sc == c0) | (sc == c1 - 1))
+        for g, lab, zz in zip((sr * cols + sc)[on_ring].tolist(),
+                              seed_labels[on_ring].tolist(),
+                              seed_z[on_ring].tolist()):
+            ring[g] = (t, lab, zz)
+        seeds_by_tile[t] = seed_labels
+
+    # -- pass 2. Link the perimeter labels across tile edges
+    for g, (t, lab, zz) in ring.items():
+        r, c = divmod(g, cols)
+        for dr, dc in _offsets:
+            rr = r + dr
+            cc = c + dc
+            if rr < 0 or rr >= rows or cc < 0 or cc >= cols:
+                continue
+            other = ring.get(rr * cols + cc)
+            if other is None or other[0] == t or other[1] == lab:
+                continue
+            key = (min(lab, other[1]), max(lab, other[1]))
+            spill = max(zz, other[2])
+            if spill < edges.get(key, numpy.inf):
+                edges[key] = spill
+    del ring
+
+    level = _spill_levels(edges, next_label)
+
+    # -- pass 3. Flood each tile again with the perimeter raised to
+    # the level it spills at
+    stats = {"depressions": 0, "cells_filled": 0,
+             "max_depth": 0.0, "total_depth": 0.0}
+    tasks = [(dem, nodata, b, level[seeds_by_tile[t]], epsilon, depth is not None)
+             for t, b in enumerate(bounds)]
+    del seeds_by_tile
+    for (r0, c0, r1, c1), f, tile_stats, d in tiled._run(_fill_task, tasks,
+                                                         processes):
+        out[r0:r1, c0:c1] = f
+        if depth is not None:
+            depth[r0:r1, c0:c1] = d
+
+        stats["depressions"] += tile_stats["depressions"]
+        stats["cells_filled"] += tile_stats["cells_filled"]
+        stats["total_depth"] += tile_stats["total_depth"]
+        stats["max_depth"] = max(stats["max_depth"], tile_stats["max_depth"])
+
+    return stats
+
+
+def _read_tile(dem, nodata, r0, c0, r1, c1):
+    """Reads a tile with a one cell overlap. Returns the tile
+    elevations, the flat indices of the tile's seed cells, and whether
+    each seed drains to the DEM edge or NoData."""
+
+    rows, cols = dem.shape
+    hr0, hc0 = max(r0 - 1, 0), max(c0 - 1, 0)
+    hr1, hc1 = min(r1 + 1, rows), min(c1 + 1, cols)
+    window = numpy.asarray(dem[hr0:hr1, hc0:hc1], dtype=numpy.float64)
+    window = numpy.where(d8.valid_cells(window, nodata), window, numpy.nan)
+
+    ocean = _edge_cells(~numpy.isnan(window),
+                        edge_top=r0 == 0, edge_bottom=r1 == rows,
+                        edge_left=c0 == 0, edge_right=c1 == cols)
+    inner = (slice(r0 - hr0, r0 - hr0 + r1 - r0),
+             slice(c0 - hc0, c0 - hc0 + c1 - c0))
+    z = window[inner]
+    ocean = ocean[inner]
+
+    perimeter = numpy.zeros(z.shape, dtype=bool)
+    perimeter[0, :] = perimeter[-1, :] = True
+    perimeter[:, 0] = perimeter[:, -1] = True
+    perimeter &= ~numpy.isnan(z)
+
+    seeds = numpy.flatnonzero(perimeter | ocean)
+    return z, seeds, ocean.ravel()[seeds]
+
+
+def _spill_levels(edges, n_labels):
+    """Returns the lowest elevation each label has to be raised to
+    before it can drain to the ocean label"""
+
+    graph = {}
+    for (a, b), spill in edges.items():
+        graph.setdefault(a, []).append((b, spill))
+        graph.setdefault(b, []).append((a, spill))
+
+    level = numpy.full(n_labels, numpy.inf)
+    level[OCEAN] = -numpy.inf
+    heap = [(-numpy.inf, OCEAN)]
+    while heap:
+        lvl, a = heapq.heappop(heap)
+        if lvl > level[a]:
+            continue
+        for b, spill in graph.get(a, []):
+            new = max(lvl, spill)
+            if new < level[b]:
+                level[b] = new
+                heapq.heappush(heap, (new, b))
+
+    # labels cut off from the ocean are left as they are
+    level[numpy.isinf(level) & (level > 0)] = -numpy.inf
+    return level
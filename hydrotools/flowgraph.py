@@ -0,0 +1,97 @@
+"""
+Flow graph built from a D8 flow direction array: the downstream cell
+of every cell and the topological order used by the accumulation,
+flow length and labeling sweeps. Graphs can be saved to a cache
+folder as .npy files keyed by a hash of the flow direction array so
+other scripts load them memory mapped instead of rebuilding them.
+"""
+
+from __future__ import division, print_function
+import hashlib
+import os
+import numpy
+
+from hydrotools import d8
+
+_parts = ["valid", "down", "order", "offsets"]
+
+
+class FlowGraph(object):
+    """
+    The flow graph of one flow direction array.
+
+    shape   -- rows, cols of the flow direction array
+    valid   -- flat bool array of cells that are not NoData
+    down    -- flat index of the cell each cell drains to or -1
+    order   -- flat indices of cells with a downstream cell in
+               topological order (see d8.topological_order)
+    offsets -- start of each wave in order
+    key     -- hash of the flow direction array
+    """
+
+    def __init__(self, shape, valid, down, order, offsets, key=None):
+        self.shape = tuple(shape)
+        self.valid = valid
+        self.down = down
+        self.order = order
+        self.offsets = offsets
+        self.key = key
+
+    @classmethod
+    def from_fdr(cls, fdr, nodata=d8.FDR_NODATA):
+        """Builds the graph for a flow direction array"""
+        fdr = numpy.asarray(fdr)
+        valid = d8.valid_cells(fdr, nodata).ravel()
+        down = d8.downstream_index(fdr, nodata)
+        order, offsets = d8.topological_order(down)
+        return cls(fdr.shape, valid, down, order, offsets,
+                   fdr_key(fdr, nodata))
+
+    def save(self, cache_dir):
+        """Saves the graph as .npy files in cache_dir"""
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for part in _parts:
+            numpy.save(_path(cache_dir, self.key, part), getattr(self, part))
+        numpy.save(_path(cache_dir, self.key, "shape"),
+                   numpy.array(self.shape))
+
+    @classmethod
+    def load(cls, cache_dir, key, mmap_mode="r"):
+        """Loads a saved graph. By default the arrays are memory mapped
+        so nothing is read until it is used."""
+        arrays = [numpy.load(_path(cache_dir, key, part), mmap_mode=mmap_mode)
+                  for part in _parts]
+        shape = numpy.load(_path(cache_dir, key, "shape"))
+        return cls(shape.tolist(), *arrays, key=key)
+
+    @staticmethod
+    def exists(cache_dir, key):
+        """Returns True if a graph with this key is saved in cache_dir"""
+        return all(os.path.isfile(_path(cache_dir, key, part))
+                   for part in _parts + ["shape"])
+
+
+def _path(cache_dir, key, part):
+    return os.path.join(cache_dir, "{0}_{1}.npy".format(key, part))
+
+
+def fdr_key(fdr, nodata=d8.FDR_NODATA, block_rows=1024):
+    """Returns a hash of the flow direction array, its shape and
+    NoData value. Hashes in row blocks so memory mapped arrays are
+    not read in all at once."""
+    sha = hashlib.sha1()
+    sha.update(repr((fdr.shape, str(fdr.dtype), nodata)).encode("utf-8"))
+    for i in range(0, fdr.shape[0], block_rows):
+        sha.update(numpy.ascontiguousarray(fdr[i:i + block_rows]).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def cached_graph(fdr, cache_dir, nodata=d8.FDR_NODATA, mmap_mode="r"):
+    """Returns the flow graph for a flow direction array, loading it
+    from cache_dir if it was built before and building and saving it
+    there if not."""
+    key = fdr_key(fdr, nodata)
+    if not FlowGraph.exists(cache_dir, key):
+        FlowGraph.from_fdr(fdr, nodata).save(cache_dir)
+    return FlowGraph.load(cache_dir, key, mmap_mode)
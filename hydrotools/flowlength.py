@@ -0,0 +1,83 @@
+"""
+D8 flow length along the flow path, like FlowLength DOWNSTREAM, in
+one sweep of the flow graph from the bottom wave up. Diagonal steps
+are sqrt(2) cells long. The length can be measured to the end of the
+flow path, to the first cell of a target mask (e.g. streams or
+outlets) or to the last cell of each zone on the path, which is the
+distance from the catchment outlet that FlowDistanceCatchment.py
+used to get from FlowLength, ZonalStatistics MINIMUM and Minus.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+from hydrotools import d8
+from hydrotools import flowgraph
+
+
+def _step_length(graph, cellsize, weight):
+    """Returns the length of the step from each cell to its downstream
+    cell, 0 where there is no downstream cell"""
+    rows, cols = graph.shape
+    down = graph.down
+    has = down >= 0
+    idx = numpy.flatnonzero(has)
+    diagonal = ((idx // cols) != (down[has] // cols)) & \
+               ((idx % cols) != (down[has] % cols))
+    step = numpy.zeros(down.size)
+    step[idx] = numpy.where(diagonal, numpy.sqrt(2.0), 1.0) * cellsize
+    if weight is not None:
+        step *= numpy.asarray(weight, dtype=numpy.float64).ravel()
+    return step
+
+
+def flow_length(fdr=None, cellsize=1.0, target=None, zones=None,
+                weight=None, nodata=d8.FDR_NODATA, graph=None):
+    """Returns the downstream flow length of each cell. fdr is a D8
+    flow direction array or graph a cached flowgraph.FlowGraph.
+
+    With target (True or not 0 on target cells) the length is to the
+    first target cell on the flow path. Target cells are 0 and cells
+    whose path never reaches a target are nan. Note this counts the
+    step into the target, unlike FlowLength on a flow direction with
+    the targets set to NoData.
+
+    With zones the length is to the last cell on the flow path that is
+    in the same zone as the cell. Cells with a nan zone are nan.
+
+    Otherwise the length is to the end of the flow path, the same as
+    FlowLength DOWNSTREAM. weight multiplies the length of the step
+    out of each cell. NoData flow direction cells are nan."""
+
+    if graph is None:
+        graph = flowgraph.FlowGraph.from_fdr(fdr, nodata)
+    valid, down = graph.valid, graph.down
+    order, offsets = graph.order, graph.offsets
+    step = _step_length(graph, cellsize, weight)
+
+    length = numpy.where(valid, 0.0, numpy.nan)
+    stop = None
+    if target is not None:
+        t = numpy.asarray(target, dtype=numpy.float64).ravel()
+        with numpy.errstate(invalid="ignore"):
+            stop = (t != 0) & ~numpy.isnan(t)
+        # paths that end without reaching a target stay nan
+        length[valid & ~stop] = numpy.nan
+    elif zones is not None:
+        z = numpy.asarray(zones, dtype=numpy.float64).ravel()
+        has = down >= 0
+        # a cell is the last of its zone if it drains out of the zone
+        stop = numpy.ones(down.size, dtype=bool)
+        stop[has] = z[down[has]] != z[has]
+        length[numpy.isnan(z)] = numpy.nan
+
+    # downstream waves first so every cell's downstream cell is done
+    for w in range(offsets.size - 2, -1, -1):
+        seg = order[offsets[w]:offsets[w + 1]]
+        if stop is not None:
+            seg = seg[~stop[seg]]
+        length[seg] = length[down[seg]] + step[seg]
+
+    if zones is not None:
+        length[numpy.isnan(z)] = numpy.nan
+    return length.reshape(graph.shape)
@@ -0,0 +1,125 @@
+"""
+Hashed lookups for lists of ids and names, in place of list.count,
+"x in some_list" and any(... for ... in some_list) scans that make a
+loop over n features take n * n steps.
+
+Run the module to time the list scans against the hashed versions on
+synthetic stream networks of up to 100k features:
+
+    python -m hydrotools.index [<largest n>] [<largest n for lists>]
+"""
+
+from __future__ import division, print_function
+from collections import Counter, defaultdict
+import random
+import sys
+import time
+
+
+def duplicates(items):
+    """Returns the items that are in items more than once, in the
+    order they are first seen"""
+    return [item for item, count in Counter(items).items() if count > 1]
+
+
+def positions(items):
+    """Returns a dictionary of each item and the list of indexes where
+    it is in items"""
+    out = defaultdict(list)
+    for i, item in enumerate(items):
+        out[item].append(i)
+    return out
+
+
+def prefix_values(mapping, text):
+    """Returns the values of the keys in mapping that text starts with,
+    the longest key first. Takes one dictionary lookup for each length
+    of text instead of a startswith for each key."""
+    return [mapping[text[:n]] for n in range(len(text), -1, -1)
+            if text[:n] in mapping]
+
+
+class Keywords(object):
+    """
+    A set of words that can be searched for inside other strings,
+    ignoring case. search(text) is the same as
+    any(word.lower() in text.lower() for word in words) but looks up
+    the substrings of text of each word length in a set. With
+    lower_text=False only the words are lowercased and the text is
+    searched as it is, the same as
+    any(word.lower() in text for word in words).
+    """
+
+    def __init__(self, words, lower_text=True):
+        self.words = set(word.lower() for word in words)
+        self.lengths = sorted(set(len(word) for word in self.words))
+        self.lower_text = lower_text
+
+    def search(self, text):
+        if self.lower_text:
+            text = text.lower()
+        return any(text[i:i + n] in self.words
+                   for n in self.lengths
+                   for i in range(len(text) - n + 1))
+
+
+def _network(n, seed=0):
+    """Returns HydroIDs, NextDownIDs and SSBT ids for a random network
+    of n features draining to one outlet"""
+    rand = random.Random(seed)
+    hids = list(range(1, n + 1))
+    rand.shuffle(hids)
+    down = [-1] + [hids[rand.randrange(i)] for i in range(1, n)]
+    ssbt = rand.sample(hids, n // 10)
+    return hids, down, ssbt
+
+
+def _time(func):
+    t = time.time()
+    func()
+    return time.time() - t
+
+
+def benchmark(sizes, list_limit):
+    """Prints the time of the list scans and the hashed lookups for
+    networks of each size. The list scans are skipped above list_limit
+    features because they grow with n * n."""
+
+    print("{0:>8} {1:>22} {2:>12} {3:>12}".format("n", "test", "list s",
+                                                   "hashed s"))
+    for n in sizes:
+        hids, down, ssbt = _network(n)
+        paths = ["\\\\nas\\lidar\\project{0}\\be\\tile{1}".format(i % 500, i)
+                 for i in range(n)]
+        years = dict(("\\\\nas\\lidar\\project{0}".format(i), 2000 + i % 15)
+                     for i in range(500))
+        quads = ["{0}d{1}".format(45000 + i, i % 8) for i in range(n)]
+        keep = quads[::3]
+
+        tests = [
+            ("duplicate HydroIDs",
+             lambda: list(set([i for i in hids if hids.count(i) > 1])),
+             lambda: duplicates(hids)),
+            ("SSBT membership",
+             lambda: [h in ssbt for h in down],
+             lambda: [h in s for s in [set(ssbt)] for h in down]),
+            ("path prefix lookup",
+             lambda: [[v for k, v in years.items() if p.startswith(k)]
+                      for p in paths],
+             lambda: [prefix_values(years, p) for p in paths]),
+            ("quad filter",
+             lambda: [any(q.lower() == name for q in keep) for name in quads],
+             lambda: [name in s for s in [set(q.lower() for q in keep)]
+                      for name in quads]),
+        ]
+        for name, scan, hashed in tests:
+            t_list = "skipped" if n > list_limit else "{0:.3f}".format(_time(scan))
+            print("{0:>8} {1:>22} {2:>12} {3:>12.3f}".format(n, name, t_list,
+                                                             _time(hashed)))
+
+
+if __name__ == "__main__":
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    list_limit = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    sizes = [n for n in (1000, 10000, 100000, 1000000) if n < largest]
+    benchmark(sizes + [largest], list_limit)
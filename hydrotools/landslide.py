@@ -0,0 +1,52 @@
+"""
+Shallow landslide susceptibility (Shaw and Johnson 1995) from a DEM
+and a lithology raster in one pass, the same steps as
+ShallowLandslides.py: planform curvature, its focal mean, slope in
+percent rise, the plan, lithology and slope reclass tables, their sum
+and the final susceptibility reclass. Run it tile by tile with
+tiled.run_local and halo(focal_size) so only the outputs that are
+wanted are written.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+from hydrotools import local
+
+# layers returned with intermediates, the first is the final
+# susceptibility (SUSCEP_reclass_Final)
+layers = ["suscep_reclass", "suscep", "slope", "slope_reclass",
+          "lith_reclass", "curve", "profile", "plan", "plan_focal",
+          "plan_reclass"]
+
+
+def halo(focal_size=5):
+    """Returns the number of cells susceptibility needs around a tile"""
+    return local.halo["curvature"] + local.focal_halo(focal_size or 1)
+
+
+def susceptibility(dem, lith, cellsize, plan_table, lith_table, slope_table,
+                   suscep_table, focal_size=5, intermediates=False):
+    """Returns the final susceptibility class of each cell. The tables
+    are lists of (from, to, out) rows like ReclassByTable with DATA.
+    focal_size is the width of the focal mean of planform curvature,
+    None to skip it (10 m DEMs). With intermediates a stack of all the
+    layers in layers is returned."""
+
+    curve, profile, plan = local.curvature(dem, cellsize)
+    if focal_size:
+        plan_focal = local.focal(plan, focal_size, "MEAN")
+    else:
+        plan_focal = plan
+    plan_reclass = local.reclass(plan_focal, plan_table, "DATA")
+    lith_reclass = local.reclass(lith, lith_table, "DATA")
+    slope = local.slope(dem, cellsize, "PERCENT_RISE")
+    slope_reclass = local.reclass(slope, slope_table, "DATA")
+    suscep = lith_reclass + slope_reclass + plan_reclass
+    suscep_reclass = local.reclass(suscep, suscep_table, "DATA")
+
+    if not intermediates:
+        return suscep_reclass
+    return numpy.array([suscep_reclass, suscep, slope, slope_reclass,
+                        lith_reclass, curve, profile, plan, plan_focal,
+                        plan_reclass])
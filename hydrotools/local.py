@@ -0,0 +1,218 @@
+"""
+Local and focal raster operators on numpy arrays: slope, curvature,
+focal statistics, reclassify and con. NoData is nan. Each operator
+only looks at a fixed neighborhood so it can be run tile by tile with
+tiled.run_local using the halo given in halo.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+from hydrotools import d8
+from hydrotools.reclass import compile_table
+
+# number of cells each operator needs around a tile. focal needs
+# focal_halo(size).
+halo = {"slope": 1, "curvature": 1, "con": 0, "reclass": 0}
+
+
+def _neighbor(z, dr, dc):
+    """Returns the neighbor at row + dr, col + dc of every cell.
+    Off grid and nan neighbors get the value of the center cell, the
+    same as ArcGIS Slope."""
+    nb = d8._shift(z, dr, dc, numpy.nan)
+    return numpy.where(numpy.isnan(nb), z, nb)
+
+
+def slope(dem, cellsize=1.0, units="PERCENT_RISE", z_factor=1.0):
+    """Returns the slope of each cell using the Horn (1981) third
+    order finite difference, the same as ArcGIS Slope. units is
+    PERCENT_RISE or DEGREE."""
+
+    z = numpy.asarray(dem, dtype=numpy.float64) * z_factor
+    a = _neighbor(z, -1, -1)
+    b = _neighbor(z, -1, 0)
+    c = _neighbor(z, -1, 1)
+    d = _neighbor(z, 0, -1)
+    f = _neighbor(z, 0, 1)
+    g = _neighbor(z, 1, -1)
+    h = _neighbor(z, 1, 0)
+    i = _neighbor(z, 1, 1)
+
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8.0 * cellsize)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8.0 * cellsize)
+    rise = numpy.sqrt(dzdx ** 2 + dzdy ** 2)
+
+    if units.upper() == "DEGREE":
+        return numpy.degrees(numpy.arctan(rise))
+    return rise * 100.0
+
+
+def curvature(dem, cellsize=1.0, z_factor=1.0):
+    """Returns the curvature, profile and planform curvature of each
+    cell from the Zevenbergen and Thorne (1987) fourth order surface,
+    like ArcGIS Curvature, in 1/100 z units. Signs follow the ArcGIS
+    descriptions: curvature and profile are negative where the surface
+    is upwardly concave and upwardly convex, planform is positive where
+    it is sidewardly convex. Profile and planform are 0 on flat
+    cells."""
+
+    z = numpy.asarray(dem, dtype=numpy.float64) * z_factor
+    z1 = _neighbor(z, -1, -1)
+    z2 = _neighbor(z, -1, 0)
+    z3 = _neighbor(z, -1, 1)
+    z4 = _neighbor(z, 0, -1)
+    z6 = _neighbor(z, 0, 1)
+    z7 = _neighbor(z, 1, -1)
+    z8 = _neighbor(z, 1, 0)
+    z9 = _neighbor(z, 1, 1)
+
+    l2 = cellsize * cellsize
+    d = ((z4 + z6) / 2.0 - z) / l2
+    e = ((z2 + z8) / 2.0 - z) / l2
+    f = (-z1 + z3 + z7 - z9) / (4.0 * l2)
+    g = (-z4 + z6) / (2.0 * cellsize)
+    h = (z2 - z8) / (2.0 * cellsize)
+    gh = g * g + h * h
+    flat = gh == 0
+    gh[flat] = 1.0
+
+    curve = -2.0 * (d + e) * 100.0
+    profile = 2.0 * (d * g * g + e * h * h + f * g * h) / gh * 100.0
+    plan = -2.0 * (d * h * h + e * g * g - f * g * h) / gh * 100.0
+    profile[flat] = 0.0
+    plan[flat] = 0.0
+    return curve, profile, plan
+
+
+def _size(size):
+    """Returns a rectangle size as (rows, cols)"""
+    if isinstance(size, int):
+        return (size, size)
+    return tuple(size)
+
+
+def focal_halo(size):
+    """Returns the number of cells focal needs around a tile for a
+    rectangle of size cells, so tiles run with tiled.run_local match
+    the whole grid without seams"""
+    return max(_size(size)) // 2
+
+
+def focal(arry, size=3, stat="MEAN", ignore_nodata=True):
+    """Returns the focal SUM, MEAN, COUNT, MINIMUM or MAXIMUM over a
+    rectangle of size cells (an int or (rows, cols)) centered on each
+    cell, like FocalStatistics with NbrRectangle in CELL units. With
+    ignore_nodata (DATA) nan cells are skipped, otherwise any nan in
+    the window gives nan. Windows with no data are nan, or 0 for
+    COUNT. SUM, MEAN and COUNT come from summed area tables so their
+    cost doesn't depend on the size of the window."""
+
+    size = _size(size)
+    arry = numpy.asarray(arry, dtype=numpy.float64)
+    stat = stat.upper()
+    if stat in ("SUM", "MEAN", "COUNT"):
+        return _focal_sum(arry, size, stat, ignore_nodata)
+
+    has = ~numpy.isnan(arry)
+    if stat == "MINIMUM":
+        fill, reduce = numpy.inf, numpy.minimum
+    elif stat == "MAXIMUM":
+        fill, reduce = -numpy.inf, numpy.maximum
+    else:
+        raise ValueError("Unknown focal statistic {0}".format(stat))
+    v = numpy.where(has, arry, fill)
+    out = numpy.full(arry.shape, fill)
+    count = numpy.zeros(arry.shape, dtype=numpy.int64)
+    window = size[0] * size[1]
+
+    for dr in range(-(size[0] // 2), size[0] - size[0] // 2):
+        for dc in range(-(size[1] // 2), size[1] - size[1] // 2):
+            out = reduce(out, d8._shift(v, dr, dc, fill))
+            count += d8._shift(has, dr, dc, False)
+
+    out[count == 0] = numpy.nan
+    if not ignore_nodata:
+        out[count < window] = numpy.nan
+    return out
+
+
+def _window_sums(table, size):
+    """Returns window_sum for every cell of the grid. The rows and
+    then the columns of the table are taken as whole slices."""
+    ends = []
+    for axis, n in enumerate(table.shape):
+        start = numpy.arange(n - 1) - size[axis] // 2
+        ends.append((numpy.clip(start, 0, n - 1),
+                     numpy.clip(start + size[axis], 0, n - 1)))
+    (r0, r1), (c0, c1) = ends
+    rows = table.take(r1, axis=0) - table.take(r0, axis=0)
+    return rows.take(c1, axis=1) - rows.take(c0, axis=1)
+
+
+def _focal_sum(arry, size, stat, ignore_nodata):
+    """focal SUM, MEAN or COUNT from summed area tables"""
+    has = ~numpy.isnan(arry)
+    count = numpy.rint(_window_sums(summed_area_table(has), size))
+
+    if stat == "COUNT":
+        out = count
+    else:
+        # the running sums are kept small by taking off a whole number
+        # near the mean, which keeps sums of integers exact
+        shift = numpy.rint(arry[has].mean()) if has.any() else 0.0
+        out = _window_sums(summed_area_table(arry - shift), size)
+        out += count * shift
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            if stat == "MEAN":
+                out /= count
+        out[count == 0] = numpy.nan
+    if not ignore_nodata:
+        out[count < size[0] * size[1]] = numpy.nan
+    return out
+
+
+def summed_area_table(arry):
+    """Returns the summed area table of an array or a (layers, rows,
+    cols) stack with a row and column of zeros before the first, so
+    table[..., r, c] is the sum of arry[..., :r, :c]. nan counts as 0."""
+    arry = numpy.asarray(arry, dtype=numpy.float64)
+    shape = arry.shape[:-2] + (arry.shape[-2] + 1, arry.shape[-1] + 1)
+    table = numpy.zeros(shape)
+    numpy.cumsum(numpy.where(numpy.isnan(arry), 0.0, arry), axis=-2,
+                 out=table[..., 1:, 1:])
+    numpy.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    return table
+
+
+def window_sum(table, rows, cols, size=3):
+    """Returns the sum over a rectangle of size cells (an int or
+    (rows, cols)) centered on each of the cells rows, cols from a
+    summed_area_table. Windows are cut off at the edges of the grid.
+    Only the given cells are computed."""
+    size = _size(size)
+    nrows, ncols = table.shape[-2] - 1, table.shape[-1] - 1
+    r0 = numpy.maximum(rows - size[0] // 2, 0)
+    r1 = numpy.minimum(rows - size[0] // 2 + size[0], nrows)
+    c0 = numpy.maximum(cols - size[1] // 2, 0)
+    c1 = numpy.minimum(cols - size[1] // 2 + size[1], ncols)
+    return (table[..., r1, c1] - table[..., r0, c1] -
+            table[..., r1, c0] + table[..., r0, c0])
+
+
+def reclass(arry, table, missing="DATA"):
+    """Reclassifies an array with a table of (from, to, new) ranges.
+    A value on the boundary of two ranges gets the lower one. Values
+    that are not in any range keep their value with missing="DATA" or
+    become nan with "NODATA". See reclass.RangeTable."""
+    return compile_table(table)(arry, missing)
+
+
+def con(condition, true, false=numpy.nan):
+    """Returns true where condition is not 0 and false where it is 0.
+    nan conditions give nan."""
+    condition = numpy.asarray(condition, dtype=numpy.float64)
+    with numpy.errstate(invalid="ignore"):
+        out = numpy.where(condition != 0, true, false).astype(numpy.float64)
+    out[numpy.isnan(condition)] = numpy.nan
+    return out
@@ -0,0 +1,71 @@
+"""
+Stream network subsets from the HydroID / NextDownID table, in place
+of selecting, erasing, merging and dissolving feature classes. The
+NextDownID column is turned into an index of each reach's upstream
+reaches once, so the reaches upstream of a seed set are found by
+visiting each reach at most once.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+
+def down_index(ids, down_ids):
+    """Returns the position in ids of each reach's downstream reach,
+    -1 for reaches whose down id is not in ids (outlets)"""
+    ids = numpy.asarray(ids)
+    down_ids = numpy.asarray(down_ids)
+    if not ids.size:
+        return numpy.full(down_ids.shape, -1, dtype=numpy.int64)
+    sorter = numpy.argsort(ids, kind="mergesort")
+    pos = numpy.searchsorted(ids, down_ids, sorter=sorter)
+    pos = sorter[numpy.minimum(pos, ids.size - 1)]
+    return numpy.where(ids[pos] == down_ids, pos, -1)
+
+
+class Network(object):
+    """
+    The upstream index of a stream network.
+
+    ids   -- reach ids (HydroID)
+    down  -- position of each reach's downstream reach, -1 at outlets
+    up    -- positions of the upstream reaches of every reach, grouped
+             by the downstream reach
+    start -- up[start[i]:start[i + 1]] are the reaches draining into
+             reach i
+    """
+
+    def __init__(self, ids, down_ids):
+        self.ids = numpy.asarray(ids)
+        self.down = down_index(self.ids, down_ids)
+        has = numpy.flatnonzero(self.down >= 0)
+        self.up = has[numpy.argsort(self.down[has], kind="mergesort")]
+        counts = numpy.bincount(self.down[has], minlength=self.ids.size)
+        self.start = numpy.r_[0, numpy.cumsum(counts)]
+
+    def upstream(self, seeds, include_seeds=False):
+        """Returns a boolean array that is True on every reach upstream
+        of the reaches at the positions seeds (an index or boolean
+        array). Seed reaches are only included with include_seeds or
+        if they are upstream of another seed."""
+        seeds = numpy.asarray(seeds)
+        if seeds.dtype == bool:
+            seeds = numpy.flatnonzero(seeds)
+        seen = numpy.zeros(self.ids.size, dtype=bool)
+        frontier = numpy.unique(seeds)
+        visited = numpy.zeros(self.ids.size, dtype=bool)
+        visited[frontier] = True
+
+        while frontier.size:
+            # every reach draining into the frontier
+            counts = self.start[frontier + 1] - self.start[frontier]
+            first = numpy.repeat(self.start[frontier] - numpy.cumsum(counts) + counts,
+                                 counts)
+            up = self.up[first + numpy.arange(counts.sum())]
+            seen[up] = True
+            frontier = up[~visited[up]]
+            visited[frontier] = True
+
+        if include_seeds:
+            seen[seeds] = True
+        return seen
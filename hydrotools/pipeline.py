@@ -0,0 +1,290 @@
+"""
+Step graph for the raster processing scripts, used in place of
+checking whether each output exists.
+
+Each step declares the outputs it makes, the inputs it reads and the
+parameters it uses. A step's key is a hash of its name, its code, its
+parameters and the keys of its inputs. An input made by another step
+has that step's key and any other input is fingerprinted. Keys are
+saved in a manifest when a step finishes. A step runs again only if
+one of its outputs is missing or its key changed, so changing an
+input or a parameter reruns that step and the steps downstream of it
+and nothing else. Steps that don't depend on each other can run at
+the same time on a pool of threads.
+"""
+
+from __future__ import print_function
+from multiprocessing.pool import ThreadPool
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+
+
+class Step(object):
+    """
+    One step of a pipeline.
+
+    name    -- name printed when the step runs
+    func    -- function called with no arguments to make the outputs
+    outputs -- paths of the datasets the step makes
+    inputs  -- paths of the datasets the step reads
+    params  -- dictionary of the parameter values the step uses
+    """
+
+    def __init__(self, name, func, outputs, inputs=(), params=None):
+        self.name = name
+        self.func = func
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.params = params or {}
+
+
+def file_fingerprint(path):
+    """Returns the size and modified time of a file, or of every file
+    in a folder. Returns None if the path doesn't exist."""
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+    if os.path.isdir(path):
+        out = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                out.append([name, stat.st_size, stat.st_mtime])
+        return out
+    return None
+
+
+def _code_hash(sha, code):
+    """Adds a function's byte code and constants to a hash. Nested
+    functions are added the same way since their repr includes a
+    memory address."""
+    sha.update(code.co_code)
+    sha.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            _code_hash(sha, const)
+        else:
+            sha.update(repr(const).encode("utf-8"))
+
+
+class Pipeline(object):
+    """
+    A graph of steps keyed by the outputs they make.
+
+    manifest    -- json file where the key of each output is saved
+    exists      -- function returning True if a dataset exists, e.g.
+                   arcpy.Exists
+    fingerprint -- function returning a json serializable summary of
+                   an input that no step makes, e.g.
+                   arcpy_io.fingerprint
+    delete      -- optional function to delete an out of date output
+                   before its step runs again
+    threads     -- number of steps that can run at the same time
+    """
+
+    def __init__(self, manifest, exists=os.path.exists,
+                 fingerprint=file_fingerprint, delete=None, threads=1):
+        self.manifest = manifest
+        self.exists = exists
+        self.fingerprint = fingerprint
+        self.delete = delete
+        self.threads = threads
+        self.steps = []
+        self.made_by = {}
+        self.saved = {}
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                self.saved = json.load(f)
+        self._lock = threading.Lock()
+
+    def add(self, name, func, outputs, inputs=(), params=None):
+        """Adds a step. Returns the step."""
+        step = Step(name, func, outputs, inputs, params)
+        for out in step.outputs:
+            if out in self.made_by:
+                raise ValueError("{0} is made by more than one step".format(out))
+            self.made_by[out] = step
+        self.steps.append(step)
+        return step
+
+    def step(self, outputs, inputs=(), params=None, name=None):
+        """Decorator that adds a function as a step"""
+        def wrap(func):
+            self.add(name or func.__name__, func, outputs, inputs, params)
+            return func
+        return wrap
+
+    def _upstream(self, step):
+        """Returns the steps that make the inputs of a step"""
+        out = []
+        for path in step.inputs:
+            up = self.made_by.get(path)
+            if up is not None and up is not step and up not in out:
+                out.append(up)
+        return out
+
+    def order(self):
+        """Returns the steps in an order where every step comes after
+        the steps it depends on"""
+        done = set()
+        out = []
+        visiting = set()
+
+        def visit(step):
+            if id(step) in done:
+                return
+            if id(step) in visiting:
+                raise ValueError("{0} depends on itself".format(step.name))
+            visiting.add(id(step))
+            for up in self._upstream(step):
+                visit(up)
+            visiting.discard(id(step))
+            done.add(id(step))
+            out.append(step)
+
+        for step in self.steps:
+            visit(step)
+        return out
+
+    def keys(self):
+        """Returns a dictionary of the key of each step"""
+        keys = {}
+        for step in self.order():
+            sha = hashlib.sha1()
+            sha.update(step.name.encode("utf-8"))
+            _code_hash(sha, getattr(step.func, "__code__", step.func))
+            sha.update(json.dumps(sorted(step.params.items()),
+                                  default=repr).encode("utf-8"))
+            for path in step.inputs:
+                up = self.made_by.get(path)
+                if up is not None:
+                    sha.update(keys[id(up)].encode("utf-8"))
+                else:
+                    sha.update(json.dumps([path, self.fingerprint(path)],
+                                          default=repr).encode("utf-8"))
+            keys[id(step)] = sha.hexdigest()
+        return keys
+
+    def stale(self, keys=None):
+        """Returns the steps that need to run: an output is missing,
+        was made with a different key, or an upstream step needs to
+        run"""
+        keys = keys or self.keys()
+        stale = []
+        for step in self.order():
+            if (any(up in stale for up in self._upstream(step)) or
+                    any(self.saved.get(out) != keys[id(step)] or
+                        not self.exists(out) for out in step.outputs)):
+                stale.append(step)
+        return stale
+
+    def mark_done(self, outputs):
+        """Records outputs as up to date without running their step,
+        e.g. when they were edited by hand"""
+        keys = self.keys()
+        for out in outputs:
+            self.saved[out] = keys[id(self.made_by[out])]
+        self._save()
+
+    def _save(self):
+        with self._lock:
+            tmp = self.manifest + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.saved, f, indent=1, sort_keys=True)
+            if os.path.exists(self.manifest):
+                os.remove(self.manifest)
+            os.rename(tmp, self.manifest)
+
+    def _run_step(self, step, key):
+        """Runs one step. Returns the step and the error message if it
+        failed."""
+        try:
+            begin = time.time()
+            print(step.name)
+            if self.delete is not None:
+                for out in step.outputs:
+                    if self.exists(out):
+                        self.delete(out)
+            step.func()
+            with self._lock:
+                for out in step.outputs:
+                    self.saved[out] = key
+            self._save()
+            print("{0} done in {1:.1f} minutes".format(
+                step.name, (time.time() - begin) / 60))
+            return step, None
+        except Exception:
+            return step, traceback.format_exc()
+
+    def run(self, dry_run=False):
+        """Runs every step that is out of date. Steps are started as
+        soon as the steps they depend on have finished. Stops starting
+        new steps after a step fails and raises once the running ones
+        are done. Returns the names of the steps that ran."""
+
+        keys = self.keys()
+        todo = self.stale(keys)
+        if dry_run or not todo:
+            return [step.name for step in todo]
+
+        waiting = dict((id(step), set(id(up) for up in self._upstream(step)
+                                      if up in todo))
+                       for step in todo)
+        ran = []
+        errors = []
+
+        if self.threads <= 1:
+            for step in todo:
+                step, error = self._run_step(step, keys[id(step)])
+                if error:
+                    raise RuntimeError("{0} failed\n{1}".format(step.name, error))
+                ran.append(step.name)
+            return ran
+
+        pool = ThreadPool(self.threads)
+        finished = []
+        cond = threading.Condition()
+
+        def callback(result):
+            with cond:
+                finished.append(result)
+                cond.notify()
+
+        running = 0
+        try:
+            while todo or running:
+                ready = [] if errors else [s for s in todo if not waiting[id(s)]]
+                for step in ready:
+                    todo.remove(step)
+                    pool.apply_async(self._run_step, (step, keys[id(step)]),
+                                     callback=callback)
+                    running += 1
+                if not running:
+                    break
+                with cond:
+                    while not finished:
+                        cond.wait(1)
+                    results = list(finished)
+                    del finished[:]
+                for step, error in results:
+                    running -= 1
+                    if error:
+                        errors.append((step.name, error))
+                        continue
+                    ran.append(step.name)
+                    for other in todo:
+                        waiting[id(other)].discard(id(step))
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise RuntimeError("\n".join("{0} failed\n{1}".format(name, error)
+                                         for name, error in errors))
+        return ran
+
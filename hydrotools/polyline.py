@@ -0,0 +1,134 @@
+"""
+Points and azimuths along polylines with numpy, in place of calling
+positionAlongLine once per point. The vertices of every feature are
+stacked into one array with a running measure so the points for a
+whole feature class are found with one searchsorted and one
+interpolation. Lines are split at known distances the same way, and
+the end caps of flat ended buffers come from the end segments.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+
+def vertices(geometry):
+    """Returns the vertices of an arcpy polyline as an (n, 2) array.
+    The parts of a multipart line are joined end to end."""
+    xy = []
+    for part in geometry:
+        xy.extend((p.X, p.Y) for p in part if p is not None)
+    return numpy.array(xy, dtype=numpy.float64).reshape(-1, 2)
+
+
+class Polylines(object):
+    """
+    The vertices of a list of polylines.
+
+    xy      -- (vertices, 2) array of every line's vertices in order
+    first   -- index in xy of each line's first vertex
+    last    -- index in xy of each line's last vertex
+    measure -- distance of each vertex from the start of its line plus
+               the length of all the lines before it
+    start   -- measure of each line's first vertex
+    length  -- length of each line
+    """
+
+    def __init__(self, lines):
+        lines = [numpy.asarray(line, dtype=numpy.float64).reshape(-1, 2)
+                 for line in lines]
+        counts = numpy.array([len(line) for line in lines], dtype=numpy.int64)
+        if (counts < 1).any():
+            raise ValueError("Every line needs at least one vertex")
+        self.xy = numpy.concatenate(lines)
+        self.last = numpy.cumsum(counts) - 1
+        self.first = self.last - counts + 1
+
+        step = numpy.hypot(*numpy.diff(self.xy, axis=0).T)
+        # no length between the last vertex of a line and the next line
+        step[self.last[:-1]] = 0.0
+        self.measure = numpy.r_[0.0, numpy.cumsum(step)]
+        self.start = self.measure[self.first]
+        self.length = self.measure[self.last] - self.start
+
+    def points(self, line, distance, normalized=False):
+        """Returns the x and y of points at distance along each line in
+        line, like positionAlongLine. With normalized the distance is
+        a fraction of the line's length. Distances off either end of a
+        line give its end point."""
+        line = numpy.atleast_1d(numpy.asarray(line, dtype=numpy.int64))
+        distance = numpy.asarray(distance, dtype=numpy.float64)
+        if normalized:
+            distance = distance * self.length[line]
+        distance = numpy.clip(distance, 0.0, self.length[line])
+        m = self.start[line] + distance
+
+        # segment of each point, kept inside its own line
+        seg = numpy.searchsorted(self.measure, m, side="right") - 1
+        seg = numpy.clip(seg, self.first[line],
+                         numpy.maximum(self.last[line] - 1, self.first[line]))
+        nxt = numpy.minimum(seg + 1, self.last[line])
+
+        span = self.measure[nxt] - self.measure[seg]
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            t = numpy.where(span > 0, (m - self.measure[seg]) / span, 0.0)
+        xy = self.xy[seg] + (self.xy[nxt] - self.xy[seg]) * t[:, None]
+        return xy[:, 0], xy[:, 1]
+
+    def azimuth(self, line, up, down, normalized=False):
+        """Returns the azimuth in degrees (0 to 360, 0 north) from the
+        point at distance up to the point at distance down along each
+        line"""
+        ux, uy = self.points(line, up, normalized)
+        dx, dy = self.points(line, down, normalized)
+        return numpy.degrees(numpy.arctan2(dx - ux, dy - uy)) % 360.0
+
+    def segments(self, line, start, end, normalized=False):
+        """Returns the part of each line in line between the distances
+        start and end as a list of (n, 2) vertex arrays, like
+        segmentAlongLine. Lines are cut at the given distances so no
+        split points or snapping tolerance are needed."""
+        line = numpy.atleast_1d(numpy.asarray(line, dtype=numpy.int64))
+        start = numpy.asarray(start, dtype=numpy.float64)
+        end = numpy.asarray(end, dtype=numpy.float64)
+        if normalized:
+            start = start * self.length[line]
+            end = end * self.length[line]
+        lo = numpy.clip(numpy.minimum(start, end), 0.0, self.length[line])
+        hi = numpy.clip(numpy.maximum(start, end), 0.0, self.length[line])
+        x0, y0 = self.points(line, lo)
+        x1, y1 = self.points(line, hi)
+
+        # vertices strictly between the two cuts
+        i0 = numpy.searchsorted(self.measure, self.start[line] + lo, side="right")
+        i1 = numpy.searchsorted(self.measure, self.start[line] + hi, side="left")
+        i0 = numpy.maximum(i0, self.first[line])
+        i1 = numpy.minimum(i1, self.last[line] + 1)
+
+        out = []
+        for k in range(line.size):
+            out.append(numpy.vstack([[x0[k], y0[k]],
+                                     self.xy[i0[k]:max(i1[k], i0[k])],
+                                     [x1[k], y1[k]]]))
+        return out
+
+
+def end_caps(xy, width):
+    """Returns the closed (2, 5, 2) rectangle rings past the start and
+    end of a line that cover the round caps of its buffer of radius
+    width. Taking them away from a round ended buffer (Polyline.buffer)
+    leaves the flat ended buffer, like Buffer FULL FLAT. Returns an
+    empty (0, 5, 2) array for a line with no length."""
+    xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+    xy = xy[numpy.r_[True, (numpy.diff(xy, axis=0) != 0).any(axis=1)]]
+    if len(xy) < 2:
+        return numpy.zeros((0, 5, 2))
+
+    # the points at each end and the unit directions out of the line
+    ends = xy[[0, -1]]
+    d = numpy.array([xy[0] - xy[1], xy[-1] - xy[-2]])
+    d /= numpy.hypot(d[:, 0], d[:, 1])[:, None]
+    # a little wider and deeper than the cap so no sliver is left
+    n = numpy.column_stack([-d[:, 1], d[:, 0]]) * width * 1.01
+    out = d * width * 1.01
+    return numpy.stack([ends + n, ends + n + out, ends - n + out,
+                        ends - n, ends + n], axis=1)
@@ -0,0 +1,137 @@
+"""
+GDAL helpers to move rasters in and out of numpy arrays.
+"""
+
+from __future__ import print_function
+import numpy
+from osgeo import gdal
+
+# numpy dtype -> gdal data type used when writing
+gdal_types = {numpy.dtype("uint8"): gdal.GDT_Byte,
+              numpy.dtype("int16"): gdal.GDT_Int16,
+              numpy.dtype("uint16"): gdal.GDT_UInt16,
+              numpy.dtype("int32"): gdal.GDT_Int32,
+              numpy.dtype("uint32"): gdal.GDT_UInt32,
+              numpy.dtype("float32"): gdal.GDT_Float32,
+              numpy.dtype("float64"): gdal.GDT_Float64}
+
+
+def read_raster(raster, band_num=1, nodata_to_nan=False):
+    """Reads a raster band into a numpy array. Returns the array,
+    geotransform, projection, and NoData value. If nodata_to_nan is
+    True the array is returned as float64 with NoData cells as nan."""
+
+    data = gdal.Open(raster)
+    band = data.GetRasterBand(band_num)
+    nodata = band.GetNoDataValue()
+    arry = band.ReadAsArray()
+    gt = data.GetGeoTransform()
+    proj = data.GetProjection()
+    data = None
+
+    if nodata_to_nan:
+        arry = arry.astype(numpy.float64)
+        if nodata is not None:
+            arry[arry == nodata] = numpy.nan
+
+    return arry, gt, proj, nodata
+
+
+def write_raster(out_raster, arry, gt, proj, nodata=None,
+                 out_format="GTiff", options=None):
+    """Writes a 2d numpy array, or a 3d array as multiple bands,
+    to a new raster. nan values are written as the NoData value."""
+
+    if arry.ndim == 2:
+        arry = arry[numpy.newaxis, :, :]
+
+    bands, rows, cols = arry.shape
+    driver = gdal.GetDriverByName(out_format)
+    data = driver.Create(out_raster, cols, rows, bands,
+                         gdal_types[arry.dtype], options or [])
+    data.SetGeoTransform(gt)
+    data.SetProjection(proj)
+
+    for b in range(bands):
+        out = arry[b]
+        if nodata is not None and out.dtype.kind == "f":
+            out = numpy.where(numpy.isnan(out), nodata, out)
+        data.GetRasterBand(b + 1).WriteArray(out)
+        if nodata is not None:
+            data.GetRasterBand(b + 1).SetNoDataValue(nodata)
+
+    data = None
+
+
+def iter_blocks(xsize, ysize, x_block_size, y_block_size):
+    """Yields the x offset, y offset, cols and rows for each block
+    of a raster"""
+    for i in range(0, ysize, y_block_size):
+        if i + y_block_size < ysize:
+            rows = y_block_size
+        else:
+            rows = ysize - i
+        for j in range(0, xsize, x_block_size):
+            if j + x_block_size < xsize:
+                cols = x_block_size
+            else:
+                cols = xsize - j
+            yield j, i, cols, rows
+
+
+class BandArray(object):
+    """
+    Wraps a GDAL raster band so windows can be read and written with
+    numpy style slicing, e.g. band[0:512, 1024:1536]. Lets the tiled
+    functions work directly on rasters that don't fit in memory.
+    """
+
+    def __init__(self, raster, band_num=1, update=False):
+        access = gdal.GA_Update if update else gdal.GA_ReadOnly
+        self.data = gdal.Open(raster, access)
+        self.band = self.data.GetRasterBand(band_num)
+        self.nodata = self.band.GetNoDataValue()
+        self.shape = (self.band.YSize, self.band.XSize)
+
+    def _window(self, key):
+        rows, cols = key
+        r0, r1, step = rows.indices(self.shape[0])
+        c0, c1, step = cols.indices(self.shape[1])
+        return c0, r0, c1 - c0, r1 - r0
+
+    def __getitem__(self, key):
+        xoff, yoff, xsize, ysize = self._window(key)
+        return self.band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def __setitem__(self, key, value):
+        xoff, yoff, xsize, ysize = self._window(key)
+        value = numpy.asarray(value)
+        if self.nodata is not None and value.dtype.kind == "f":
+            value = numpy.where(numpy.isnan(value), self.nodata, value)
+        self.band.WriteArray(value, xoff, yoff)
+
+    def close(self):
+        self.band.FlushCache()
+        self.band = None
+        self.data = None
+
+
+def create_like(template, out_raster, dtype, nodata=None, bands=1,
+                out_format="GTiff", options=None):
+    """Creates an empty raster with the same size, geotransform and
+    projection as the template raster and returns it as a BandArray
+    open for writing"""
+
+    data = gdal.Open(template)
+    driver = gdal.GetDriverByName(out_format)
+    out = driver.Create(out_raster, data.RasterXSize, data.RasterYSize,
+                        bands, gdal_types[numpy.dtype(dtype)],
+                        options or [])
+    out.SetGeoTransform(data.GetGeoTransform())
+    out.SetProjection(data.GetProjection())
+    if nodata is not None:
+        for b in range(bands):
+            out.GetRasterBand(b + 1).SetNoDataValue(nodata)
+    out = None
+    data = None
+    return BandArray(out_raster, update=True)
@@ -0,0 +1,165 @@
+"""
+Reclassify arrays with compiled tables, like Reclassify with
+RemapRange or RemapValue and ReclassByTable. A range table is
+compiled to sorted breakpoints looked up with searchsorted and a
+value table to a dense lookup array over the integer values, so each
+cell is looked up once instead of once per row of the table.
+reclassify_blocks streams a raster that doesn't fit in memory through
+a pool of threads.
+
+A value on the boundary of two ranges goes to the lower range, the
+same as RemapRange. A new value of None, "NoData" or "NODATA" is nan.
+With missing="DATA" values that are not in the table keep their
+value, with "NODATA" they become nan.
+"""
+
+from __future__ import division, print_function
+from multiprocessing.pool import ThreadPool
+import numpy
+
+# a value table is looked up by searchsorted instead of a lookup array
+# if its values span more than this many times the number of rows
+max_lut_spread = 64
+
+
+def _new_value(new):
+    """Returns a new value from a table as a float, nan for NoData"""
+    if new is None or (hasattr(new, "upper") and new.upper() == "NODATA"):
+        return numpy.nan
+    return float(new)
+
+
+def _unmatched(arry, missing):
+    """Returns the values given to cells that are not in a table"""
+    if missing.upper() == "DATA":
+        return arry
+    return numpy.full(arry.shape, numpy.nan)
+
+
+class RangeTable(object):
+    """
+    A compiled table of (from, to, new) ranges. Ranges that are in
+    order and don't overlap (except at a shared boundary) are looked up
+    with one searchsorted on the to values. Overlapping ranges are
+    applied one at a time with the lowest range winning.
+    """
+
+    def __init__(self, table):
+        rows = sorted((float(low), float(high), _new_value(new))
+                      for low, high, new in table)
+        self.low = numpy.array([row[0] for row in rows])
+        self.high = numpy.array([row[1] for row in rows])
+        self.new = numpy.array([row[2] for row in rows])
+        self.ordered = bool((self.low <= self.high).all() and
+                            (self.low[1:] >= self.high[:-1]).all())
+
+    def __call__(self, arry, missing="DATA"):
+        arry = numpy.asarray(arry, dtype=numpy.float64)
+        if not self.ordered or not self.low.size:
+            out = numpy.array(_unmatched(arry, missing), dtype=numpy.float64)
+            with numpy.errstate(invalid="ignore"):
+                for k in range(self.low.size - 1, -1, -1):
+                    out[(arry >= self.low[k]) & (arry <= self.high[k])] = self.new[k]
+            return out
+
+        # the first range whose upper end is >= the value, which is the
+        # lower range on a shared boundary. nan sorts past the end.
+        k = numpy.searchsorted(self.high, arry, side="left")
+        k = numpy.minimum(k, self.low.size - 1)
+        with numpy.errstate(invalid="ignore"):
+            found = (self.low[k] <= arry) & (arry <= self.high[k])
+        return numpy.where(found, self.new[k], _unmatched(arry, missing))
+
+
+class ValueTable(object):
+    """
+    A compiled table of (value, new) pairs for integer rasters. The new
+    values are held in a lookup array indexed by value - the smallest
+    value, or looked up with searchsorted if the values are too spread
+    out for that.
+    """
+
+    def __init__(self, table):
+        rows = sorted((float(value), _new_value(new)) for value, new in table)
+        self.values = numpy.array([row[0] for row in rows])
+        self.new = numpy.array([row[1] for row in rows])
+        self.lut = None
+        if self.values.size:
+            self.first = self.values[0]
+            spread = int(self.values[-1] - self.first) + 1
+            if spread <= max_lut_spread * self.values.size:
+                self.lut = numpy.full(spread, numpy.nan)
+                self.has = numpy.zeros(spread, dtype=bool)
+                idx = (self.values - self.first).astype(numpy.int64)
+                self.lut[idx] = self.new
+                self.has[idx] = True
+
+    def __call__(self, arry, missing="DATA"):
+        arry = numpy.asarray(arry)
+        if not self.values.size:
+            return numpy.array(_unmatched(arry, missing), dtype=numpy.float64)
+
+        if self.lut is not None:
+            with numpy.errstate(invalid="ignore"):
+                inside = (arry >= self.first) & (arry < self.first + self.lut.size)
+            k = numpy.zeros(arry.shape, dtype=numpy.int64)
+            k[inside] = arry[inside] - self.first
+            found = inside & self.has[k] & (arry == k + self.first)
+            new = self.lut[k]
+        else:
+            k = numpy.searchsorted(self.values, arry)
+            k = numpy.minimum(k, self.values.size - 1)
+            found = self.values[k] == arry
+            new = self.new[k]
+        return numpy.where(found, new, _unmatched(arry, missing))
+
+
+def compile_table(table):
+    """Returns a RangeTable for a table of (from, to, new) rows and a
+    ValueTable for (value, new) rows. Compiled tables are returned as
+    is."""
+    if isinstance(table, (RangeTable, ValueTable)):
+        return table
+    table = list(table)
+    if table and len(table[0]) == 2:
+        return ValueTable(table)
+    return RangeTable(table)
+
+
+def reclassify(arry, table, missing="DATA"):
+    """Returns the reclassified array as float64 with NoData as nan"""
+    return compile_table(table)(arry, missing)
+
+
+def reclassify_blocks(source, out, table, missing="DATA", nodata=None,
+                      block_rows=1024, threads=4, source_nodata=None):
+    """Reclassifies source block by block into out. Both are sliced
+    like 2d arrays, e.g. numpy memmaps or raster_io.BandArray. Blocks
+    are read and written in this thread, the lookups run on a pool of
+    threads. Source cells equal to source_nodata are NoData (nan) and
+    nan results are written as nodata if given."""
+
+    table = compile_table(table)
+    rows = source.shape[0]
+    bounds = [(r0, min(r0 + block_rows, rows))
+              for r0 in range(0, rows, block_rows)]
+
+    def work(block):
+        if source_nodata is not None:
+            block = numpy.where(block == source_nodata, numpy.nan, block)
+        result = table(block, missing)
+        if nodata is not None:
+            result[numpy.isnan(result)] = nodata
+        return result
+
+    pool = ThreadPool(threads)
+    try:
+        for i in range(0, len(bounds), threads):
+            batch = bounds[i:i + threads]
+            blocks = [numpy.asarray(source[r0:r1, :]) for r0, r1 in batch]
+            for (r0, r1), result in zip(batch, pool.map(work, blocks)):
+                out[r0:r1, :] = result.astype(out.dtype) if hasattr(out, "dtype") else result
+    finally:
+        pool.close()
+        pool.join()
+    return out
@@ -0,0 +1,105 @@
+"""
+Regression harness for the numpy hydro engine. Runs the engine on a
+reference DEM and compares the outputs cell by cell with reference
+grids exported from an ArcHydro run.
+
+The reference directory must hold GeoTIFFs named after the SSN
+outputs, e.g. hydro_dem.tif, fdr.tif, fac.tif.
+
+Usage:
+    python -m hydrotools.regression <reference_dir> [<tolerance>]
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import numpy
+
+from hydrotools import d8
+from hydrotools import raster_io
+
+
+def compare_grids(result, reference, tolerance=0.0,
+                  result_nodata=None, reference_nodata=None):
+    """Compares two arrays cell by cell and returns a dictionary
+    summarizing the differences. Cells are a match if both are NoData
+    or the absolute difference is <= tolerance."""
+
+    result = numpy.asarray(result, dtype=numpy.float64)
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    if result.shape != reference.shape:
+        raise ValueError("Grid shapes do not match: "
+                         "{0} and {1}".format(result.shape, reference.shape))
+
+    res_nd = ~d8.valid_cells(result, result_nodata)
+    ref_nd = ~d8.valid_cells(reference, reference_nodata)
+    both = ~res_nd & ~ref_nd
+
+    diff = numpy.zeros(result.shape)
+    diff[both] = numpy.abs(result[both] - reference[both])
+    mismatch = (res_nd != ref_nd) | (diff > tolerance)
+
+    rows, cols = numpy.nonzero(mismatch)
+    return {"cells": result.size,
+            "mismatched": int(mismatch.sum()),
+            "nodata_mismatched": int((res_nd != ref_nd).sum()),
+            "max_abs_diff": float(diff.max()) if diff.size else 0.0,
+            "first_mismatches": list(zip(rows[:10].tolist(),
+                                         cols[:10].tolist()))}
+
+
+def print_report(name, summary):
+    """Prints a comparison summary"""
+    status = "PASS" if summary["mismatched"] == 0 else "FAIL"
+    print("{0}: {1}".format(name, status))
+    print("    cells: {0}, mismatched: {1} ({2} NoData), "
+          "max abs diff: {3}".format(summary["cells"],
+                                     summary["mismatched"],
+                                     summary["nodata_mismatched"],
+                                     summary["max_abs_diff"]))
+    if summary["mismatched"]:
+        print("    first mismatches (row, col): "
+              "{0}".format(summary["first_mismatches"]))
+
+
+def run(reference_dir, tolerance=0.0):
+    """Runs the engine on the reference hydro_dem and compares the
+    flow direction and flow accumulation. Accumulation is computed
+    from the reference fdr when there is one so a flow direction
+    difference doesn't also show up as an accumulation difference.
+    Returns True if all the grids match."""
+
+    passed = True
+
+    def check(name, result, result_nd):
+        ref_path = os.path.join(reference_dir, name + ".tif")
+        if not os.path.isfile(ref_path):
+            print("{0}: no reference grid, skipping".format(name))
+            return True
+        ref, ref_gt, ref_proj, ref_nd = raster_io.read_raster(ref_path)
+        summary = compare_grids(result, ref, tolerance, result_nd, ref_nd)
+        print_report(name, summary)
+        return summary["mismatched"] == 0
+
+    dem, gt, proj, dem_nd = raster_io.read_raster(
+        os.path.join(reference_dir, "hydro_dem.tif"))
+
+    fdr = d8.flow_direction(dem, gt[1], nodata=dem_nd)
+    passed &= check("fdr", fdr, d8.FDR_NODATA)
+
+    fdr_path = os.path.join(reference_dir, "fdr.tif")
+    if os.path.isfile(fdr_path):
+        fdr, fdr_gt, fdr_proj, fdr_nd = raster_io.read_raster(fdr_path)
+        fac = d8.flow_accumulation(fdr, nodata=fdr_nd)
+    else:
+        fac = d8.flow_accumulation(fdr)
+    passed &= check("fac", fac, None)
+
+    return passed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    sys.exit(0 if run(sys.argv[1], tolerance) else 1)
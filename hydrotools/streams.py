@@ -0,0 +1,184 @@
+"""
+Stream definition, link segmentation and outlet cells from flow
+direction and flow accumulation arrays in one pass, in place of the
+ArcHydro StreamDefinition, StreamSegmentation and
+DrainagePointProcessing steps.
+
+A link starts at a stream head (no stream cells drain into it) or a
+junction (two or more stream cells drain into it) and runs down to
+the cell above the next junction or the end of the stream. The
+junction cell is the first cell of the link below it, the same as
+ArcHydro. A link's outlet is its most downstream cell.
+
+Class links (e.g. SSBT or Type F) are the links with a class cell in
+the 3x3 window around one of their cells, found from a summed area
+table of each class raster at the stream cells only.
+
+Catchments are labelled by sweeping the flow graph from the bottom
+up, one wave at a time, so each cell takes the label of the cell it
+drains to.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+from hydrotools import d8
+from hydrotools import flowgraph
+from hydrotools import local
+
+
+def _link_starts(parent):
+    """Follows each cell's parent up to the first cell of its link.
+    Cells that start a link are their own parent. Pointer jumping
+    takes log2 of the longest link passes."""
+    root = parent.copy()
+    while True:
+        up = root[root]
+        if numpy.array_equal(up, root):
+            return root
+        root = up
+
+
+def stream_network(fdr, fac=None, threshold=None, streams=None,
+                   nodata=d8.FDR_NODATA, graph=None):
+    """Returns a dictionary of stream arrays for a D8 flow direction
+    array. Stream cells are those where fac >= threshold, or the cells
+    of streams that are not 0 or nan if given (e.g. refined streams).
+    A cached flowgraph.FlowGraph can be passed instead of building
+    the downstream index from fdr.
+
+    stream   -- 1 on streams, 0 elsewhere, nan where fdr is NoData
+                (STREAM2; STREAM1 is stream with 0 as nan)
+    link     -- link id numbered 1.. in row order of the first cell
+                of each link, nan off the streams (STREAM_SEG)
+    junction -- True on cells where two or more links meet
+    outlet   -- link id on the outlet cell of each link, nan elsewhere
+                (OUTLETS1; OUTLETS2 is outlet with nan as 0)
+    """
+
+    if graph is not None:
+        shape, valid, down = graph.shape, graph.valid, graph.down
+    else:
+        fdr = numpy.asarray(fdr)
+        shape = fdr.shape
+        valid = d8.valid_cells(fdr, nodata).ravel()
+        down = d8.downstream_index(fdr, nodata)
+    size = valid.size
+
+    if streams is not None:
+        s = numpy.asarray(streams, dtype=numpy.float64).ravel()
+        with numpy.errstate(invalid="ignore"):
+            is_stream = (s != 0) & ~numpy.isnan(s)
+    else:
+        f = numpy.asarray(fac, dtype=numpy.float64).ravel()
+        with numpy.errstate(invalid="ignore"):
+            is_stream = f >= threshold
+    is_stream &= valid
+
+    # stream cells and where each drains, -1 if not to a stream cell
+    cells = numpy.flatnonzero(is_stream)
+    pos = numpy.full(size, -1, dtype=numpy.int64)
+    pos[cells] = numpy.arange(cells.size)
+    d = down[cells]
+    d = numpy.where(d >= 0, pos[numpy.maximum(d, 0)], -1)
+    flows = d >= 0
+
+    upstream = numpy.bincount(d[flows], minlength=cells.size)
+    junction = upstream >= 2
+
+    # a cell with one upstream stream cell continues that cell's link
+    parent = numpy.arange(cells.size)
+    single = flows & (upstream[numpy.maximum(d, 0)] == 1)
+    parent[d[single]] = numpy.flatnonzero(single)
+    start = _link_starts(parent)
+
+    ids = numpy.zeros(cells.size, dtype=numpy.int64)
+    firsts = numpy.flatnonzero(parent == numpy.arange(cells.size))
+    ids[firsts] = numpy.arange(1, firsts.size + 1)
+    link_ids = ids[start]
+
+    # the outlet is the cell whose downstream cell is in another link
+    last = ~flows
+    last[flows] = link_ids[d[flows]] != link_ids[flows]
+
+    stream = numpy.where(valid, 0.0, numpy.nan)
+    stream[cells] = 1.0
+    link = numpy.full(size, numpy.nan)
+    link[cells] = link_ids
+    junctions = numpy.zeros(size, dtype=bool)
+    junctions[cells[junction]] = True
+    outlet = numpy.full(size, numpy.nan)
+    outlet[cells[last]] = link_ids[last]
+
+    return {"stream": stream.reshape(shape), "link": link.reshape(shape),
+            "junction": junctions.reshape(shape),
+            "outlet": outlet.reshape(shape)}
+
+
+def catchments(link, fdr=None, outlets=None, nodata=d8.FDR_NODATA,
+               graph=None):
+    """Returns a dictionary with the catchment of each stream link,
+    like CatchmentGridDelineation. link is the link id array (nan off
+    the streams) and fdr the flow direction array or graph a cached
+    flowgraph.FlowGraph. Cells that don't drain to a stream are nan.
+
+    catchment -- link id of the link each cell drains to
+    ids       -- sorted catchment ids
+    count     -- number of cells in each catchment
+    fac_rca   -- only if outlets (True or 1 on outlet cells) is given,
+                 the number of upstream cells in the same catchment
+                 plus 1, the same as FAC_RCA. Outlet cells are nan;
+                 count is the value they would have.
+    """
+
+    if graph is None:
+        graph = flowgraph.FlowGraph.from_fdr(fdr, nodata)
+    valid, down = graph.valid, graph.down
+    order, offsets = graph.order, graph.offsets
+
+    label = numpy.array(link, dtype=numpy.float64).ravel()
+    label[~valid] = numpy.nan
+
+    # downstream waves first so every cell's downstream cell is done
+    for w in range(offsets.size - 2, -1, -1):
+        seg = order[offsets[w]:offsets[w + 1]]
+        seg = seg[numpy.isnan(label[seg])]
+        label[seg] = label[down[seg]]
+
+    has = ~numpy.isnan(label)
+    ids, count = numpy.unique(label[has].astype(numpy.int64),
+                              return_counts=True)
+    out = {"catchment": label.reshape(graph.shape), "ids": ids,
+           "count": count}
+
+    if outlets is not None:
+        inside = numpy.asarray(outlets, dtype=numpy.float64).ravel() != 1
+        fac = d8.flow_accumulation(None, mask=inside.reshape(graph.shape),
+                                   graph=graph)
+        out["fac_rca"] = fac + 1.0
+    return out
+
+
+def class_links(classes, link, size=3, threshold=1):
+    """Returns a (layers, rows, cols) stack with a link raster for each
+    class raster in classes, a list or stack where class cells are 1
+    and others 0 or nan. A link cell keeps its link id if the focal
+    SUM (DATA) of the class over a size window is >= threshold there
+    and is nan otherwise, the same as FocalStatistics, Times with the
+    stream raster and Con(Value >= threshold) on the link raster. Only
+    the stream cells of the class links are kept, so
+    DrainageLineProcessing makes the same partial lines from them."""
+
+    link = numpy.asarray(link, dtype=numpy.float64)
+    classes = numpy.asarray(classes, dtype=numpy.float64)
+    if classes.ndim == 2:
+        classes = classes[None]
+
+    rows, cols = numpy.nonzero(~numpy.isnan(link))
+    focal = local.window_sum(local.summed_area_table(classes), rows, cols,
+                             size)
+    out = numpy.full((len(focal),) + link.shape, numpy.nan)
+    for k, f in enumerate(focal):
+        keep = f >= threshold
+        out[k, rows[keep], cols[keep]] = link[rows[keep], cols[keep]]
+    return out
@@ -0,0 +1,76 @@
+"""
+Table columns as aligned numpy arrays, in place of the nested
+dictionaries filled one cursor row at a time. Keys are matched with
+a sort and searchsorted so a whole column is looked up at once.
+"""
+
+from __future__ import division, print_function
+import csv
+import os
+import sys
+import numpy
+
+
+def index_of(keys, values):
+    """Returns the position in keys of each of values. Raises a
+    KeyError for the first value that is not in keys."""
+    keys = numpy.asarray(keys)
+    values = numpy.asarray(values)
+    if not keys.size:
+        if values.size:
+            raise KeyError(values.ravel()[0])
+        return numpy.zeros(values.shape, dtype=numpy.int64)
+    sorter = numpy.argsort(keys, kind="mergesort")
+    pos = numpy.searchsorted(keys, values, sorter=sorter)
+    pos = sorter[numpy.minimum(pos, keys.size - 1)]
+    found = keys[pos] == values
+    if not found.all():
+        raise KeyError(values[~found].ravel()[0])
+    return pos
+
+
+def dilution_factors(hydro_id, grid_id, next_down_id, value, fac_min,
+                     fac_max):
+    """Returns the dilution factor, downstream mixing and tributary
+    flow accumulation of each stream link as three arrays.
+
+    hydro_id, grid_id and next_down_id are the stream link columns and
+    value, fac_min and fac_max the flow accumulation min/max table by
+    GridID. TRIB is the link's maximum flow accumulation, DS_MIX the
+    minimum of the link downstream and DF = DS_MIX / TRIB. Links at the
+    watershed outlet (next_down_id -1) have a DF and DS_MIX of -1."""
+
+    grid_id = numpy.asarray(grid_id)
+    next_down_id = numpy.asarray(next_down_id)
+    fac_min = numpy.asarray(fac_min, dtype=numpy.float64)
+    fac_max = numpy.asarray(fac_max, dtype=numpy.float64)
+
+    trib = fac_max[index_of(value, grid_id)]
+    down = next_down_id != -1
+    down_gid = grid_id[index_of(hydro_id, next_down_id[down])]
+
+    down_mix = numpy.full(grid_id.size, -1.0)
+    down_mix[down] = fac_min[index_of(value, down_gid)]
+    df = numpy.full(grid_id.size, -1.0)
+    df[down] = down_mix[down] / trib[down]
+    return df, down_mix, trib
+
+
+def write_table(path, columns, names):
+    """Writes a list of equal length columns to a table. The format is
+    Parquet if path ends with .parquet (needs pandas and pyarrow or
+    fastparquet) and csv otherwise."""
+    if os.path.splitext(path)[1].lower() == ".parquet":
+        import pandas
+        frame = pandas.DataFrame(dict(zip(names, columns)), columns=names)
+        frame.to_parquet(path, index=False)
+        return
+
+    if sys.version_info[0] < 3:
+        f = open(path, "wb")
+    else:
+        f = open(path, "w", newline="")
+    with f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows(zip(*[numpy.asarray(c).tolist() for c in columns]))
@@ -0,0 +1,356 @@
+"""
+Tiled, out-of-core execution for rasters that don't fit in memory.
+Local operators (see local.py) run on tiles read with a halo of
+extra cells so the results match a whole raster run. Flow
+accumulation runs on each tile independently and the flow that
+crosses tile edges is reconciled afterward. Tiles are spread over a
+process pool and the tile size is picked so the tiles in flight stay
+under a memory limit.
+
+Sources and outputs are file paths so each worker can open them
+itself: .npy files are opened as numpy memmaps and anything else as
+a GDAL raster (raster_io.BandArray). numpy arrays can also be passed
+but then the tiles run in the current process.
+"""
+
+from __future__ import division, print_function
+from multiprocessing import Pool, cpu_count
+import sys
+import numpy
+
+from hydrotools import d8
+
+# arcpy returns unicode paths on Python 2
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def open_array(source, update=False):
+    """Returns something that can be sliced like a 2d array for a
+    .npy file, a raster path or an array"""
+    if not isinstance(source, string_types):
+        return source
+    if source.lower().endswith(".npy"):
+        return numpy.load(source, mmap_mode="r+" if update else "r")
+    from hydrotools import raster_io
+    return raster_io.BandArray(source, update=update)
+
+
+def create_array(out, shape, dtype, template=None, nodata=None):
+    """Creates an output for the tiles. out is a .npy path, a raster
+    path (created like the template raster) or an existing array."""
+    if not isinstance(out, string_types):
+        return out
+    if out.lower().endswith(".npy"):
+        arry = numpy.lib.format.open_memmap(out, mode="w+", dtype=dtype,
+                                            shape=tuple(shape))
+        if nodata is not None:
+            arry[:] = nodata
+        return arry
+    from hydrotools import raster_io
+    return raster_io.create_like(template, out, dtype, nodata)
+
+
+def _close(arry):
+    if hasattr(arry, "close"):
+        arry.close()
+    elif hasattr(arry, "flush"):
+        arry.flush()
+
+
+def tile_size_for_memory(max_memory_mb, arrays, halo=0, processes=1,
+                         itemsize=8):
+    """Returns the largest tile size where processes tiles, each
+    holding arrays float64 arrays of (tile + 2 * halo) cells a side,
+    stay under max_memory_mb. The parent process holding one tile
+    while writing is counted as one more process."""
+    per_tile = max_memory_mb * 1024.0 ** 2 / (processes + 1)
+    side = int((per_tile / (arrays * itemsize)) ** 0.5) - 2 * halo
+    # whole blocks read faster
+    return max(256, side // 256 * 256)
+
+
+def tiles(shape, tile_size):
+    """Returns the (r0, c0, r1, c1) bounds of each tile"""
+    rows, cols = shape
+    return [(r0, c0, min(r0 + tile_size, rows), min(c0 + tile_size, cols))
+            for r0 in range(0, rows, tile_size)
+            for c0 in range(0, cols, tile_size)]
+
+
+def read_window(arry, bounds, halo=0, fill=numpy.nan):
+    """Reads a tile plus halo cells on each side. Cells off the grid
+    are set to fill."""
+    rows, cols = arry.shape
+    r0, c0, r1, c1 = bounds
+    hr0, hc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+    hr1, hc1 = min(r1 + halo, rows), min(c1 + halo, cols)
+    window = numpy.asarray(arry[hr0:hr1, hc0:hc1])
+    pad = ((hr0 - (r0 - halo), (r1 + halo) - hr1),
+           (hc0 - (c0 - halo), (c1 + halo) - hc1))
+    if any(pad[0]) or any(pad[1]):
+        if isinstance(fill, float) and numpy.isnan(fill):
+            window = window.astype(numpy.float64)
+        window = numpy.pad(window, pad, mode="constant", constant_values=fill)
+    return window
+
+
+def read_float(arry, bounds, halo=0):
+    """Reads a tile plus halo as float64 with NoData as nan"""
+    window = numpy.asarray(read_window(arry, bounds, halo), dtype=numpy.float64)
+    nodata = getattr(arry, "nodata", None)
+    if nodata is not None:
+        window[window == nodata] = numpy.nan
+    return window
+
+
+def _pool(processes):
+    """Starts a pool of processes. On Windows each worker imports the
+    main script before it runs a task, which would rerun a flat
+    script like SSN_dem_processing.py from the top. The tile
+    functions all live in hydrotools so the main script is hidden
+    while the workers start."""
+    main = sys.modules["__main__"]
+    main_file = getattr(main, "__file__", None)
+    main_spec = getattr(main, "__spec__", None)
+    argv = list(sys.argv)
+    try:
+        if main_file is not None:
+            del main.__file__
+        main.__spec__ = None
+        if sys.argv:
+            sys.argv[0] = ""
+        return Pool(processes)
+    finally:
+        if main_file is not None:
+            main.__file__ = main_file
+        main.__spec__ = main_spec
+        sys.argv[:] = argv
+
+
+def _run(func, tasks, processes):
+    """Yields func(task) for each task, in any order, using a pool of
+    processes. Tasks are handed out a few at a time so finished
+    tiles don't pile up in memory waiting to be written."""
+    if processes == 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    pool = _pool(processes)
+    try:
+        batch = processes * 2
+        for i in range(0, len(tasks), batch):
+            for result in pool.imap_unordered(func, tasks[i:i + batch]):
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _processes(sources, processes):
+    if any(not isinstance(s, string_types) for s in sources if s is not None):
+        return 1
+    return processes or cpu_count()
+
+
+# -- local operators ------------------------------------------------------
+
+def _local_task(task):
+    func, sources, bounds, halo, args = task
+    windows = [read_float(open_array(s), bounds, halo) for s in sources]
+    result = numpy.asarray(func(*(windows + list(args))))
+    r0, c0, r1, c1 = bounds
+    return bounds, result[..., halo:halo + r1 - r0, halo:halo + c1 - c0]
+
+
+def run_local(func, sources, out, halo=0, args=(), dtype=numpy.float32,
+              nodata=None, template=None, tile_size=None,
+              max_memory_mb=1024, processes=None):
+    """Runs func(*(tiles + args)) on each tile of the source rasters
+    and writes the results to out. func must be a module level
+    function (e.g. local.slope) that takes float64 arrays with NoData
+    as nan and returns an array of the same shape. halo is the number
+    of cells func needs around each cell. If out is a list, func
+    returns a (len(out), rows, cols) stack and each layer is written
+    to one output. Returns the output array or list of arrays.
+    Rasters created from a path are closed."""
+
+    processes = _processes(sources, processes)
+    shape = open_array(sources[0]).shape
+    outs = list(out) if isinstance(out, (list, tuple)) else [out]
+    if tile_size is None:
+        tile_size = tile_size_for_memory(max_memory_mb,
+                                         len(sources) + 2 * len(outs),
+                                         halo, processes)
+
+    created = [isinstance(o, string_types) for o in outs]
+    outs = [create_array(o, shape, dtype, template or sources[0], nodata)
+            for o in outs]
+    tasks = [(func, sources, bounds, halo, args)
+             for bounds in tiles(shape, tile_size)]
+    for (r0, c0, r1, c1), result in _run(_local_task, tasks, processes):
+        if nodata is not None:
+            result = numpy.where(numpy.isnan(result), nodata, result)
+        result = result.reshape((len(outs), r1 - r0, c1 - c0))
+        for o, layer in zip(outs, result):
+            o[r0:r1, c0:c1] = layer.astype(dtype)
+    for o, c in zip(outs, created):
+        if c:
+            _close(o)
+    return outs if isinstance(out, (list, tuple)) else outs[0]
+
+
+# -- flow accumulation ----------------------------------------------------
+
+def _tile_fdr(fdr, weight, masked, nodata, bounds, halo):
+    """Reads a flow direction tile and its weights. If masked, cells
+    with NoData weight are set to NoData flow direction."""
+    f = read_window(open_array(fdr), bounds, halo, nodata)
+    w = None
+    if weight is not None:
+        w = read_float(open_array(weight), bounds, halo)
+        if masked:
+            f = numpy.where(numpy.isnan(w), nodata, f)
+    return f, w
+
+
+def _accumulate_task(task):
+    """First pass. Accumulates one tile on its own and returns where
+    flow leaves the tile."""
+    fdr, weight, masked, nodata, bounds, shape = task
+    r0, c0, r1, c1 = bounds
+    rows, cols = r1 - r0, c1 - c0
+    f, w = _tile_fdr(fdr, weight, masked, nodata, bounds, 1)
+    core = f[1:-1, 1:-1]
+
+    valid = d8.valid_cells(core, nodata).ravel()
+    down = d8.downstream_index(core, nodata)
+    order, offsets = d8.topological_order(down)
+    if w is None:
+        wv = valid.astype(numpy.float64)
+    else:
+        wv = numpy.nan_to_num(w[1:-1, 1:-1].ravel())
+    total = d8._sweep(wv[numpy.newaxis].copy(), down, order, offsets)[0]
+    fac = total - wv
+    fac[~valid] = numpy.nan
+
+    # cells that drain to a valid cell in another tile
+    idx = numpy.arange(core.size, dtype=numpy.int64)
+    r = idx // cols
+    c = idx % cols
+    target = numpy.full(core.size, -1, dtype=numpy.int64)
+    fv = core.ravel()
+    for k in range(8):
+        nr = r + d8.d8_row[k]
+        nc = c + d8.d8_col[k]
+        sel = (valid & (fv == d8.d8_codes[k]) &
+               ((nr < 0) | (nr >= rows) | (nc < 0) | (nc >= cols)))
+        into = d8.valid_cells(f[nr[sel] + 1, nc[sel] + 1], nodata)
+        target[idx[sel][into]] = (nr[sel][into] + r0) * shape[1] + nc[sel][into] + c0
+    is_exit = target >= 0
+
+    # the cell each cell's flow leaves the tile from
+    term = idx.copy()
+    for w_i in range(offsets.size - 2, -1, -1):
+        seg = order[offsets[w_i]:offsets[w_i + 1]]
+        term[seg] = term[down[seg]]
+
+    perimeter = (r == 0) | (r == rows - 1) | (c == 0) | (c == cols - 1)
+    to_global = (r + r0) * shape[1] + c + c0
+    term_exit = numpy.where(is_exit[term], to_global[term], -1)
+
+    return (bounds, fac.reshape(rows, cols), to_global[perimeter],
+            term_exit[perimeter], to_global[is_exit], target[is_exit],
+            total[is_exit])
+
+
+def _inflow_task(task):
+    """Third pass. Returns the flow from other tiles that passes
+    through each cell of the tile."""
+    fdr, weight, masked, nodata, bounds, cells, inflow = task
+    r0, c0, r1, c1 = bounds
+    f, w = _tile_fdr(fdr, weight, masked, nodata, bounds, 0)
+    down = d8.downstream_index(f, nodata)
+    order, offsets = d8.topological_order(down)
+    total = numpy.zeros((1, f.size))
+    total[0, cells] = inflow
+    total = d8._sweep(total, down, order, offsets)[0]
+    return bounds, total.reshape(f.shape)
+
+
+def flow_accumulation_tiled(fdr, out, weight=None, masked=False,
+                            nodata=d8.FDR_NODATA, tile_size=None,
+                            max_memory_mb=1024, processes=None,
+                            template=None):
+    """Flow accumulation tile by tile, the same as
+    d8.flow_accumulation. fdr and weight are .npy or raster paths (or
+    arrays) and out is written as float32 with nan for NoData. If
+    masked, cells with NoData weight don't pass flow, the same as the
+    mask in d8.flow_accumulation_stack.
+
+    Each tile is accumulated on its own. The flow leaving each tile
+    is then routed across the tile edges through a small graph of
+    the perimeter cells, and the inflow added back to each tile in a
+    second pass over the tiles. Returns the output array. Rasters
+    created from a path are closed."""
+
+    processes = _processes([fdr, weight], processes)
+    shape = open_array(fdr).shape
+    if tile_size is None:
+        tile_size = tile_size_for_memory(max_memory_mb, 6, 1, processes)
+    bounds = tiles(shape, tile_size)
+    created = isinstance(out, string_types)
+    out = create_array(out, shape, numpy.float32, template or fdr)
+
+    # -- pass 1. accumulate each tile
+    tasks = [(fdr, weight, masked, nodata, b, shape) for b in bounds]
+    perimeter = {}
+    exits = []
+    for result in _run(_accumulate_task, tasks, processes):
+        b, fac, cells, term, exit_cells, targets, totals = result
+        out[b[0]:b[2], b[1]:b[3]] = fac.astype(numpy.float32)
+        perimeter[b] = cells
+        exits.append((exit_cells, targets, totals, cells, term))
+
+    # -- pass 2. route flow between tiles. Each perimeter cell is an
+    # entry node (flow arriving from other tiles) and an exit node
+    # (flow leaving the tile).
+    cells = numpy.sort(numpy.concatenate(list(perimeter.values())))
+    n = cells.size
+    down = numpy.full(2 * n, -1, dtype=numpy.int64)
+    node_w = numpy.zeros((1, 2 * n))
+    for exit_cells, targets, totals, tile_cells, term in exits:
+        # entry -> the exit its flow leaves the tile from
+        has = term >= 0
+        down[2 * numpy.searchsorted(cells, tile_cells[has])] = \
+            2 * numpy.searchsorted(cells, term[has]) + 1
+        # exit -> the entry it drains to in the next tile
+        e = 2 * numpy.searchsorted(cells, exit_cells) + 1
+        down[e] = 2 * numpy.searchsorted(cells, targets)
+        node_w[0, e] = totals
+    del exits
+
+    order, offsets = d8.topological_order(down)
+    inflow = d8._sweep(node_w, down, order, offsets)[0, 0::2]
+
+    # -- pass 3. add the inflow to each tile
+    tasks = []
+    for b in bounds:
+        tile_cells = perimeter[b]
+        flow = inflow[numpy.searchsorted(cells, tile_cells)]
+        has = flow > 0
+        if not has.any():
+            continue
+        local = ((tile_cells[has] // shape[1] - b[0]) * (b[3] - b[1]) +
+                 tile_cells[has] % shape[1] - b[1])
+        tasks.append((fdr, weight, masked, nodata, b, local, flow[has]))
+
+    for (r0, c0, r1, c1), extra in _run(_inflow_task, tasks, processes):
+        out[r0:r1, c0:c1] = (numpy.asarray(out[r0:r1, c0:c1], dtype=numpy.float64) +
+                             extra).astype(numpy.float32)
+    if created:
+        _close(out)
+    return out
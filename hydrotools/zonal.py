@@ -0,0 +1,243 @@
+"""
+Zonal statistics with numpy bincount and ufunc.reduceat. Computes the
+count, sum, mean, minimum, maximum and standard deviation of any
+number of value arrays against one zone array, block by block so only
+a few rows are in memory at a time. Results can be returned as a
+table or broadcast back to the zone cells as a raster.
+"""
+
+from __future__ import division, print_function
+import numpy
+
+from hydrotools import d8
+
+statistics = ["count", "sum", "mean", "min", "max", "std"]
+
+# field names used by ZonalStatisticsAsTable
+table_fields = {"count": "COUNT", "sum": "SUM", "mean": "MEAN",
+                "min": "MIN", "max": "MAX", "std": "STD"}
+
+
+class Zones(object):
+    """
+    Indexes a zone array once so the statistics of any number of
+    value arrays can be taken with bincount. Cells with NoData or nan
+    zones are not part of any zone.
+    """
+
+    def __init__(self, zones, nodata=None):
+        zones = numpy.asarray(zones).ravel()
+        self.size = zones.size
+        self.valid = d8.valid_cells(zones, nodata)
+        self.ids, self.inverse = numpy.unique(zones[self.valid].astype(numpy.int64),
+                                              return_inverse=True)
+
+    def summarize(self, values):
+        """Returns a ZonalStats for a (layers, cells) array or a single
+        array with the same number of cells as the zones. nan values
+        are ignored."""
+
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values.reshape(-1, self.size)
+        layers = values.shape[0]
+        n = self.ids.size
+        stats = ZonalStats.empty(self.ids, layers)
+
+        for k in range(layers):
+            v = values[k][self.valid]
+            has = ~numpy.isnan(v)
+            inv = self.inverse[has]
+            v = v[has]
+            if not v.size:
+                continue
+
+            count = numpy.bincount(inv, minlength=n)
+            total = numpy.bincount(inv, v, minlength=n)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                mean = total / count
+            m2 = numpy.bincount(inv, (v - mean[inv]) ** 2, minlength=n)
+
+            # sort by zone so min and max are one reduceat each
+            order = numpy.argsort(inv, kind="mergesort")
+            inv = inv[order]
+            v = v[order]
+            starts = numpy.flatnonzero(numpy.r_[True, inv[1:] != inv[:-1]])
+            present = inv[starts]
+
+            stats.count[k] = count
+            stats.sum[k] = total
+            stats.m2[k] = m2
+            stats.minimum[k, present] = numpy.minimum.reduceat(v, starts)
+            stats.maximum[k, present] = numpy.maximum.reduceat(v, starts)
+
+        return stats
+
+    def broadcast(self, per_zone):
+        """Returns a (layers, cells) array with each zone cell set to
+        the value of its zone in a (layers, zones) array. Cells
+        outside a zone are nan."""
+        per_zone = numpy.atleast_2d(per_zone)
+        out = numpy.full((per_zone.shape[0], self.size), numpy.nan)
+        out[:, self.valid] = per_zone[:, self.inverse]
+        return out
+
+    def mean(self, values):
+        """Returns the zonal mean of each row of a (layers, cells) array
+        broadcast back to the zone cells"""
+        return self.broadcast(self.summarize(values).get("mean"))
+
+
+class ZonalStats(object):
+    """
+    Per zone running totals for a stack of value layers. Results from
+    different blocks of the same rasters are combined with merge.
+
+    ids     -- sorted zone values
+    count   -- (layers, zones) number of cells with data
+    sum     -- (layers, zones) sum of the values
+    m2      -- (layers, zones) sum of squared differences from the mean
+    minimum -- (layers, zones) minimum value, inf if the zone has no data
+    maximum -- (layers, zones) maximum value, -inf if the zone has no data
+    """
+
+    def __init__(self, ids, count, total, m2, minimum, maximum):
+        self.ids = ids
+        self.count = count
+        self.sum = total
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @classmethod
+    def empty(cls, ids, layers):
+        shape = (layers, ids.size)
+        return cls(ids, numpy.zeros(shape, dtype=numpy.int64),
+                   numpy.zeros(shape), numpy.zeros(shape),
+                   numpy.full(shape, numpy.inf),
+                   numpy.full(shape, -numpy.inf))
+
+    def _expand(self, ids):
+        """Returns a copy of the totals over a larger set of zone ids"""
+        out = ZonalStats.empty(ids, self.count.shape[0])
+        pos = numpy.searchsorted(ids, self.ids)
+        out.count[:, pos] = self.count
+        out.sum[:, pos] = self.sum
+        out.m2[:, pos] = self.m2
+        out.minimum[:, pos] = self.minimum
+        out.maximum[:, pos] = self.maximum
+        return out
+
+    def merge(self, other):
+        """Returns the totals of both blocks combined (Chan et al.
+        1979 for the variance)"""
+        ids = numpy.union1d(self.ids, other.ids)
+        a = self._expand(ids)
+        b = other._expand(ids)
+
+        count = a.count + b.count
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            delta = b.sum / b.count - a.sum / a.count
+            m2 = a.m2 + b.m2 + delta ** 2 * a.count * b.count / count
+        m2 = numpy.where((a.count > 0) & (b.count > 0), m2, a.m2 + b.m2)
+
+        return ZonalStats(ids, count, a.sum + b.sum, m2,
+                          numpy.minimum(a.minimum, b.minimum),
+                          numpy.maximum(a.maximum, b.maximum))
+
+    def get(self, stat):
+        """Returns a (layers, zones) array of one statistic. Zones
+        without data in a layer are nan except for count and sum."""
+        if stat == "count":
+            return self.count
+        if stat == "sum":
+            return self.sum
+
+        empty = self.count == 0
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            if stat == "mean":
+                out = self.sum / self.count
+            elif stat == "std":
+                # population standard deviation, the same as ArcGIS
+                out = numpy.sqrt(self.m2 / self.count)
+            elif stat == "min":
+                out = self.minimum.copy()
+            elif stat == "max":
+                out = self.maximum.copy()
+            else:
+                raise ValueError("Unknown statistic: {0}".format(stat))
+        out[empty] = numpy.nan
+        return out
+
+    def table(self, layer=0, stats=statistics):
+        """Returns a numpy structured array with a row for each zone
+        that has data in the layer. Fields are named like the output
+        of ZonalStatisticsAsTable (VALUE, COUNT, MIN, ...) so it can
+        be written with arcpy.da.NumPyArrayToTable."""
+        keep = self.count[layer] > 0
+        dtype = [("VALUE", numpy.int64)]
+        dtype += [(table_fields[s], numpy.int64 if s == "count" else numpy.float64)
+                  for s in stats]
+        out = numpy.zeros(int(keep.sum()), dtype=dtype)
+        out["VALUE"] = self.ids[keep]
+        for s in stats:
+            out[table_fields[s]] = self.get(s)[layer][keep]
+        return out
+
+
+def _blocks(rows, block_rows):
+    if block_rows is None:
+        block_rows = rows
+    for r0 in range(0, rows, block_rows):
+        yield r0, min(r0 + block_rows, rows)
+
+
+def zonal_statistics(zones, values, nodata=None, block_rows=None):
+    """Returns a ZonalStats with a layer for each value array in values
+    against the zone array. zones is a 2d array and values a 2d array, a 3d stack
+    or a list of 2d arrays. Any of them can be numpy memmaps or
+    raster_io.BandArray; with block_rows set only that many rows are
+    read at a time. nan values are ignored."""
+
+    if hasattr(values, "ndim") and values.ndim == 2:
+        values = [values]
+    rows = zones.shape[0]
+
+    result = None
+    for r0, r1 in _blocks(rows, block_rows):
+        z = Zones(zones[r0:r1, :], nodata)
+        block = numpy.array([numpy.asarray(v[r0:r1, :], dtype=numpy.float64)
+                             for v in values])
+        stats = z.summarize(block.reshape(block.shape[0], -1))
+        result = stats if result is None else result.merge(stats)
+    return result
+
+
+def zonal_raster(zones, result, stat, out=None, nodata=None, block_rows=None):
+    """Sets each zone cell to a statistic of its zone, like
+    ZonalStatistics. result is a ZonalStats. Returns a (layers, rows,
+    cols) array, or writes block by block to out (anything that
+    supports 3d slicing) and returns out. Cells outside a zone or in
+    a zone without data are nan."""
+
+    per_zone = result.get(stat).astype(numpy.float64)
+    layers = per_zone.shape[0]
+    rows, cols = zones.shape
+    if out is None:
+        out = numpy.full((layers, rows, cols), numpy.nan)
+
+    if not result.ids.size:
+        out[:] = numpy.nan
+        return out
+
+    for r0, r1 in _blocks(rows, block_rows):
+        z = numpy.asarray(zones[r0:r1, :])
+        valid = d8.valid_cells(z, nodata)
+        block = numpy.full((layers,) + z.shape, numpy.nan)
+        pos = numpy.searchsorted(result.ids, z[valid].astype(numpy.int64))
+        pos = numpy.minimum(pos, result.ids.size - 1)
+        found = result.ids[pos] == z[valid]
+        values = numpy.full((layers, pos.size), numpy.nan)
+        values[:, found] = per_zone[:, pos[found]]
+        block[:, valid] = values
+        out[:, r0:r1, :] = block
+    return out
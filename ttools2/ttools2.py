@@ -1,5 +1,11 @@
 from __future__ import division
 from __future__ import print_function
+import os
+import sys
+import numpy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hydrotools import polyline
 
 class Blocks(object):
     """
@@ -24,7 +30,7 @@ class StreamReach(object):
       
     def __init__(self, **kwargs):
 
-        attrs = ["nodes", "stream_km"]        
+        attrs = ["nodes", "stream_id", "stream_km", "vertices"]
         
         for attr in attrs:
             x = kwargs[attr] if attr in kwargs.keys() else None
@@ -36,10 +42,25 @@ class StreamReach(object):
             data[attr] = getattr(self,attr)
         return data
                                     
-    def make_nodes(self):
+    def make_nodes(self, node_dx=50):
+        """Makes a stream node every node_dx along the reach starting
+        at the downstream end plus one at the upstream end. vertices
+        are the reach's (x, y) vertices ordered from upstream to
+        downstream."""
         print("making nodes")
         
-        self.nodes = [1, 2, 3, 4]
+        lines = polyline.Polylines([self.vertices])
+        length = lines.length[0]
+        km = numpy.r_[numpy.arange(0, length, node_dx), length]
+        if km.size > 1 and km[-1] == km[-2]:
+            km = km[:-1]
+        x, y = lines.points(numpy.zeros(km.size, dtype=numpy.int64),
+                            length - km)
+        
+        self.nodes = [StreamNode(node_id=i, stream_id=self.stream_id,
+                                 stream_km=float(km[i]) / 1000.0,
+                                 point_x=float(x[i]), point_y=float(y[i]))
+                      for i in range(km.size)]
         
     def sort_nodes(self):
         print("sort nodes")
@@ -61,7 +82,7 @@ class StreamNode(object):
     def __init__(self, **kwargs):
         
         attrs = ["node_id",
-                 "stream_id"
+                 "stream_id",
                  "stream_km", 
                  "point_x",
                  "point_y",